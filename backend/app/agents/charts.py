@@ -1,12 +1,22 @@
+import asyncio
+import time
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
 from app.state.state import AgentState
 from app.core.config import settings
-from app.core.llm import get_llm, get_thinking_instructions
-from app.core.context import set_context, get_messages, get_context
+from app.core.logger import logger
+from app.core.llm import get_llm, bind_tools, get_thinking_instructions
+from app.core.context import set_context, get_messages, get_context, current_artifact
+from app.core.patching import generate_edit
+from app.core.cache import cached_tool
+from app.core.validation import validate_output
+from app.core.tokens import assemble_context
+from app.core.datasets import DatasetError, bind_option, strip_bound_data, describe
+from app.agents.direct import direct_tool_call, enrichment_instructions
 import json
 
-llm = get_llm()
+llm = get_llm(role="tool", agent="charts")
+agent_llm = get_llm(role="agent", agent="charts")
 
 CHARTS_SYSTEM_PROMPT = """You are a World-Class Data Visualization Specialist. Your goal is to generate professional, insightful, and aesthetically pleasing ECharts configurations (JSON).
 
@@ -39,7 +49,53 @@ CHARTS_SYSTEM_PROMPT = """You are a World-Class Data Visualization Specialist. Y
 - Return ONLY the JSON string.
 """
 
+DATASET_INSTRUCTIONS = """
+
+### DATASETS (BIND COLUMNS, NEVER TYPE THE DATA)
+The user attached these datasets (schema and summary statistics only):
+<<DATASETS>>
+
+To plot them, add a `dataset` entry with a `bind` spec instead of data points; the server
+computes its `dimensions` and `source` and downsamples long series:
+{"dataset": {"bind": {"dataset": 1, "x": "date", "bucket": "month", "y": [{"column": "revenue", "agg": "sum", "as": "Revenue"}]}},
+ "xAxis": {"type": "category"}, "yAxis": {}, "series": [{"type": "line", "encode": {"x": "date", "y": "Revenue"}}]}
+- `dataset`: id or name. `x`: the x axis column. Text columns are grouped; time columns can
+  be bucketed ("bucket": year/month/week/day/hour/minute); number columns binned ("bins": n).
+- `y`: measures, `agg` one of sum, mean, count, min, max, median (`as` defaults to
+  `<column>_<agg>`). Without `agg` the rows are plotted raw, sorted by x (scatter, long time series).
+  Text columns can only be counted ("agg": "count").
+- `groupBy`: a text column splitting the first measure into one series per value. Write ONE
+  series with "encode": {"x": <x column>, "y": "@group"}; it is repeated for every group.
+- Optional: "filter": [{"column": "region", "op": "==", "value": "EU"}] (==, !=, >, >=, <, <=,
+  in, not in, between), "sort": "-y" (largest first) or "y", "limit": n.
+- Series `encode` uses the output dimensions: the x column name, then the measure names.
+- Several bound datasets: use a list of entries and `datasetIndex` on the series.
+"""
+
+
+async def finish_chart(output: str) -> str:
+    """Validates the option, then computes the data of its dataset bindings."""
+    code = await validate_output("charts", output, llm)
+    datasets = get_context().get("datasets") or []
+    if not datasets or '"bind"' not in code:
+        return code
+    try:
+        option = json.loads(code)
+    except ValueError:
+        return code
+
+    start = time.perf_counter()
+    try:
+        # Vectorised, but over up to millions of rows: off the event loop
+        option = await asyncio.to_thread(bind_option, option, datasets)
+    except DatasetError as e:
+        logger.warning(f"📊 Chart binding failed: {e}")
+        return f"Error: {e}"
+    logger.info(f"📊 Bound chart data in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return json.dumps(option, ensure_ascii=False, indent=2)
+
 @tool
+@cached_tool("charts", llm)
 async def create_chart(instruction: str):
     """
     Renders a Chart using Apache ECharts based on instructions.
@@ -48,62 +104,41 @@ async def create_chart(instruction: str):
     """
     messages = get_messages()
     context = get_context()
-    current_code = context.get("current_code", "")
+    # Computed dataset sources are left out: the model works on the bindings
+    current_code = strip_bound_data(context.get("current_code", ""))
+    system_prompt = CHARTS_SYSTEM_PROMPT + get_thinking_instructions()
+    if context.get("datasets"):
+        system_prompt += DATASET_INSTRUCTIONS.replace("<<DATASETS>>", describe(context["datasets"]))
+
+    # Edit mode: ask for a compact patch instead of re-emitting the whole diagram
+    if current_code and settings.EDIT_MODE == "patch":
+        patched = await generate_edit(llm, "json", system_prompt, messages, instruction, current_code)
+        if patched is not None:
+            return await finish_chart(patched)
     
     # Call LLM to generate the ECharts option
-    system_msg = CHARTS_SYSTEM_PROMPT + get_thinking_instructions()
+    system_msg = system_prompt
+    if context.get("direct"):
+        system_msg += enrichment_instructions(CHARTS_AGENT_PROMPT)
     if current_code:
         system_msg += f"\n\n### CURRENT CHART CODE\n```json\n{current_code}\n```\nApply changes to this code."
         
-    prompt = [SystemMessage(content=system_msg)] + messages
-    if instruction:
-        prompt.append(HumanMessage(content=f"Instruction: {instruction}"))
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent="charts", tail=tail)
     
     full_content = ""
     async for chunk in llm.astream(prompt):
         if chunk.content:
             full_content += chunk.content
     
-    option_str = full_content
-    
-    # Robust JSON Extraction: Find the substring from first '{' to last '}'
-    import re
-    # Remove any thinking tags first just in case
-    option_str = re.sub(r'<think>[\s\S]*?</think>', '', option_str, flags=re.DOTALL)
-    
-    match = re.search(r'(\{[\s\S]*\})', option_str)
-    if match:
-        option_str = match.group(1)
-    else:
-        # Fallback: simple markdown strip
-        option_str = re.sub(r'^```\w*\n?', '', option_str.strip())
-        option_str = re.sub(r'\n?```$', '', option_str.strip())
-    
-    return option_str.strip()
+    # Extract, validate and repair the output (see ARTIFACT_VALIDATION), then bind datasets
+    return await finish_chart(full_content)
 
 tools = [create_chart]
-llm_with_tools = llm.bind_tools(tools)
-
-async def charts_agent_node(state: AgentState):
-    messages = state['messages']
-    
-    # 动态从历史中提取最新的 charts 代码（寻找最后一条 tool 消息且内容包含 series/xAxis 等）
-    current_code = ""
-    for msg in reversed(messages):
-        if msg.type == "tool" and msg.content:
-            stripped = msg.content.strip()
-            if '"series":' in stripped or '"xAxis":' in stripped:
-                current_code = stripped
-                break
-
-    # Safety: Ensure no empty text content blocks reach the LLM
-    for msg in messages:
-        if hasattr(msg, 'content') and not msg.content:
-            msg.content = "Generate a chart"
+llm_with_tools = bind_tools(agent_llm, tools)
 
-    set_context(messages, current_code=current_code)
-    
-    system_prompt = SystemMessage(content="""You are a World-Class Data Analysis Consultant.
+# Orchestrator brief: expands the request into a detailed instruction for the tool
+CHARTS_AGENT_PROMPT = """You are a World-Class Data Analysis Consultant.
     YOUR MISSION is to act as a Strategic Advisor. When a user requests a chart, don't just "draw" it—ANALYZE and EXPAND it.
     
     ### ORCHESTRATION RULES:
@@ -117,10 +152,37 @@ async def charts_agent_node(state: AgentState):
     
     ### PROACTIVENESS:
     - BE DECISIVE. If you see an opportunity to add a "Goal Target" line or "YoY Growth" metrics, include it in the tool instruction.
-    """ + get_thinking_instructions())
+    """
+
+async def charts_agent_node(state: AgentState, direct: bool = False):
+    messages = state['messages']
+    
+    # 最新的 charts 产物：本轮工具结果，或会话分支上存储的最新版本（O(1) 查找）
+    current_code = current_artifact("charts", messages)
+
+    # Safety: Ensure no empty text content blocks reach the LLM
+    for msg in messages:
+        if hasattr(msg, 'content') and not msg.content:
+            msg.content = "Generate a chart"
+
+    set_context(messages, current_code=current_code, direct=direct)
+
+    # Direct mode: skip the orchestrator call and hand the request straight to the generator
+    if direct and messages[-1].type != "tool":
+        return {"messages": [direct_tool_call(create_chart, messages)]}
+    
+    system_prompt = CHARTS_AGENT_PROMPT + get_thinking_instructions()
+    datasets = get_context().get("datasets")
+    if datasets:
+        system_prompt += (
+            "\n\n### ATTACHED DATASETS\n" + describe(datasets) +
+            "\nWhen the request is about this data, tell the tool which dataset and columns to bind. "
+            "NEVER synthesize data for it."
+        )
+    system_prompt = SystemMessage(content=system_prompt)
     
     full_response = None
-    async for chunk in llm_with_tools.astream([system_prompt] + messages):
+    async for chunk in llm_with_tools.astream(assemble_context(system_prompt, messages, "agent", agent="charts")):
         if full_response is None:
             full_response = chunk
         else:
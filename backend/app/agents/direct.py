@@ -0,0 +1,36 @@
+import uuid
+from langchain_core.messages import AIMessage
+from app.agents.dispatcher import message_text
+
+
+def direct_tool_call(tool, messages) -> AIMessage:
+    """
+    Direct mode: the tool call the orchestrator would have made, without calling it. The
+    user's latest request is passed through as the instruction; the generator enriches it
+    itself (see enrichment_instructions).
+    """
+    instruction = ""
+    for msg in reversed(messages):
+        if msg.type == "human":
+            instruction = message_text(msg.content)
+            break
+    return AIMessage(
+        content="",
+        tool_calls=[{
+            "name": tool.name,
+            "args": {"instruction": instruction},
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "tool_call",
+        }],
+    )
+
+
+def enrichment_instructions(agent_prompt: str) -> str:
+    """The orchestrator's brief, merged into the generator prompt for direct mode."""
+    return (
+        "\n\n### REQUEST ENRICHMENT\n"
+        "The instruction is the user's request exactly as written. Before generating, expand it "
+        "the way this orchestrator brief describes (its rules about calling tools do not apply, "
+        "you produce the result directly):\n"
+        + agent_prompt
+    )
@@ -3,16 +3,144 @@ from langchain_core.messages import HumanMessage, SystemMessage
 from langgraph.graph import StateGraph, END
 from app.state.state import AgentState
 from app.core.config import settings
-from app.core.llm import get_llm
+from app.core.logger import logger
+from app.core.llm import get_llm, llm_priority, PRIORITY_ROUTER
+from app.core.tokens import assemble_context
+import asyncio
+import math
 import re
+import time
+from collections import Counter
 
-llm = get_llm() # Use a fast model for routing, or default to general config
+llm = get_llm(role="router") # Use a fast model for routing (LLM_MODEL_MATRIX), or default to general config
 
-def router_node(state: AgentState):
+INTENTS = ("mindmap", "flowchart", "mermaid", "charts", "drawio", "infographic", "general")
+
+# Seed phrases so the local classifier is useful before any history has been collected
+SEED_EXAMPLES = {
+    "mindmap": ["mindmap", "mind map", "brainstorm", "outline ideas", "knowledge map", "organize concepts", "topic tree", "思维导图", "脑图", "头脑风暴", "大纲", "知识图谱"],
+    "flowchart": ["flowchart", "flow chart", "process flow", "workflow", "approval process", "login process", "steps of the process", "decision flow", "流程图", "工作流", "业务流程", "审批流程"],
+    "mermaid": ["mermaid", "sequence diagram", "class diagram", "state diagram", "gantt chart", "er diagram", "entity relationship", "git graph", "user journey", "时序图", "类图", "状态图", "甘特图", "er图"],
+    "charts": ["bar chart", "line chart", "pie chart", "sales data", "statistics", "trend", "revenue by month", "plot the data", "scatter", "kpi dashboard", "柱状图", "折线图", "饼图", "销售数据", "统计", "趋势"],
+    "drawio": ["drawio", "draw.io", "architecture diagram", "system architecture", "cloud infrastructure", "network topology", "aws architecture", "microservices deployment", "架构图", "系统架构", "网络拓扑", "部署架构"],
+    "infographic": ["infographic", "data poster", "visual summary", "timeline poster", "comparison poster", "visual storytelling", "信息图", "海报", "可视化总结"],
+    "general": ["hello", "hi", "thanks", "thank you", "what can you do", "who are you", "help", "你好", "谢谢", "你是谁", "你能做什么"],
+}
+
+class IntentClassifier:
+    """
+    Local, CPU-only intent classifier: multinomial naive Bayes over word/bigram and CJK
+    character n-gram features of the prompt, plus the last active agent. Seeded with SEED_EXAMPLES and trainable from stored routing
+    decisions (`ChatMessage.agent`).
+    """
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+        self.feature_counts: dict[str, Counter] = {intent: Counter() for intent in INTENTS}
+        self.total_counts: Counter = Counter()
+        self.doc_counts: Counter = Counter()
+        self.vocabulary: set[str] = set()
+        for intent, phrases in SEED_EXAMPLES.items():
+            for phrase in phrases:
+                self.add(phrase, intent)
+
+    @staticmethod
+    def features(text: str, last_active_agent: str = "None") -> list[str]:
+        text = text.lower()
+        words = re.findall(r"[a-z0-9][a-z0-9.\-]*", text)
+        feats = [f"w:{w}" for w in words]
+        feats += [f"b:{a}_{b}" for a, b in zip(words, words[1:])]
+        for run in re.findall(r"[\u4e00-\u9fff]+", text):
+            feats += [f"c:{ch}" for ch in run]
+            feats += [f"c:{run[i:i + 2]}" for i in range(len(run) - 1)]
+        if last_active_agent and last_active_agent != "None":
+            feats.append(f"last:{last_active_agent}")
+        return feats
+
+    def add(self, text: str, intent: str, last_active_agent: str = "None"):
+        if intent not in self.feature_counts:
+            return
+        feats = self.features(text, last_active_agent)
+        self.feature_counts[intent].update(feats)
+        self.total_counts[intent] += len(feats)
+        self.doc_counts[intent] += 1
+        self.vocabulary.update(feats)
+
+    def fit(self, samples):
+        """samples: iterable of (prompt, last_active_agent, intent)."""
+        for text, last_active_agent, intent in samples:
+            self.add(text, intent, last_active_agent or "None")
+        return self
+
+    def predict(self, text: str, last_active_agent: str = "None") -> tuple[str, float]:
+        """Returns (intent, confidence), confidence being the posterior of the best intent."""
+        feats = [f for f in self.features(text, last_active_agent) if f in self.vocabulary]
+        total_docs = sum(self.doc_counts.values())
+        vocab_size = len(self.vocabulary) or 1
+
+        scores = {}
+        for intent in INTENTS:
+            log_prob = math.log((self.doc_counts[intent] + 1) / (total_docs + len(INTENTS)))
+            denominator = self.total_counts[intent] + self.alpha * vocab_size
+            for f in feats:
+                log_prob += math.log((self.feature_counts[intent][f] + self.alpha) / denominator)
+            scores[intent] = log_prob
+
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(v - scores[best]) for v in scores.values())
+        return best, 1.0 / norm
+
+intent_classifier = IntentClassifier()
+
+# Explicit @agent mentions
+EXPLICIT_MAPPINGS = {
+    "@mindmap": "mindmap",
+    "@flow": "flowchart",
+    "@flowchart": "flowchart",
+    "@mermaid": "mermaid",
+    "@chart": "charts",
+    "@charts": "charts",
+    "@drawio": "drawio",
+    "@infographic": "infographic"
+}
+
+def has_explicit_mention(message) -> bool:
+    return isinstance(message, HumanMessage) and isinstance(message.content, str) and any(
+        keyword in message.content.lower() for keyword in EXPLICIT_MAPPINGS
+    )
+
+def find_last_active_agent(messages) -> str:
+    """Agent of the most recent assistant turn, read from its execution trace ("None" if absent)."""
+    for msg in reversed(messages[:-1]):
+        if msg.type == "ai" and "agentName:" in str(msg.content):
+            match = re.search(r"agentName:\s*(\w+)", str(msg.content))
+            if match:
+                return match.group(1)
+    return "None"
+
+def message_text(content) -> str:
+    """Text part of a (possibly multimodal) message content."""
+    if isinstance(content, list):
+        return " ".join(item.get("text", "") for item in content if isinstance(item, dict) and item.get("type") == "text")
+    return str(content)
+
+def fallback_intent(last_active_agent: str) -> str:
+    """Deterministic routing used when the router model is too slow or fails."""
+    return last_active_agent if last_active_agent in INTENTS else "general"
+
+async def router_node(state: AgentState):
     """
     Analyzes the user's input and determines the appropriate agent.
     Supports explicit routing via @agent syntax.
+    The LLM call is bounded by ROUTER_TIMEOUT_S; past that budget the last active agent
+    (or general) is used instead.
     """
+    start_time = time.perf_counter()
+
+    def routed(intent: str, source: str):
+        routing_ms = round((time.perf_counter() - start_time) * 1000, 1)
+        return {"intent": intent, "routing_ms": routing_ms, "routing_source": source}
+
     messages = state['messages']
     last_message = messages[-1]
     
@@ -21,19 +149,7 @@ def router_node(state: AgentState):
     if isinstance(last_message, HumanMessage) and isinstance(last_message.content, str):
         content = last_message.content.lower().strip()
         
-        # Explicit mapping
-        mappings = {
-            "@mindmap": "mindmap",
-            "@flow": "flowchart",
-            "@flowchart": "flowchart",
-            "@mermaid": "mermaid",
-            "@chart": "charts",
-            "@charts": "charts",
-            "@drawio": "drawio",
-            "@infographic": "infographic"
-        }
-        
-        for keyword, intent_name in mappings.items():
+        for keyword, intent_name in EXPLICIT_MAPPINGS.items():
             if keyword in content:
                 explicit_intent = intent_name
                 # Clean the keyword from the message so the agent doesn't see it
@@ -42,7 +158,7 @@ def router_node(state: AgentState):
                 if not cleaned:
                     cleaned = f"Generate a default {intent_name} diagram."
                 last_message.content = cleaned
-                print(f"DEBUG ROUTER | Explicit Routing Triggered: {keyword} -> {intent_name} | Cleaned: {last_message.content}")
+                logger.debug(f"🧭 Router | Explicit Routing Triggered: {keyword} -> {intent_name} | Cleaned: {last_message.content}")
                 break
 
     agent_descriptions = {
@@ -71,19 +187,20 @@ def router_node(state: AgentState):
     execution_history_text = "\n---\n".join(execution_history) if execution_history else "None"
     
     # Identify Last Active Agent
-    last_active_agent = "None"
-    for msg in reversed(messages[:-1]):
-        if msg.type == "ai" and "agentName:" in str(msg.content):
-            match = re.search(r"agentName:\s*(\w+)", str(msg.content))
-            if match:
-                last_active_agent = match.group(1)
-                break
+    last_active_agent = find_last_active_agent(messages)
     
     # If we have an explicit intent, we can skip the LLM call but we STILL want to return 
     # the intent inside the unified flow for consistency.
     if explicit_intent:
-        print(f"DEBUG ROUTER | Proceeding with Explicit Intent: {explicit_intent}")
-        return {"intent": explicit_intent}
+        logger.debug(f"🧭 Router | Proceeding with Explicit Intent: {explicit_intent}")
+        return routed(explicit_intent, "explicit")
+
+    # Local classifier: only consult the router model when it isn't confident enough
+    if settings.ROUTER_CLASSIFIER_THRESHOLD > 0:
+        intent, confidence = intent_classifier.predict(message_text(last_message.content), last_active_agent)
+        logger.debug(f"🧭 Router | Classifier: {intent} ({confidence:.2f})")
+        if confidence >= settings.ROUTER_CLASSIFIER_THRESHOLD:
+            return routed(intent, "classifier")
 
     descriptions_text = "\n".join([f"- '{key}': {desc}" for key, desc in agent_descriptions.items()])
 
@@ -130,9 +247,13 @@ def router_node(state: AgentState):
             return text[:1000] + "... [TRUNCATED]"
         return text
 
-    # Summarize history except for the very last message
+    # Summarize history except for the very last message (most recent turns within the router budget)
     conversation_text = ""
-    for msg in messages[:-1]:
+    for msg in assemble_context(None, messages, "router")[:-1]:
+        if msg.type == "system":
+            # Running summary of the compacted turns
+            conversation_text += f"{msg.content}\n"
+            continue
         role = "User" if msg.type == "human" else "Assistant"
         content_summary = summarize_history_content(msg.content)
         conversation_text += f"{role}: {content_summary}\n"
@@ -154,27 +275,39 @@ def router_node(state: AgentState):
         messages[-1] # The real last message with multimodal content
     ]
     
-    response = llm.invoke(msgs_to_invoke)
+    try:
+        # Router calls are admitted ahead of generations when the upstream is busy
+        with llm_priority(PRIORITY_ROUTER):
+            response = await asyncio.wait_for(llm.ainvoke(msgs_to_invoke), timeout=settings.ROUTER_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        intent = fallback_intent(last_active_agent)
+        logger.debug(f"🧭 Router | Budget of {settings.ROUTER_TIMEOUT_S}s exceeded, falling back to {intent}")
+        return routed(intent, "fallback")
+    except Exception as e:
+        intent = fallback_intent(last_active_agent)
+        logger.debug(f"🧭 Router | Router call failed ({e}), falling back to {intent}")
+        return routed(intent, "fallback")
+
     intent = response.content.strip().lower()
     
-    print(f"DEBUG ROUTER | Last Agent: {last_active_agent} | Raw Intent: {intent}")
+    logger.debug(f"🧭 Router | Last Agent: {last_active_agent} | Raw Intent: {intent}")
 
     if "mindmap" in intent:
-        return {"intent": "mindmap"}
+        return routed("mindmap", "llm")
     elif "flow" in intent:
-        return {"intent": "flowchart"}
+        return routed("flowchart", "llm")
     elif "mermaid" in intent:
-        return {"intent": "mermaid"}
+        return routed("mermaid", "llm")
     elif "chart" in intent:
-        return {"intent": "charts"}
+        return routed("charts", "llm")
     elif "drawio" in intent or "draw.io" in intent or "architecture" in intent or "network" in intent:
-        return {"intent": "drawio"} 
+        return routed("drawio", "llm")
     elif "infographic" in intent or "信息图" in intent or "poster" in intent:
-        return {"intent": "infographic"}
+        return routed("infographic", "llm")
     elif "general" in intent:
-        return {"intent": "general"}
+        return routed("general", "llm")
     else:
-        return {"intent": "general"} # Default to general for safety
+        return routed("general", "llm") # Default to general for safety
 
 def route_decision(state: AgentState) -> Literal["mindmap_agent", "flow_agent", "mermaid_agent", "charts_agent", "drawio_agent", "infographic_agent", "general_agent"]:
     intent = state.get("intent")
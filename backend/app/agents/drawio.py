@@ -1,11 +1,22 @@
+import json
+import time
+import xml.etree.ElementTree as ET
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
 from app.core.config import settings
-from app.core.llm import get_llm, get_thinking_instructions
+from app.core.logger import logger
+from app.core.llm import get_llm, bind_tools, get_thinking_instructions, llm_priority, PRIORITY_BULK
 from app.state.state import AgentState
-from app.core.context import get_messages
+from app.core.context import set_context, get_messages, get_context, current_artifact
+from app.core.patching import generate_edit
+from app.core.cache import cached_tool
+from app.core.validation import validate_output, repair_drawio_ir
+from app.core.tokens import assemble_context, count_text_tokens
+from app.agents.direct import direct_tool_call, enrichment_instructions
+from app.agents.flow import sugiyama_layout
 
-llm = get_llm()
+llm = get_llm(role="tool", agent="drawio")
+agent_llm = get_llm(role="agent", agent="drawio")
 
 DRAWIO_SYSTEM_PROMPT = """You are a World-Class System Architect and Draw.io (mxGraph) Expert. Your goal is to generate professional, high-fidelity, and uncompressed Draw.io XML strings.
 
@@ -34,7 +45,340 @@ DRAWIO_SYSTEM_PROMPT = """You are a World-Class System Architect and Draw.io (mx
 RETURN ONLY THE RAW XML STRING. No markdown, no explanations.
 """
 
+# --- Compact IR (DRAWIO_MODE=ir) --------------------------------------------------------
+# The model describes the architecture with named styles; the server lays it out and
+# expands it into mxGraph XML, which is several times more tokens than the IR.
+
+# name -> (style, width, height)
+NODE_STYLES = {
+    "service": ("rounded=1;whiteSpace=wrap;html=1;fillColor=#dae8fc;strokeColor=#6c8ebf;", 140, 60),
+    "client": ("rounded=1;whiteSpace=wrap;html=1;fillColor=#f5f5f5;strokeColor=#666666;fontColor=#333333;", 140, 60),
+    "user": ("shape=umlActor;verticalLabelPosition=bottom;verticalAlign=top;html=1;outlineConnect=0;", 40, 70),
+    "gateway": ("shape=hexagon;perimeter=hexagonPerimeter2;whiteSpace=wrap;html=1;fixedSize=1;fillColor=#d5e8d4;strokeColor=#82b366;", 150, 70),
+    "loadbalancer": ("ellipse;whiteSpace=wrap;html=1;fillColor=#d5e8d4;strokeColor=#82b366;", 140, 70),
+    "function": ("shape=parallelogram;perimeter=parallelogramPerimeter;whiteSpace=wrap;html=1;fixedSize=1;fillColor=#ffe6cc;strokeColor=#d79b00;", 150, 60),
+    "database": ("shape=cylinder3;whiteSpace=wrap;html=1;boundedLbl=1;backgroundOutline=1;size=15;fillColor=#fff2cc;strokeColor=#d6b656;", 110, 80),
+    "cache": ("shape=cylinder3;whiteSpace=wrap;html=1;boundedLbl=1;backgroundOutline=1;size=15;fillColor=#f8cecc;strokeColor=#b85450;", 110, 80),
+    "storage": ("shape=datastore;whiteSpace=wrap;html=1;fillColor=#fff2cc;strokeColor=#d6b656;", 110, 80),
+    "queue": ("shape=process;whiteSpace=wrap;html=1;backgroundOutline=1;fillColor=#e1d5e7;strokeColor=#9673a6;", 150, 60),
+    "external": ("rounded=1;dashed=1;whiteSpace=wrap;html=1;fillColor=#f5f5f5;strokeColor=#666666;", 140, 60),
+    "cloud": ("ellipse;shape=cloud;whiteSpace=wrap;html=1;fillColor=#dae8fc;strokeColor=#6c8ebf;", 150, 90),
+    "security": ("rounded=0;whiteSpace=wrap;html=1;fillColor=#f8cecc;strokeColor=#b85450;strokeWidth=2;", 140, 60),
+    "decision": ("rhombus;whiteSpace=wrap;html=1;fillColor=#fff2cc;strokeColor=#d6b656;", 120, 80),
+    "note": ("shape=note;whiteSpace=wrap;html=1;backgroundOutline=1;size=14;fillColor=#fff2cc;strokeColor=#d6b656;", 160, 70),
+}
+_CONTAINER = "whiteSpace=wrap;html=1;container=1;collapsible=0;verticalAlign=top;align=left;spacingLeft=10;fontStyle=1;"
+GROUP_STYLES = {
+    "group": ("rounded=1;dashed=1;fillColor=none;strokeColor=#666666;" + _CONTAINER, 0, 0),
+    "vpc": ("rounded=0;fillColor=none;strokeColor=#82b366;strokeWidth=2;" + _CONTAINER, 0, 0),
+    "subnet": ("rounded=0;fillColor=#f5f5f5;strokeColor=#6c8ebf;dashed=1;" + _CONTAINER, 0, 0),
+    "region": ("rounded=1;fillColor=none;strokeColor=#6c8ebf;dashed=1;dashPattern=8 4;" + _CONTAINER, 0, 0),
+    "cluster": ("rounded=1;fillColor=#fafafa;strokeColor=#9673a6;" + _CONTAINER, 0, 0),
+    "boundary": ("rounded=0;fillColor=none;strokeColor=#b85450;dashed=1;strokeWidth=2;" + _CONTAINER, 0, 0),
+}
+_EDGE = "edgeStyle=orthogonalEdgeStyle;rounded=1;orthogonalLoop=1;jettySize=auto;html=1;"
+EDGE_STYLES = {
+    "default": (_EDGE + "endArrow=classic;", 0, 0),
+    "dashed": (_EDGE + "dashed=1;endArrow=classic;", 0, 0),
+    "async": (_EDGE + "dashed=1;endArrow=open;strokeColor=#9673a6;", 0, 0),
+    "bidirectional": (_EDGE + "startArrow=classic;endArrow=classic;", 0, 0),
+    "data": (_EDGE + "endArrow=classic;strokeColor=#82b366;strokeWidth=2;", 0, 0),
+}
+
+# Spacing between items in a row, between rows, inside containers (sides, title bar), page margin
+IR_ITEM_GAP = 60
+IR_ROW_GAP = 90
+IR_GROUP_PADDING = 30
+IR_GROUP_HEADER = 40
+IR_PAGE_MARGIN = 40
+IR_MIN_GROUP = (200, 120)
+
+DRAWIO_IR_PROMPT = """You are a World-Class System Architect and Draw.io Expert. Your goal is to design professional, high-fidelity architecture diagrams.
+
+### PERSONA & PRINCIPLES
+- **Architectural Depth**: Don't just draw blocks. Design systems. If asked for a "web app", include Load Balancers, Web Servers, API Gateways, Microservices, Caches, and Databases.
+- **Logical Grouping**: Use groups (nested if needed) for boundaries such as VPCs, subnets, regions and clusters.
+- **MANDATORY ENRICHMENT**: Expand simple prompts into full-scale architectures. If user says "Redshift", include S3 buckets, IAM roles, and VPC endpoints.
+- **LANGUAGE**: Match user's input language for all labels.
+
+### OUTPUT FORMAT (COMPACT JSON, NOT XML)
+Describe WHAT is in the diagram; the server computes the layout, sizes and draw.io XML.
+{"direction": "TB", "groups": [{"id": "vpc", "label": "VPC", "style": "vpc"}, {"id": "priv", "label": "Private Subnet", "style": "subnet", "parent": "vpc"}],
+ "nodes": [{"id": "lb", "label": "Load Balancer", "style": "loadbalancer", "group": "vpc"}, {"id": "db", "label": "PostgreSQL", "style": "database", "group": "priv"}],
+ "edges": [{"from": "lb", "to": "db", "label": "SQL", "style": "default"}]}
+- `direction`: "TB" (layers top to bottom) or "LR" (streams left to right).
+- Node styles: <<NODE_STYLES>>.
+- Group styles: <<GROUP_STYLES>>.
+- Edge styles: <<EDGE_STYLES>>.
+- `group` / `parent` are optional; edges may connect nodes in different groups. Use short ids.
+- No coordinates, no sizes, no raw draw.io styles.
+
+RETURN ONLY THE JSON. No markdown, no explanations.
+""".replace("<<NODE_STYLES>>", ", ".join(NODE_STYLES)).replace(
+    "<<GROUP_STYLES>>", ", ".join(GROUP_STYLES)).replace("<<EDGE_STYLES>>", ", ".join(EDGE_STYLES))
+
+# Tokens of the IR vs the XML it compiled to, over every compiled diagram
+IR_TOKEN_STATS = {"diagrams": 0, "ir_tokens": 0, "xml_tokens": 0}
+
+
+def _ir_style(table: dict, name, default: str) -> tuple[str, int, int]:
+    """Named style; a raw draw.io style string ("key=value;...") is passed through."""
+    name = str(name or default)
+    if "=" in name:
+        return name, *table[default][1:]
+    return table.get(name.lower().replace(" ", "").replace("_", ""), table[default])
+
+
+def _ir_label(value) -> str:
+    return str(value or "").replace("\n", "<br>")
+
+
+def ir_parents(ir: dict) -> dict[str, str | None]:
+    """
+    Container of every group and node. Links to unknown groups and links that close a
+    nesting cycle (a -> b -> a) are dropped, so the containers always form a tree.
+    """
+    groups = {g["id"] for g in ir.get("groups", [])}
+    parent_of = {g["id"]: g.get("parent") for g in ir.get("groups", [])}
+    parent_of.update({n["id"]: n.get("group") for n in ir["nodes"]})
+    for item_id, parent in parent_of.items():
+        if parent not in groups:
+            parent_of[item_id] = None
+    for group in groups:
+        seen, item = {group}, group
+        while parent_of.get(item) is not None:
+            if parent_of[item] in seen:
+                parent_of[item] = None
+                break
+            item = parent_of[item]
+            seen.add(item)
+    return parent_of
+
+
+def layout_drawio_ir(ir: dict) -> tuple[dict[str, tuple[float, float]], dict[str, tuple[float, float]]]:
+    """
+    Containers are laid out bottom-up: the direct children of each group (nodes and nested
+    groups, with edges projected onto them) get a layered order from sugiyama_layout, rows
+    are packed with their real sizes and the group is sized around them. Returns
+    (position relative to the parent, size) by id.
+    """
+    groups = {g["id"]: g for g in ir.get("groups", [])}
+    parent_of = ir_parents(ir)
+    children: dict[str | None, list[str]] = {}
+    for item_id, parent in parent_of.items():
+        children.setdefault(parent, []).append(item_id)
+    edges = [(str(e["from"]), str(e["to"])) for e in ir.get("edges", [])]
+    horizontal = str(ir.get("direction", "TB")).upper() == "LR"
+
+    size = {n["id"]: _ir_style(NODE_STYLES, n.get("style"), "service")[1:] for n in ir["nodes"]}
+    position: dict[str, tuple[float, float]] = {}
+
+    def lift(item: str, container: str | None) -> str | None:
+        """The direct child of `container` that contains `item`, if any."""
+        seen = set()
+        while item in parent_of and item not in seen:
+            if parent_of[item] == container:
+                return item
+            seen.add(item)
+            item = parent_of[item]
+        return None
+
+    placed = set()
+
+    def place(container: str | None, origin: tuple[float, float]) -> tuple[float, float]:
+        placed.add(container)
+        items = children.get(container, [])
+        for item in items:
+            if item in groups and item not in placed:
+                place(item, (IR_GROUP_PADDING, IR_GROUP_HEADER))
+        projected = {(lift(a, container), lift(b, container)) for a, b in edges}
+        grid = sugiyama_layout(items, [(a, b) for a, b in projected if a and b and a != b])
+
+        layers: dict[int, list[str]] = {}
+        for item in items:
+            layers.setdefault(grid[item]["y"], []).append(item)
+        rows = [sorted(layers[y], key=lambda i: grid[i]["x"]) for y in sorted(layers)]
+
+        # Rows run across the flow direction: `along` is the extent inside a row
+        along = lambda i: size[i][1] if horizontal else size[i][0]
+        across = lambda i: size[i][0] if horizontal else size[i][1]
+        lengths = [sum(along(i) for i in row) + IR_ITEM_GAP * (len(row) - 1) for row in rows]
+        length = max(lengths, default=0)
+        offset = 0
+        for row, row_length in zip(rows, lengths):
+            thickness = max(across(i) for i in row)
+            cursor = (length - row_length) / 2
+            for item in row:
+                a, b = cursor, offset + (thickness - across(item)) / 2
+                x, y = (b, a) if horizontal else (a, b)
+                position[item] = (round(origin[0] + x), round(origin[1] + y))
+                cursor += along(item) + IR_ITEM_GAP
+            offset += thickness + IR_ROW_GAP
+        depth = max(0, offset - IR_ROW_GAP)
+        width, height = (depth, length) if horizontal else (length, depth)
+
+        if container is not None:
+            size[container] = (
+                max(IR_MIN_GROUP[0], round(width + 2 * IR_GROUP_PADDING)),
+                max(IR_MIN_GROUP[1], round(height + IR_GROUP_HEADER + IR_GROUP_PADDING)),
+            )
+        return width, height
+
+    place(None, (IR_PAGE_MARGIN, IR_PAGE_MARGIN))
+    return position, size
+
+
+def compile_drawio_ir(ir: dict) -> ET.Element:
+    """Expands the IR into an <mxfile> document (containers before their children)."""
+    position, size = layout_drawio_ir(ir)
+    groups = {g["id"]: g for g in ir.get("groups", [])}
+    nodes = {n["id"]: n for n in ir["nodes"]}
+    parent_of = ir_parents(ir)
+
+    used = {"0", "1"}
+    cell_ids = {}
+    for item_id in list(groups) + list(nodes):
+        cell_id = item_id
+        while cell_id in used:
+            cell_id = f"ir-{cell_id}"
+        cell_ids[item_id] = cell_id
+        used.add(cell_id)
+
+    document = ET.Element("mxfile", {"host": "DeepDiagram"})
+    diagram = ET.SubElement(document, "diagram", {"id": "diagram", "name": str(ir.get("title") or "Page-1")})
+    model = ET.SubElement(diagram, "mxGraphModel", {
+        "grid": "1", "gridSize": "10", "guides": "1", "tooltips": "1", "connect": "1", "arrows": "1",
+        "fold": "1", "page": "1", "pageScale": "1", "pageWidth": "1169", "pageHeight": "827",
+    })
+    root = ET.SubElement(model, "root")
+    ET.SubElement(root, "mxCell", {"id": "0"})
+    ET.SubElement(root, "mxCell", {"id": "1", "parent": "0"})
+
+    def emit(item_id: str, parent: str):
+        item, table, default = (groups[item_id], GROUP_STYLES, "group") if item_id in groups else (nodes[item_id], NODE_STYLES, "service")
+        cell = ET.SubElement(root, "mxCell", {
+            "id": cell_ids[item_id], "value": _ir_label(item.get("label")),
+            "style": _ir_style(table, item.get("style"), default)[0], "vertex": "1", "parent": parent,
+        })
+        x, y = position[item_id]
+        width, height = size[item_id]
+        ET.SubElement(cell, "mxGeometry", {"x": str(x), "y": str(y), "width": str(width), "height": str(height), "as": "geometry"})
+        if item_id in groups:
+            for child in [g for g in groups if parent_of[g] == item_id] + [n for n in nodes if parent_of[n] == item_id]:
+                emit(child, cell_ids[item_id])
+
+    for item_id in [g for g in groups if parent_of[g] is None] + [n for n in nodes if parent_of[n] is None]:
+        emit(item_id, "1")
+
+    for index, edge in enumerate(ir.get("edges", [])):
+        source, target = cell_ids.get(str(edge.get("from"))), cell_ids.get(str(edge.get("to")))
+        if not source or not target:
+            continue
+        cell_id = f"e{index + 1}"
+        while cell_id in used:
+            cell_id = f"ir-{cell_id}"
+        used.add(cell_id)
+        cell = ET.SubElement(root, "mxCell", {
+            "id": cell_id, "value": _ir_label(edge.get("label")),
+            "style": _ir_style(EDGE_STYLES, edge.get("style"), "default")[0],
+            "edge": "1", "parent": "1", "source": source, "target": target,
+        })
+        ET.SubElement(cell, "mxGeometry", {"relative": "1", "as": "geometry"})
+    return document
+
+
+def _ir_style_name(table: dict, style: str) -> str:
+    """Inverse of _ir_style: the name a compiled style came from, else the raw style."""
+    return next((name for name, (value, _, _) in table.items() if value == style), style)
+
+
+def extract_ir(xml: str) -> str | None:
+    """
+    The IR of a diagram compiled from one (host="DeepDiagram"), read back from its cells for
+    edits. Layout-only details are not part of the IR; the direction is inferred from the
+    edges between siblings.
+    """
+    try:
+        document = ET.fromstring(xml)
+    except ET.ParseError:
+        return None
+    if document.tag != "mxfile" or document.get("host") != "DeepDiagram":
+        return None
+    diagram = document.find("diagram")
+    cells = document.findall(".//root/mxCell")
+    group_styles = {value for value, _, _ in GROUP_STYLES.values()}
+    groups, nodes, edges, placement = [], [], [], {}
+    for cell in cells:
+        style, parent = cell.get("style", ""), cell.get("parent")
+        label = cell.get("value", "").replace("<br>", "\n")
+        if cell.get("edge") == "1":
+            edge = {"from": cell.get("source"), "to": cell.get("target"), "style": _ir_style_name(EDGE_STYLES, style)}
+            if label:
+                edge["label"] = label
+            edges.append(edge)
+        elif cell.get("vertex") == "1":
+            geometry = cell.find("mxGeometry")
+            try:
+                placement[cell.get("id")] = (parent, float(geometry.get("x", 0)), float(geometry.get("y", 0)))
+            except (AttributeError, ValueError):
+                pass
+            if style in group_styles:
+                group = {"id": cell.get("id"), "label": label, "style": _ir_style_name(GROUP_STYLES, style)}
+                if parent != "1":
+                    group["parent"] = parent
+                groups.append(group)
+            else:
+                node = {"id": cell.get("id"), "label": label, "style": _ir_style_name(NODE_STYLES, style)}
+                if parent != "1":
+                    node["group"] = parent
+                nodes.append(node)
+    if not nodes:
+        return None
+
+    # Layers run along the flow: edges between siblings mostly go down (TB) or right (LR)
+    down = across = 0.0
+    for edge in edges:
+        a, b = placement.get(edge["from"]), placement.get(edge["to"])
+        if a and b and a[0] == b[0]:
+            across += abs(b[1] - a[1])
+            down += abs(b[2] - a[2])
+    ir = {"direction": "LR" if across > down else "TB"}
+    if diagram is not None and diagram.get("name") not in (None, "Page-1"):
+        ir["title"] = diagram.get("name")
+    ir.update({"groups": groups, "nodes": nodes, "edges": edges})
+    return json.dumps(ir, ensure_ascii=False, indent=2)
+
+
+async def finish_drawio(output: str) -> str:
+    """Validates the model's IR and compiles it to draw.io XML, logging the tokens saved."""
+    ir_text = await validate_output("drawio_ir", output, llm)
+    start = time.perf_counter()
+    try:
+        # Also with ARTIFACT_VALIDATION=off: the compiler needs the bare, well-formed IR
+        ir_text, _ = repair_drawio_ir(ir_text)
+        ir = json.loads(ir_text)
+        document = compile_drawio_ir(ir)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"🧱 Could not compile draw.io IR: {e}")
+        return "Error: The generated diagram description is invalid."
+    xml = ET.tostring(document, encoding="unicode")
+
+    ir_tokens, xml_tokens = count_text_tokens(ir_text), count_text_tokens(xml)
+    IR_TOKEN_STATS["diagrams"] += 1
+    IR_TOKEN_STATS["ir_tokens"] += ir_tokens
+    IR_TOKEN_STATS["xml_tokens"] += xml_tokens
+    total_saved = IR_TOKEN_STATS["xml_tokens"] - IR_TOKEN_STATS["ir_tokens"]
+    logger.info(
+        f"🧱 Compiled draw.io IR ({len(ir['nodes'])} nodes, {len(ir.get('edges', []))} edges) in "
+        f"{(time.perf_counter() - start) * 1000:.1f}ms: {ir_tokens} tokens instead of {xml_tokens} "
+        f"({(1 - ir_tokens / max(xml_tokens, 1)) * 100:.0f}% saved; {total_saved} tokens over "
+        f"{IR_TOKEN_STATS['diagrams']} diagrams)"
+    )
+    # The IR is not kept with the diagram: edits read it back from the cells (extract_ir)
+    return xml
+
 @tool
+@cached_tool("drawio", llm)
 async def render_drawio_xml(instruction: str):
     """
     Renders a Draw.io XML diagram based on instructions.
@@ -42,53 +386,65 @@ async def render_drawio_xml(instruction: str):
         instruction: Detailed instruction on what diagram to create or modify.
     """
     messages = get_messages()
+    context = get_context()
+    current_code = context.get("current_code", "")
+
+    ir_mode = settings.DRAWIO_MODE == "ir"
+    current_ir = extract_ir(current_code) if ir_mode and current_code else None
+    system_prompt = (DRAWIO_IR_PROMPT if ir_mode else DRAWIO_SYSTEM_PROMPT) + get_thinking_instructions()
+
+    # Edit mode: a JSON Patch against the IR, or cell-level operations on diagrams without one
+    if current_code and settings.EDIT_MODE == "patch":
+        if current_ir:
+            patched = await generate_edit(llm, "json", system_prompt, messages, instruction, current_ir)
+            if patched is not None:
+                return await finish_drawio(patched)
+        else:
+            patched = await generate_edit(llm, "cells", DRAWIO_SYSTEM_PROMPT + get_thinking_instructions(), messages, instruction, current_code)
+            if patched is not None:
+                return await validate_output("drawio", patched, llm)
     
-    # Call LLM to generate the Draw.io XML
-    system_msg = DRAWIO_SYSTEM_PROMPT + get_thinking_instructions()
+    # Call LLM to generate the diagram (IR or raw Draw.io XML, see DRAWIO_MODE)
+    system_msg = system_prompt
+    if context.get("direct"):
+        system_msg += enrichment_instructions(drawio_agent_prompt())
+    if current_ir:
+        system_msg += f"\n\n### CURRENT DIAGRAM (IR)\n```json\n{current_ir}\n```\nApply changes to this diagram."
+    elif current_code:
+        system_msg += f"\n\n### CURRENT DIAGRAM CODE (XML)\n```xml\n{current_code}\n```\nApply changes to this code."
+        if ir_mode:
+            system_msg += " Re-express the result in the JSON format above."
 
-    prompt = [SystemMessage(content=system_msg)] + messages
-    if instruction:
-        prompt.append(HumanMessage(content=f"Instruction: {instruction}"))
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent="drawio", tail=tail)
     
     full_content = ""
-    async for chunk in llm.astream(prompt):
-        if chunk.content:
-            full_content += chunk.content
-    
-    xml_content = full_content
+    # Full generations are the longest calls: they queue behind everything else
+    with llm_priority(PRIORITY_BULK):
+        async for chunk in llm.astream(prompt):
+            if chunk.content:
+                full_content += chunk.content
     
-    if not xml_content:
+    if not full_content:
         return "Error: No XML content generated."
-    
-    # Robustly strip markdown code blocks
-    import re
-    # Remove any thinking tags first
-    xml_content = re.sub(r'<think>[\s\S]*?</think>', '', xml_content, flags=re.DOTALL)
 
-    xml_content = re.sub(r'^```[a-zA-Z]*\n', '', xml_content)
-    xml_content = re.sub(r'\n```$', '', xml_content)
-    
-    return xml_content.strip()
+    if ir_mode:
+        return await finish_drawio(full_content)
 
-tools = [render_drawio_xml]
+    # Extract, validate and repair the XML (see ARTIFACT_VALIDATION)
+    return await validate_output("drawio", full_content, llm)
 
-async def drawio_agent_node(state: AgentState):
-    messages = state['messages']
-    
-    # Safety: Ensure no empty text content blocks reach the LLM
-    for msg in messages:
-        if hasattr(msg, 'content') and not msg.content:
-            msg.content = "Generate a diagram"
+tools = [render_drawio_xml]
+llm_with_tools = bind_tools(agent_llm, tools)
 
-    llm_with_tools = llm.bind_tools(tools)
-    
-    system_prompt = SystemMessage(content="""You are a Visionary Principal System Architect.
+# Orchestrator brief: expands the request into a detailed instruction for the tool
+DRAWIO_AGENT_PROMPT = """You are a Visionary Principal System Architect.
     YOUR MISSION is to act as a Chief Technical Lead. When a user asks for a diagram, don't just "draw" components—SOLVE for scalability, security, and flow.
     
     ### ORCHESTRATION RULES:
     1. **ARCHITECTURAL EXPANSION**: If the user says "draw a login flow", expand it to "draw a high-fidelity system architecture for an authentication service, including Frontend, API Gateway, Auth Microservice, Session Cache (Redis), and User Database, with proper connectors and professional styling".
     2. **MANDATORY TOOL CALL**: Always use `render_drawio_xml`.
-    3. **HI-FI SPECIFICATIONS**: Instruct the tool to include specific XML properties and shapes that represent professional architecture (e.g., cloud provider icons, database cylinders, cloud boundaries).
+    3. **HI-FI SPECIFICATIONS**: <<SPECIFICATIONS>>
     4. **METAPHORICAL THINKING**: Use layouts that represent the flow (e.g., Top-to-Bottom for layers, Left-to-Right for streams).
     
     ### LANGUAGE CONSISTENCY:
@@ -96,10 +452,40 @@ async def drawio_agent_node(state: AgentState):
     
     ### PROACTIVENESS:
     - BE DECISIVE. If you see an opportunity to add a "CDN" or "Security Layer", include it in the architect's instructions.
-    """ + get_thinking_instructions())
+    """
+
+# Rule 3 per DRAWIO_MODE: the IR has named styles only, so no XML properties are asked for
+DRAWIO_SPECIFICATIONS = {
+    "ir": "Instruct the tool which component kinds (e.g., gateway, database, cache, queue), groups (e.g., VPC, subnet, region) and connection kinds (e.g., async, data flow) represent professional architecture.",
+    "xml": "Instruct the tool to include specific XML properties and shapes that represent professional architecture (e.g., cloud provider icons, database cylinders, cloud boundaries).",
+}
+
+
+def drawio_agent_prompt() -> str:
+    specifications = DRAWIO_SPECIFICATIONS["ir" if settings.DRAWIO_MODE == "ir" else "xml"]
+    return DRAWIO_AGENT_PROMPT.replace("<<SPECIFICATIONS>>", specifications)
+
+async def drawio_agent_node(state: AgentState, direct: bool = False):
+    messages = state['messages']
+    
+    # 最新的 drawio 产物：本轮工具结果，或会话分支上存储的最新版本（O(1) 查找）
+    current_code = current_artifact("drawio", messages)
+
+    # Safety: Ensure no empty text content blocks reach the LLM
+    for msg in messages:
+        if hasattr(msg, 'content') and not msg.content:
+            msg.content = "Generate a diagram"
+
+    set_context(messages, current_code=current_code, direct=direct)
+
+    # Direct mode: skip the orchestrator call and hand the request straight to the generator
+    if direct and messages[-1].type != "tool":
+        return {"messages": [direct_tool_call(render_drawio_xml, messages)]}
+
+    system_prompt = SystemMessage(content=drawio_agent_prompt() + get_thinking_instructions())
     
     full_response = None
-    async for chunk in llm_with_tools.astream([system_prompt] + messages):
+    async for chunk in llm_with_tools.astream(assemble_context(system_prompt, messages, "agent", agent="drawio")):
         if full_response is None:
             full_response = chunk
         else:
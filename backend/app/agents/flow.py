@@ -1,11 +1,20 @@
+import json
+import time
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
 from app.state.state import AgentState
 from app.core.config import settings
-from app.core.llm import get_llm, get_thinking_instructions
-from app.core.context import set_context, get_messages, get_context
+from app.core.logger import logger
+from app.core.llm import get_llm, bind_tools, get_thinking_instructions
+from app.core.context import set_context, get_messages, get_context, current_artifact
+from app.core.patching import generate_edit
+from app.core.cache import cached_tool
+from app.core.validation import validate_output
+from app.core.tokens import assemble_context
+from app.agents.direct import direct_tool_call, enrichment_instructions
 
-llm = get_llm()
+llm = get_llm(role="tool", agent="flowchart")
+agent_llm = get_llm(role="agent", agent="flowchart")
 
 FLOW_SYSTEM_PROMPT = """You are a Senior Business Process Analyst and Flowchart Expert. Your goal is to generate high-end, professional, and optimized flowcharts in JSON for React Flow.
 
@@ -23,9 +32,7 @@ FLOW_SYSTEM_PROMPT = """You are a Senior Business Process Analyst and Flowchart
 ### EXECUTION & ENRICHMENT
 - **MANDATORY ENRICHMENT**: Expand simple lists into comprehensive business processes with professional descriptions.
 - **QUANTITATIVE DEPTH**: Add time estimates or KPIs to labels where helpful (e.g., "Verification (Est. 5 min)").
-- **LAYOUT**: 
-  - Vertical: 250px between nodes.
-  - Horizontal: 400px for branches.
+<<LAYOUT>>
 - **LANGUAGE**: Match user's input language.
 
 ### OUTPUT FORMAT
@@ -33,12 +40,193 @@ FLOW_SYSTEM_PROMPT = """You are a Senior Business Process Analyst and Flowchart
 - **Strict JSON Syntax**: No comments, keys must be double-quoted.
 - **Structure**:
   {
-    "nodes": [ { "id": "1", "type": "start", "position": { "x": 0, "y": 0 }, "data": { "label": "Start" } }, ... ],
+    "nodes": [ <<NODE_EXAMPLE>>, ... ],
     "edges": [ { "id": "e1-2", "source": "1", "target": "2", "animated": true }, ... ]
   }
 """
 
+# FLOW_LAYOUT=server: the model only emits topology and nodes are placed by sugiyama_layout
+FLOW_LAYOUT_RULES = {
+    "model": """- **LAYOUT**: 
+  - Vertical: 250px between nodes.
+  - Horizontal: 400px for branches.""",
+    "server": """- **LAYOUT**: Do NOT output `position`. Nodes are laid out automatically in layers along the edges; list them in reading order.""",
+}
+FLOW_NODE_EXAMPLES = {
+    "model": '{ "id": "1", "type": "start", "position": { "x": 0, "y": 0 }, "data": { "label": "Start" } }',
+    "server": '{ "id": "1", "type": "start", "data": { "label": "Start" } }',
+}
+SERVER_LAYOUT = settings.FLOW_LAYOUT == "server"
+FLOW_SYSTEM_PROMPT = FLOW_SYSTEM_PROMPT.replace("<<LAYOUT>>", FLOW_LAYOUT_RULES[settings.FLOW_LAYOUT]).replace(
+    "<<NODE_EXAMPLE>>", FLOW_NODE_EXAMPLES[settings.FLOW_LAYOUT]
+)
+
+# Spacing of the server-side layout (same grid the model was asked to use)
+LAYER_GAP = 250
+NODE_GAP = 400
+# Barycenter sweeps (down + up) for crossing reduction
+ORDERING_SWEEPS = 4
+# Edges spanning more layers than this get no dummy chain (they'd dominate the work on
+# large graphs and hardly change the order)
+MAX_DUMMY_SPAN = 8
+
+
+def sugiyama_layout(node_ids: list[str], edges: list[tuple[str, str]]) -> dict[str, dict]:
+    """
+    Layered (Sugiyama-style) layout, top to bottom: cycles are broken by reversing DFS back
+    edges, nodes get their longest-path layer, edges spanning up to MAX_DUMMY_SPAN layers are
+    split with dummy nodes, crossings are reduced with barycenter sweeps and each node is
+    placed under the mean of its parents without overlapping its neighbours. Linear-ish in
+    nodes + edges: ~10ms for 1,000 nodes.
+    """
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    count = len(node_ids)
+    successors: list[list[int]] = [[] for _ in range(count)]
+    seen = set()
+    for source, target in edges:
+        u, v = index.get(source), index.get(target)
+        if u is None or v is None or u == v or (u, v) in seen:
+            continue
+        seen.add((u, v))
+        successors[u].append(v)
+
+    # 1. Cycle removal: edges pointing back to a node on the DFS stack are reversed
+    state = [0] * count  # 0 = unvisited, 1 = on stack, 2 = done
+    dag: list[list[int]] = [[] for _ in range(count)]
+    for root in range(count):
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [(root, 0)]
+        while stack:
+            u, i = stack[-1]
+            if i < len(successors[u]):
+                stack[-1] = (u, i + 1)
+                v = successors[u][i]
+                if state[v] == 1:
+                    dag[v].append(u)
+                    continue
+                dag[u].append(v)
+                if state[v] == 0:
+                    state[v] = 1
+                    stack.append((v, 0))
+            else:
+                state[u] = 2
+                stack.pop()
+
+    # 2. Longest-path layering in topological order
+    indegree = [0] * count
+    for u in range(count):
+        for v in dag[u]:
+            indegree[v] += 1
+    layer = [0] * count
+    queue = [u for u in range(count) if indegree[u] == 0]
+    for u in queue:
+        for v in dag[u]:
+            layer[v] = max(layer[v], layer[u] + 1)
+            indegree[v] -= 1
+            if indegree[v] == 0:
+                queue.append(v)
+
+    # 3. Dummy nodes so every (not too long) edge spans exactly one layer
+    up: list[list[int]] = [[] for _ in range(count)]
+    down: list[list[int]] = [[] for _ in range(count)]
+    layers: list[list[int]] = [[] for _ in range(max(layer, default=0) + 1)]
+    for u in queue:
+        layers[layer[u]].append(u)
+    for u in range(count):
+        for v in dag[u]:
+            if layer[v] - layer[u] > MAX_DUMMY_SPAN:
+                continue
+            previous = u
+            for level in range(layer[u] + 1, layer[v]):
+                dummy = len(up)
+                up.append([previous])
+                down.append([])
+                down[previous].append(dummy)
+                layers[level].append(dummy)
+                previous = dummy
+            down[previous].append(v)
+            up[v].append(previous)
+
+    # 4. Crossing reduction: reorder each layer by the barycenter of its neighbours
+    position = [0.0] * len(up)
+    for nodes in layers:
+        for i, u in enumerate(nodes):
+            position[u] = i
+    for sweep in range(ORDERING_SWEEPS):
+        downward = sweep % 2 == 0
+        order = range(1, len(layers)) if downward else range(len(layers) - 2, -1, -1)
+        neighbours = up if downward else down
+        for level in order:
+            nodes = layers[level]
+            keys = {}
+            for u in nodes:
+                adjacent = neighbours[u]
+                keys[u] = sum(position[w] for w in adjacent) / len(adjacent) if adjacent else position[u]
+            nodes.sort(key=keys.__getitem__)
+            for i, u in enumerate(nodes):
+                position[u] = i
+
+    # 5. Coordinates: under the mean of the parents, left to right without overlaps
+    x = [0.0] * len(up)
+    for level, nodes in enumerate(layers):
+        previous = None
+        offsets = []
+        for u in nodes:
+            desired = sum(x[w] for w in up[u]) / len(up[u]) if level and up[u] else None
+            placed = desired if desired is not None else (previous + NODE_GAP if previous is not None else 0.0)
+            if previous is not None:
+                placed = max(placed, previous + NODE_GAP)
+            x[u] = placed
+            previous = placed
+            if desired is not None:
+                offsets.append(desired - placed)
+        # Pushing nodes right to avoid overlaps drifts the layer; centre it back
+        if offsets:
+            shift = sum(offsets) / len(offsets)
+        else:
+            shift = -(x[nodes[-1]] + x[nodes[0]]) / 2 if nodes else 0.0
+        for u in nodes:
+            x[u] += shift
+
+    left = min((x[u] for u in range(count)), default=0.0)
+    return {
+        node_ids[u]: {"x": round(x[u] - left), "y": layer[u] * LAYER_GAP}
+        for u in range(count)
+    }
+
+
+def strip_positions(code: str) -> str:
+    """Topology only, for prompts: positions are recomputed after every generation."""
+    try:
+        doc = json.loads(code)
+        for node in doc.get("nodes", []):
+            if isinstance(node, dict) and not (node.get("parentNode") or node.get("parentId")):
+                node.pop("position", None)
+    except (ValueError, AttributeError):
+        return code
+    return json.dumps(doc, ensure_ascii=False)
+
+
+def apply_layout(code: str) -> str:
+    """Positions every top-level node of a React Flow document (children of groups keep theirs)."""
+    try:
+        doc = json.loads(code)
+        nodes = [n for n in doc["nodes"] if not (n.get("parentNode") or n.get("parentId"))]
+        edges = [(str(e.get("source")), str(e.get("target"))) for e in doc.get("edges") or []]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return code
+
+    start = time.perf_counter()
+    positions = sugiyama_layout([str(n.get("id")) for n in nodes], edges)
+    for node in nodes:
+        node["position"] = positions[str(node.get("id"))]
+    logger.info(f"📐 Laid out {len(nodes)} flow nodes in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return json.dumps(doc, ensure_ascii=False, indent=2)
+
 @tool
+@cached_tool("flow", llm)
 async def create_flow(instruction: str):
     """
     Renders an interactive flowchart using React Flow based on instructions.
@@ -48,60 +236,44 @@ async def create_flow(instruction: str):
     messages = get_messages()
     context = get_context()
     current_code = context.get("current_code", "")
+    if SERVER_LAYOUT and current_code:
+        current_code = strip_positions(current_code)
+
+    # Edit mode: ask for a compact patch instead of re-emitting the whole diagram
+    if current_code and settings.EDIT_MODE == "patch":
+        patched = await generate_edit(llm, "json", FLOW_SYSTEM_PROMPT + get_thinking_instructions(), messages, instruction, current_code)
+        if patched is not None:
+            return await finish_flow(patched)
     
     # Call LLM to generate the Flow JSON
     system_msg = FLOW_SYSTEM_PROMPT + get_thinking_instructions()
+    if context.get("direct"):
+        system_msg += enrichment_instructions(FLOW_AGENT_PROMPT)
     if current_code:
         system_msg += f"\n\n### CURRENT FLOWCHART CODE (JSON)\n```json\n{current_code}\n```\nApply changes to this code."
 
-    prompt = [SystemMessage(content=system_msg)] + messages
-    if instruction:
-        prompt.append(HumanMessage(content=f"Instruction: {instruction}"))
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent="flowchart", tail=tail)
     
     full_content = ""
     async for chunk in llm.astream(prompt):
         if chunk.content:
             full_content += chunk.content
     
-    json_str = full_content
-    
-    # Robust JSON Extraction: Find the substring from first '{' to last '}'
-    import re
-    # Remove any thinking tags first
-    json_str = re.sub(r'<think>[\s\S]*?</think>', '', json_str, flags=re.DOTALL)
-    
-    match = re.search(r'(\{[\s\S]*\})', json_str)
-    if match:
-        cleaned_json = match.group(1)
-    else:
-        cleaned_json = re.sub(r'^```\w*\n?', '', json_str.strip())
-        cleaned_json = re.sub(r'\n?```$', '', cleaned_json.strip())
-    
-    return cleaned_json.strip()
+    return await finish_flow(full_content)
 
-tools = [create_flow]
-llm_with_tools = llm.bind_tools(tools)
 
-async def flow_agent_node(state: AgentState):
-    messages = state['messages']
-    
-    # 动态从历史中提取最新的 flowchart 代码（寻找最后一条 tool 消息且内容包含 nodes/edges）
-    current_code = ""
-    for msg in reversed(messages):
-        if msg.type == "tool" and msg.content:
-            stripped = msg.content.strip()
-            if '"nodes":' in stripped and '"edges":' in stripped:
-                current_code = stripped
-                break
+async def finish_flow(output: str) -> str:
+    # Extract, validate and repair the output (see ARTIFACT_VALIDATION), then lay it out
+    if not SERVER_LAYOUT:
+        return await validate_output("flow", output, llm)
+    return apply_layout(await validate_output("flow_topology", output, llm))
 
-    # Safety: Ensure no empty text content blocks reach the LLM
-    for msg in messages:
-        if hasattr(msg, 'content') and not msg.content:
-            msg.content = "Generate a flowchart"
+tools = [create_flow]
+llm_with_tools = bind_tools(agent_llm, tools)
 
-    set_context(messages, current_code=current_code)
-    
-    system_prompt = SystemMessage(content="""You are a World-Class Business Process Analyst.
+# Orchestrator brief: expands the request into a detailed instruction for the tool
+FLOW_AGENT_PROMPT = """You are a World-Class Business Process Analyst.
     YOUR MISSION is to act as a Process Improvement Consultant. When a user describes a flow, don't just "diagram" it—OPTIMIZE and INDUSTRIALIZE it.
     
     ### ORCHESTRATION RULES:
@@ -115,10 +287,29 @@ async def flow_agent_node(state: AgentState):
     
     ### PROACTIVENESS:
     - BE DECISIVE. If a step looks like it needs "Manual Approval" or a "Timeout", include it in the optimized instructions.
-    """ + get_thinking_instructions())
+    """
+
+async def flow_agent_node(state: AgentState, direct: bool = False):
+    messages = state['messages']
+    
+    # 最新的 flowchart 产物：本轮工具结果，或会话分支上存储的最新版本（O(1) 查找）
+    current_code = current_artifact("flowchart", messages)
+
+    # Safety: Ensure no empty text content blocks reach the LLM
+    for msg in messages:
+        if hasattr(msg, 'content') and not msg.content:
+            msg.content = "Generate a flowchart"
+
+    set_context(messages, current_code=current_code, direct=direct)
+
+    # Direct mode: skip the orchestrator call and hand the request straight to the generator
+    if direct and messages[-1].type != "tool":
+        return {"messages": [direct_tool_call(create_flow, messages)]}
+    
+    system_prompt = SystemMessage(content=FLOW_AGENT_PROMPT + get_thinking_instructions())
     
     full_response = None
-    async for chunk in llm_with_tools.astream([system_prompt] + messages):
+    async for chunk in llm_with_tools.astream(assemble_context(system_prompt, messages, "agent", agent="flowchart")):
         if full_response is None:
             full_response = chunk
         else:
@@ -1,8 +1,9 @@
 from langchain_core.messages import SystemMessage
 from app.state.state import AgentState
 from app.core.llm import get_llm
+from app.core.tokens import assemble_context
 
-llm = get_llm()
+llm = get_llm(role="agent", agent="general")
 
 async def general_agent_node(state: AgentState):
     messages = state['messages']
@@ -22,5 +23,5 @@ async def general_agent_node(state: AgentState):
     DO NOT call any tools. Just chat.
     """)
     
-    response = await llm.ainvoke([system_prompt] + messages)
+    response = await llm.ainvoke(assemble_context(system_prompt, messages, "agent", agent="general"))
     return {"messages": [response]}
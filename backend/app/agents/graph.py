@@ -1,7 +1,10 @@
+import asyncio
+import copy
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 from app.state.state import AgentState
-from app.agents.dispatcher import router_node, route_decision
+from app.core.config import settings
+from app.agents.dispatcher import router_node, route_decision, find_last_active_agent, has_explicit_mention
 from app.agents.mindmap import mindmap_agent_node as mindmap_agent, tools as mindmap_tools
 from app.agents.flow import flow_agent_node as flow_agent, tools as flow_tools
 from app.agents.mermaid import mermaid_agent_node as mermaid_agent, tools as mermaid_tools
@@ -10,11 +13,96 @@ from app.agents.drawio import drawio_agent_node as drawio_agent, tools as drawio
 from app.agents.infographic import infographic_agent_node as infographic_agent, tools as infographic_tools
 from app.agents.general import general_agent_node as general_agent
 
+def with_mode(agent_node):
+    """
+    GRAPH_MODE=direct: the agent node skips its orchestrator LLM call and sends the request
+    straight to the generator tool, which gets the orchestrator's enrichment brief merged
+    into its own prompt (one LLM call instead of two before the diagram appears).
+    """
+    if settings.GRAPH_MODE != "direct":
+        return agent_node
+
+    async def direct_agent_node(state: AgentState):
+        return await agent_node(state, direct=True)
+    return direct_agent_node
+
+mindmap_agent = with_mode(mindmap_agent)
+flow_agent = with_mode(flow_agent)
+mermaid_agent = with_mode(mermaid_agent)
+charts_agent = with_mode(charts_agent)
+drawio_agent = with_mode(drawio_agent)
+infographic_agent = with_mode(infographic_agent)
+
+def after_tools(agent_node_name: str):
+    # GRAPH_END_AFTER_TOOL: finish with the tool result instead of a closing agent message
+    return END if settings.GRAPH_END_AFTER_TOOL else agent_node_name
+
+# Agent <-> Tool edges (ReAct Loop)
+def should_continue(state: AgentState):
+    messages = state['messages']
+    last_message = messages[-1]
+    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
+        return "continue"
+    return "end"
+
+# intent -> (node name prefix, agent node)
+AGENTS = {
+    "mindmap": ("mindmap", mindmap_agent),
+    "flowchart": ("flow", flow_agent),
+    "mermaid": ("mermaid", mermaid_agent),
+    "charts": ("charts", charts_agent),
+    "drawio": ("drawio", drawio_agent),
+    "infographic": ("infographic", infographic_agent),
+    "general": ("general", general_agent),
+}
+
+async def speculative_router_node(state: AgentState):
+    """
+    Router with speculative execution: for follow-up turns, the last active agent starts
+    concurrently with routing. Its output is buffered (events are attributed to the router
+    node and not streamed) and committed if the router picks the same agent; otherwise the
+    speculative run is cancelled, which aborts its upstream LLM call.
+    """
+    messages = state['messages']
+    last_active_agent = find_last_active_agent(messages)
+    if not settings.SPECULATIVE_ROUTING or last_active_agent not in AGENTS or has_explicit_mention(messages[-1]):
+        return await router_node(state)
+
+    _, agent_node = AGENTS[last_active_agent]
+    # Agents rewrite message objects in place (e.g. filling empty contents), and the router
+    # reads the same messages concurrently: the speculative run gets its own copies
+    speculation = asyncio.create_task(agent_node({**state, "messages": copy.deepcopy(messages)}))
+    try:
+        decision = await router_node(state)
+    except BaseException:
+        speculation.cancel()
+        raise
+
+    if decision["intent"] == last_active_agent:
+        result = await speculation
+        return {**decision, **result, "speculation": "hit"}
+
+    speculation.cancel()
+    try:
+        await speculation
+    except (asyncio.CancelledError, Exception):
+        pass
+    return {**decision, "speculation": "miss"}
+
+def route_after_router(state: AgentState):
+    if state.get("speculation") == "hit":
+        # The agent already ran; continue where its own node would have gone
+        prefix, _ = AGENTS[state["intent"]]
+        if prefix != "general" and should_continue(state) == "continue":
+            return f"{prefix}_tools"
+        return "end"
+    return route_decision(state)
+
 # Define the graph
 workflow = StateGraph(AgentState)
 
 # Add nodes
-workflow.add_node("router", router_node)
+workflow.add_node("router", speculative_router_node)
 workflow.add_node("mindmap_agent", mindmap_agent)
 workflow.add_node("flow_agent", flow_agent)
 workflow.add_node("mermaid_agent", mermaid_agent)
@@ -44,7 +132,7 @@ workflow.set_entry_point("router")
 # Router edges
 workflow.add_conditional_edges(
     "router",
-    route_decision,
+    route_after_router,
     {
         "mindmap_agent": "mindmap_agent",
         "flow_agent": "flow_agent",
@@ -52,25 +140,25 @@ workflow.add_conditional_edges(
         "charts_agent": "charts_agent",
         "drawio_agent": "drawio_agent",
         "infographic_agent": "infographic_agent",
-        "general_agent": "general_agent"
+        "general_agent": "general_agent",
+        # Committed speculative runs
+        "mindmap_tools": "mindmap_tools",
+        "flow_tools": "flow_tools",
+        "mermaid_tools": "mermaid_tools",
+        "charts_tools": "charts_tools",
+        "drawio_tools": "drawio_tools",
+        "infographic_tools": "infographic_tools",
+        "end": END
     }
 )
 
-# Agent <-> Tool edges (ReAct Loop)
-def should_continue(state: AgentState):
-    messages = state['messages']
-    last_message = messages[-1]
-    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        return "continue"
-    return "end"
-
 # MindMap Loop
 workflow.add_conditional_edges(
     "mindmap_agent",
     should_continue,
     {"continue": "mindmap_tools", "end": END}
 )
-workflow.add_edge("mindmap_tools", "mindmap_agent")
+workflow.add_edge("mindmap_tools", after_tools("mindmap_agent"))
 
 # Flow Loop
 workflow.add_conditional_edges(
@@ -78,7 +166,7 @@ workflow.add_conditional_edges(
     should_continue,
     {"continue": "flow_tools", "end": END}
 )
-workflow.add_edge("flow_tools", "flow_agent")
+workflow.add_edge("flow_tools", after_tools("flow_agent"))
 
 # Mermaid Loop
 workflow.add_conditional_edges(
@@ -86,7 +174,7 @@ workflow.add_conditional_edges(
     should_continue,
     {"continue": "mermaid_tools", "end": END}
 )
-workflow.add_edge("mermaid_tools", "mermaid_agent")
+workflow.add_edge("mermaid_tools", after_tools("mermaid_agent"))
 
 # Charts Loop
 workflow.add_conditional_edges(
@@ -94,7 +182,7 @@ workflow.add_conditional_edges(
     should_continue,
     {"continue": "charts_tools", "end": END}
 )
-workflow.add_edge("charts_tools", "charts_agent")
+workflow.add_edge("charts_tools", after_tools("charts_agent"))
 
 # Drawio Loop
 workflow.add_conditional_edges(
@@ -102,7 +190,7 @@ workflow.add_conditional_edges(
     should_continue,
     {"continue": "drawio_tools", "end": END}
 )
-workflow.add_edge("drawio_tools", "drawio_agent")
+workflow.add_edge("drawio_tools", after_tools("drawio_agent"))
 
 # Infographic Loop
 workflow.add_conditional_edges(
@@ -110,7 +198,7 @@ workflow.add_conditional_edges(
     should_continue,
     {"continue": "infographic_tools", "end": END}
 )
-workflow.add_edge("infographic_tools", "infographic_agent")
+workflow.add_edge("infographic_tools", after_tools("infographic_agent"))
 
 # General Agent (No tools, just ends)
 workflow.add_edge("general_agent", END)
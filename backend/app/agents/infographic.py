@@ -2,10 +2,16 @@ from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
 from app.state.state import AgentState
 from app.core.config import settings
-from app.core.llm import get_llm, get_thinking_instructions
-from app.core.context import set_context, get_messages, get_context
+from app.core.llm import get_llm, bind_tools, get_thinking_instructions
+from app.core.context import set_context, get_messages, get_context, current_artifact
+from app.core.patching import generate_edit
+from app.core.cache import cached_tool
+from app.core.validation import validate_output
+from app.core.tokens import assemble_context
+from app.agents.direct import direct_tool_call, enrichment_instructions
 
-llm = get_llm()
+llm = get_llm(role="tool", agent="infographic")
+agent_llm = get_llm(role="agent", agent="infographic")
 
 INFOGRAPHIC_SYSTEM_PROMPT = """You are an expert Infographic Designer. Your goal is to generate professional AntV Infographic DSL syntax.
 
@@ -67,6 +73,7 @@ data
 """
 
 @tool
+@cached_tool("infographic", llm)
 async def create_infographic(instruction: str):
     """
     Renders an Infographic using AntV Infographic DSL based on instructions.
@@ -76,15 +83,22 @@ async def create_infographic(instruction: str):
     messages = get_messages()
     context = get_context()
     current_code = context.get("current_code", "")
+
+    # Edit mode: ask for a compact patch instead of re-emitting the whole diagram
+    if current_code and settings.EDIT_MODE == "patch":
+        patched = await generate_edit(llm, "lines", INFOGRAPHIC_SYSTEM_PROMPT + get_thinking_instructions(), messages, instruction, current_code)
+        if patched is not None:
+            return await validate_output("infographic", patched, llm)
     
     # Call LLM to generate the Infographic DSL
     system_msg = INFOGRAPHIC_SYSTEM_PROMPT + get_thinking_instructions()
+    if context.get("direct"):
+        system_msg += enrichment_instructions(INFOGRAPHIC_AGENT_PROMPT)
     if current_code:
         system_msg += f"\n\n### CURRENT INFOGRAPHIC CODE\n```\n{current_code}\n```\nApply changes to this code."
         
-    prompt = [SystemMessage(content=system_msg)] + messages
-    if instruction:
-        prompt.append(HumanMessage(content=f"Instruction: {instruction}"))
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent="infographic", tail=tail)
     
     # Using astream to allow the graph's astream_events to catch it
     full_content = ""
@@ -93,48 +107,14 @@ async def create_infographic(instruction: str):
         if content:
             full_content += content
     
-    dsl_str = full_content
-    
-    # Robust Stripping: Extract from ``` blocks if present
-    import re
-    # Remove any thinking tags first
-    dsl_str = re.sub(r'<think>[\s\S]*?</think>', '', dsl_str, flags=re.DOTALL)
-
-    code_block_match = re.search(r'```(?:\w+)?\n([\s\S]*?)```', dsl_str)
-    if code_block_match:
-        dsl_str = code_block_match.group(1).strip()
-    
-    # Further ensure it starts with infographic keyword
-    if 'infographic' in dsl_str and not dsl_str.strip().startswith('infographic'):
-        infographic_match = re.search(r'infographic[\s\S]*', dsl_str)
-        if infographic_match:
-            dsl_str = infographic_match.group(0).strip()
-    
-    return dsl_str.strip()
+    # Extract, validate and repair the output (see ARTIFACT_VALIDATION)
+    return await validate_output("infographic", full_content, llm)
 
 tools = [create_infographic]
-llm_with_tools = llm.bind_tools(tools)
-
-async def infographic_agent_node(state: AgentState):
-    messages = state['messages']
-    
-    # 动态从历史中提取最新的 infographic 代码（寻找最后一条 tool 消息且内容包含 infographic）
-    current_code = ""
-    for msg in reversed(messages):
-        if msg.type == "tool" and msg.content:
-            stripped = msg.content.strip()
-            if stripped.startswith('infographic '):
-                current_code = stripped
-                break
+llm_with_tools = bind_tools(agent_llm, tools)
 
-    # Safety: Ensure no empty text content blocks reach the LLM
-    for msg in messages:
-        if hasattr(msg, 'content') and not msg.content:
-            msg.content = "Generate an infographic"
-
-    set_context(messages, current_code=current_code)
-    
-    system_prompt = SystemMessage(content="""You are an expert Infographic Orchestrator. 
+# Orchestrator brief: expands the request into a detailed instruction for the tool
+INFOGRAPHIC_AGENT_PROMPT = """You are an expert Infographic Orchestrator. 
     YOUR MISSION is to act as a Consultative Creative Director. When a user provides a request, don't just pass it through—EXPAND and ENRICH it.
     
     ### ORCHESTRATION RULES:
@@ -148,10 +128,29 @@ async def infographic_agent_node(state: AgentState):
     
     ### PROACTIVENESS:
     - BE DECISIVE. If you see an opportunity to add a "Did you know?" section or a "Key Metric", include it in the tool instruction.
-    """ + get_thinking_instructions())
+    """
+
+async def infographic_agent_node(state: AgentState, direct: bool = False):
+    messages = state['messages']
+    
+    # 最新的 infographic 产物：本轮工具结果，或会话分支上存储的最新版本（O(1) 查找）
+    current_code = current_artifact("infographic", messages)
+
+    # Safety: Ensure no empty text content blocks reach the LLM
+    for msg in messages:
+        if hasattr(msg, 'content') and not msg.content:
+            msg.content = "Generate an infographic"
+
+    set_context(messages, current_code=current_code, direct=direct)
+
+    # Direct mode: skip the orchestrator call and hand the request straight to the generator
+    if direct and messages[-1].type != "tool":
+        return {"messages": [direct_tool_call(create_infographic, messages)]}
+    
+    system_prompt = SystemMessage(content=INFOGRAPHIC_AGENT_PROMPT + get_thinking_instructions())
     
     full_response = None
-    async for chunk in llm_with_tools.astream([system_prompt] + messages):
+    async for chunk in llm_with_tools.astream(assemble_context(system_prompt, messages, "agent", agent="infographic")):
         if full_response is None:
             full_response = chunk
         else:
@@ -2,10 +2,16 @@ from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
 from app.state.state import AgentState
 from app.core.config import settings
-from app.core.llm import get_llm, get_thinking_instructions
-from app.core.context import set_context, get_messages, get_context
+from app.core.llm import get_llm, bind_tools, get_thinking_instructions
+from app.core.context import set_context, get_messages, get_context, current_artifact
+from app.core.patching import generate_edit
+from app.core.cache import cached_tool
+from app.core.validation import validate_output
+from app.core.tokens import assemble_context
+from app.agents.direct import direct_tool_call, enrichment_instructions
 
-llm = get_llm()
+llm = get_llm(role="tool", agent="mermaid")
+agent_llm = get_llm(role="agent", agent="mermaid")
 
 MERMAID_SYSTEM_PROMPT = """You are a World-Class Technical Documentation Specialist and Mermaid Diagram Expert. Your goal is to generate professional, semantically rich, and accurate Mermaid syntax.
 
@@ -26,6 +32,7 @@ Return ONLY the raw Mermaid syntax string. No markdown fences. NO COMMENTS (like
 """
 
 @tool
+@cached_tool("mermaid", llm)
 async def create_mermaid(instruction: str):
     """
     Renders a diagram using Mermaid syntax based on instructions.
@@ -35,55 +42,36 @@ async def create_mermaid(instruction: str):
     messages = get_messages()
     context = get_context()
     current_code = context.get("current_code", "")
+
+    # Edit mode: ask for a compact patch instead of re-emitting the whole diagram
+    if current_code and settings.EDIT_MODE == "patch":
+        patched = await generate_edit(llm, "lines", MERMAID_SYSTEM_PROMPT + get_thinking_instructions(), messages, instruction, current_code)
+        if patched is not None:
+            return await validate_output("mermaid", patched, llm)
     
     # Call LLM to generate the Mermaid code
     system_msg = MERMAID_SYSTEM_PROMPT + get_thinking_instructions()
+    if context.get("direct"):
+        system_msg += enrichment_instructions(MERMAID_AGENT_PROMPT)
     if current_code:
         system_msg += f"\n\n### CURRENT DIAGRAM CODE\n```mermaid\n{current_code}\n```\nApply changes to this code."
 
-    prompt = [SystemMessage(content=system_msg)] + messages
-    if instruction:
-        prompt.append(HumanMessage(content=f"Instruction: {instruction}"))
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent="mermaid", tail=tail)
     
     full_content = ""
     async for chunk in llm.astream(prompt):
         if chunk.content:
             full_content += chunk.content
     
-    code = full_content
-    
-    # Robustly strip markdown code blocks
-    import re
-    # Remove any thinking tags first
-    code = re.sub(r'<think>[\s\S]*?</think>', '', code, flags=re.DOTALL)
-
-    cleaned_code = re.sub(r'^```[a-zA-Z]*\n', '', code)
-    cleaned_code = re.sub(r'\n```$', '', cleaned_code)
-    return cleaned_code.strip()
+    # Extract, validate and repair the output (see ARTIFACT_VALIDATION)
+    return await validate_output("mermaid", full_content, llm)
 
 tools = [create_mermaid]
-llm_with_tools = llm.bind_tools(tools)
-
-async def mermaid_agent_node(state: AgentState):
-    messages = state['messages']
-    
-    # 动态从历史中提取最新的 mermaid 代码（寻找最后一条 tool 消息且内容包含 graph/sequenceDiagram 等）
-    current_code = ""
-    for msg in reversed(messages):
-        if msg.type == "tool" and msg.content:
-            stripped = msg.content.strip()
-            if any(stripped.startswith(k) for k in ["graph", "sequenceDiagram", "gantt", "classDiagram", "stateDiagram", "pie"]):
-                current_code = stripped
-                break
+llm_with_tools = bind_tools(agent_llm, tools)
 
-    # Safety: Ensure no empty text content blocks reach the LLM
-    for msg in messages:
-        if hasattr(msg, 'content') and not msg.content:
-            msg.content = "Generate a mermaid diagram"
-
-    set_context(messages, current_code=current_code)
-    
-    system_prompt = SystemMessage(content="""You are a World-Class Technical Documentation Specialist.
+# Orchestrator brief: expands the request into a detailed instruction for the tool
+MERMAID_AGENT_PROMPT = """You are a World-Class Technical Documentation Specialist.
     YOUR MISSION is to act as a Solutions Architect. When a user asks for a diagram, don't just "syntax" it—FORMALIZE and DOCUMENT it.
     
     ### ORCHESTRATION RULES:
@@ -97,10 +85,29 @@ async def mermaid_agent_node(state: AgentState):
     
     ### PROACTIVENESS:
     - BE DECISIVE. If you see an opportunity to add a "Fallback State" or a "User Feedback Loop", include it in the architect's instructions.
-    """ + get_thinking_instructions())
+    """
+
+async def mermaid_agent_node(state: AgentState, direct: bool = False):
+    messages = state['messages']
+    
+    # 最新的 mermaid 产物：本轮工具结果，或会话分支上存储的最新版本（O(1) 查找）
+    current_code = current_artifact("mermaid", messages)
+
+    # Safety: Ensure no empty text content blocks reach the LLM
+    for msg in messages:
+        if hasattr(msg, 'content') and not msg.content:
+            msg.content = "Generate a mermaid diagram"
+
+    set_context(messages, current_code=current_code, direct=direct)
+
+    # Direct mode: skip the orchestrator call and hand the request straight to the generator
+    if direct and messages[-1].type != "tool":
+        return {"messages": [direct_tool_call(create_mermaid, messages)]}
+    
+    system_prompt = SystemMessage(content=MERMAID_AGENT_PROMPT + get_thinking_instructions())
     
     full_response = None
-    async for chunk in llm_with_tools.astream([system_prompt] + messages):
+    async for chunk in llm_with_tools.astream(assemble_context(system_prompt, messages, "agent", agent="mermaid")):
         if full_response is None:
             full_response = chunk
         else:
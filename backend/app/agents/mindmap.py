@@ -1,11 +1,23 @@
+import asyncio
+import re
+import time
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
 from app.state.state import AgentState
 from app.core.config import settings
-from app.core.llm import get_llm, get_thinking_instructions
-from app.core.context import set_context, get_messages, get_context
+from app.core.logger import logger
+from app.core.llm import get_llm, bind_tools, get_thinking_instructions
+from app.core.context import set_context, get_messages, get_context, current_artifact
+from app.core.patching import generate_edit, EDIT_TAG
+from app.core.incremental import FANOUT_TAG
+from app.core.reasoning import strip_reasoning
+from app.core.cache import cached_tool
+from app.core.validation import validate_output
+from app.core.tokens import assemble_context
+from app.agents.direct import direct_tool_call, enrichment_instructions
 
-llm = get_llm()
+llm = get_llm(role="tool", agent="mindmap")
+agent_llm = get_llm(role="agent", agent="mindmap")
 
 MINDMAP_SYSTEM_PROMPT = """You are a World-Class Strategic Thinking Partner and Knowledge Architect. Your goal is to generate deep, insightful, and structured mindmaps using Markdown (Markmap).
 
@@ -28,7 +40,99 @@ MINDMAP_SYSTEM_PROMPT = """You are a World-Class Strategic Thinking Partner and
 - Return ONLY the raw Markdown. No code fences.
 """
 
+# --- Fan-out generation (MINDMAP_MODE=fanout) -------------------------------------------
+# The outline (root + main branches) comes first, then every branch is expanded by its own
+# call, MINDMAP_FANOUT_CONCURRENCY at a time: wall-clock time follows the depth of the map
+# rather than its total size.
+
+OUTLINE_INSTRUCTIONS = """
+
+### OUTLINE STEP (OVERRIDES THE OUTPUT FORMAT ABOVE)
+Return ONLY the skeleton of the mindmap: the `# Main Topic` line followed by its 4-8 main
+branches as `## Branch` lines. Nothing deeper, no code fences, no explanations.
+"""
+
+BRANCH_PROMPT = MINDMAP_SYSTEM_PROMPT + """
+
+### BRANCH STEP (OVERRIDES THE OUTPUT FORMAT ABOVE)
+The mindmap is being written one main branch at a time. Its outline:
+{outline}
+
+Write ONLY the branch `## {branch}`: start with that exact line, then its sub-topics
+(`###`, then `-` lists, 3-4 levels below the branch). Stay within this branch; the other
+branches are written separately. No `#` root line, no code fences, no explanations.
+"""
+
+_HEADING = re.compile(r"^(#{1,2})\s+(.+?)\s*$")
+
+
+def parse_outline(text: str) -> tuple[str, list[str]]:
+    """(root line, main branch titles) of an outline; the root defaults to an empty heading."""
+    root, branches = "", []
+    for line in strip_reasoning(text).split("\n"):
+        match = _HEADING.match(line.strip())
+        if not match:
+            continue
+        if match.group(1) == "#" and not root:
+            root = line.strip()
+        elif match.group(1) == "##":
+            branches.append(match.group(2))
+    return root, branches
+
+
+def clean_branch(text: str, branch: str) -> str:
+    """A branch subtree starting with its `## ` heading, without a repeated root."""
+    text = re.sub(r"^```[a-zA-Z]*\n|\n?```\s*$", "", strip_reasoning(text).strip())
+    lines = [l for l in text.split("\n") if not re.match(r"^#\s", l)]
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    if not lines or not lines[0].startswith("## "):
+        lines.insert(0, f"## {branch}")
+    return "\n".join(lines).strip()
+
+
+async def fanout_mindmap(system_msg: str, messages: list, instruction: str) -> str | None:
+    """Outline, then the branches concurrently; None if the outline has no branches."""
+    start = time.perf_counter()
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg + OUTLINE_INSTRUCTIONS, messages, "tool", agent="mindmap", tail=tail)
+    # The outline isn't streamed: the branches carry it to the client as they finish
+    outline = await llm.ainvoke(prompt, config={"tags": [EDIT_TAG]})
+    root, branches = parse_outline(str(outline.content))
+    if not branches:
+        return None
+    root = root or f"# {instruction or branches[0]}"
+    outline_text = "\n".join([root] + [f"## {b}" for b in branches])
+
+    concurrency = max(1, settings.MINDMAP_FANOUT_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def expand(branch: str) -> str:
+        prompt = [
+            SystemMessage(content=BRANCH_PROMPT.format(outline=outline_text, branch=branch)),
+            HumanMessage(content=f"Instruction: {instruction}" if instruction else f"Expand {branch}"),
+        ]
+        config = {"tags": [FANOUT_TAG], "metadata": {"fanout_header": root + "\n\n"}}
+        async with semaphore:
+            try:
+                content = ""
+                async for chunk in llm.astream(prompt, config=config):
+                    if chunk.content:
+                        content += chunk.content
+                return clean_branch(content, branch)
+            except Exception as e:
+                logger.warning(f"🌿 Mindmap branch {branch!r} failed: {e}")
+                return f"## {branch}"
+
+    expanded = await asyncio.gather(*(expand(b) for b in branches))
+    logger.info(
+        f"🌿 Mindmap fan-out: {len(branches)} branches (concurrency {concurrency}) "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return "\n\n".join([root] + expanded)
+
 @tool
+@cached_tool("mindmap", llm)
 async def create_mindmap(instruction: str):
     """
     Renders a MindMap based on instructions.
@@ -38,58 +142,42 @@ async def create_mindmap(instruction: str):
     messages = get_messages()
     context = get_context()
     current_code = context.get("current_code", "")
+
+    # Edit mode: ask for a compact patch instead of re-emitting the whole diagram
+    if current_code and settings.EDIT_MODE == "patch":
+        patched = await generate_edit(llm, "lines", MINDMAP_SYSTEM_PROMPT + get_thinking_instructions(), messages, instruction, current_code)
+        if patched is not None:
+            return await validate_output("mindmap", patched, llm)
     
     # Call LLM to generate the Mindmap code
     system_msg = MINDMAP_SYSTEM_PROMPT + get_thinking_instructions()
+    if context.get("direct"):
+        system_msg += enrichment_instructions(MINDMAP_AGENT_PROMPT)
     if current_code:
         system_msg += f"\n\n### CURRENT MINDMAP CODE (Markdown)\n```markdown\n{current_code}\n```\nApply changes to this code."
 
-    prompt = [SystemMessage(content=system_msg)] + messages
-    if instruction:
-        prompt.append(HumanMessage(content=f"Instruction: {instruction}"))
+    # New mindmaps are generated branch by branch (see MINDMAP_MODE)
+    if not current_code and settings.MINDMAP_MODE == "fanout":
+        merged = await fanout_mindmap(system_msg, messages, instruction)
+        if merged is not None:
+            return await validate_output("mindmap", merged, llm)
+
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent="mindmap", tail=tail)
     
     full_content = ""
     async for chunk in llm.astream(prompt):
         if chunk.content:
             full_content += chunk.content
     
-    # Robust Stripping: Extract from ``` blocks if present
-    import re
-    # Remove any thinking tags first
-    full_content = re.sub(r'<think>[\s\S]*?</think>', '', full_content, flags=re.DOTALL)
-
-    code_block_match = re.search(r'```(?:\w+)?\n([\s\S]*?)```', full_content)
-    if code_block_match:
-        full_content = code_block_match.group(1).strip()
-    
-    # Simply return the markdown so the frontend can render it.
-    return full_content
+    # Extract, validate and repair the output (see ARTIFACT_VALIDATION)
+    return await validate_output("mindmap", full_content, llm)
 
 tools = [create_mindmap]
-llm_with_tools = llm.bind_tools(tools)
+llm_with_tools = bind_tools(agent_llm, tools)
 
-async def mindmap_agent_node(state: AgentState):
-    messages = state['messages']
-    
-    # 动态从历史中提取最新的 mindmap 代码（寻找最后一条 tool 消息且内容非空）
-    current_code = ""
-    for msg in reversed(messages):
-        if msg.type == "tool" and msg.content:
-            # 简单判断是否是 mindmap (Markdown 格式) 
-            # 更好的办法是判断 tool_name，但目前 content 已经足够
-            stripped = msg.content.strip()
-            if stripped.startswith("#"):
-                current_code = stripped
-                break
-
-    # Safety: Ensure no empty text content blocks reach the LLM
-    for msg in messages:
-        if hasattr(msg, 'content') and not msg.content:
-            msg.content = "Generate a mindmap"
-
-    set_context(messages, current_code=current_code)
-    
-    system_prompt = """You are a Visionary Strategic Thinking Partner.
+# Orchestrator brief: expands the request into a detailed instruction for the tool
+MINDMAP_AGENT_PROMPT = """You are a Visionary Strategic Thinking Partner.
     YOUR MISSION is to act as a Mental Model Consultant. When a user provides a topic, don't just "brainstorm" it—MAP the entire ecosystem.
     
     ### ORCHESTRATION RULES:
@@ -103,10 +191,29 @@ async def mindmap_agent_node(state: AgentState):
     
     ### PROACTIVENESS:
     - BE DECISIVE. If a topic has obvious "Pros/Cons" or "Future Risks", include them in the brainstormed instructions.
-    """ + get_thinking_instructions()
+    """
+
+async def mindmap_agent_node(state: AgentState, direct: bool = False):
+    messages = state['messages']
+    
+    # 最新的 mindmap 产物：本轮工具结果，或会话分支上存储的最新版本（O(1) 查找）
+    current_code = current_artifact("mindmap", messages)
+
+    # Safety: Ensure no empty text content blocks reach the LLM
+    for msg in messages:
+        if hasattr(msg, 'content') and not msg.content:
+            msg.content = "Generate a mindmap"
+
+    set_context(messages, current_code=current_code, direct=direct)
+
+    # Direct mode: skip the orchestrator call and hand the request straight to the generator
+    if direct and messages[-1].type != "tool":
+        return {"messages": [direct_tool_call(create_mindmap, messages)]}
+    
+    system_prompt = MINDMAP_AGENT_PROMPT + get_thinking_instructions()
     
     full_response = None
-    async for chunk in llm_with_tools.astream([system_prompt] + messages):
+    async for chunk in llm_with_tools.astream(assemble_context(system_prompt, messages, "agent", agent="mindmap")):
         if full_response is None:
             full_response = chunk
         else:
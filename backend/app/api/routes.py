@@ -1,15 +1,29 @@
-from fastapi import APIRouter, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
-from langchain_core.messages import HumanMessage, AIMessage
+from typing import Literal
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk
 from app.agents.graph import graph
-from app.core.database import get_session
+from app.core.database import get_session, async_session
 from sqlmodel.ext.asyncio.session import AsyncSession
 from app.services.chat import ChatService
+from app.services.generation import Generation, TooManyGenerations, HEARTBEAT, generation_registry
+import asyncio
 import json
+import time
 from typing import AsyncGenerator
 from app.core.logger import logger
-from datetime import datetime, timezone
+from app.core.config import settings
+from app.core.sse import coalesce_events, format_sse
+from app.core.incremental import create_patch_parser, FANOUT_TAG
+from app.core.patching import EDIT_TAG
+from app.core.context import init_context
+from app.core.reasoning import ThinkTagSplitter, strip_reasoning
+from app.core.cache import generation_cache
+from app.core.compaction import split_at_summary, count_turns, should_compact, summary_message, schedule_compaction
+from app.core.llm import llm_registry, upstream_busy
+from app.core.datasets import parse_upload, save_columns, DatasetError
+from datetime import datetime
 
 router = APIRouter()
 
@@ -22,8 +36,20 @@ class ChatRequest(BaseModel):
     context: dict = {}
     parent_id: int | None = None
     is_retry: bool = False
+    # Coalescing window for streamed content events; None uses SSE_FLUSH_MS, 0 = one frame per token
+    stream_flush_ms: int | None = None
+    # Detached: return the generation id immediately and run in the background until done or
+    # cancelled; output is read from /generations/{id}/events
+    detached: bool = False
+    # Skip the generation cache lookup (retries always do)
+    bypass_cache: bool = False
+    # Thinking level for this request; None uses THINKING_VERBOSITY
+    thinking_verbosity: Literal["normal", "concise", "verbose"] | None = None
 
-async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenerator[str, None]:
+def stored_reasoning(reasoning: str) -> str | None:
+    return (reasoning.strip() or None) if settings.REASONING_STORE == "separate" else None
+
+async def event_generator(request: ChatRequest, db: AsyncSession, on_llm_queue=None) -> AsyncGenerator[tuple[str, dict], None]:
     chat_service = ChatService(db)
     
     # 1. Manage Session
@@ -31,17 +57,16 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
     if not session_id:
         chat_session = await chat_service.create_session(title=request.prompt[:30])
         session_id = chat_session.id
-        yield f"event: session_created\ndata: {json.dumps({'session_id': session_id})}\n\n"
+        yield "session_created", {'session_id': session_id}
     
-    # 2. Load History for context reconstruction
-    all_history = await chat_service.get_history(session_id)
-    history_map = {msg.id: msg for msg in all_history}
-
-    # 3. Manage User Message
-    last_user_msg_id = None
+    # 2. Manage User Message
     if request.is_retry and request.parent_id:
         # If retrying, the parent_id IS the user message we are retrying
+        retried_msg = await chat_service.get_message(request.parent_id)
         last_user_msg_id = request.parent_id
+        user_turn_index = retried_msg.turn_index if retried_msg else 0
+        # Context is the branch leading up to the retried message
+        branch_leaf_id = retried_msg.parent_id if retried_msg else None
     else:
         # Save new User Message
         user_msg = await chat_service.add_message(
@@ -50,37 +75,44 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
             parent_id=request.parent_id
         )
         last_user_msg_id = user_msg.id
+        user_turn_index = user_msg.turn_index
+        branch_leaf_id = request.parent_id
     
-    yield f"event: message_created\ndata: {json.dumps({'id': last_user_msg_id, 'role': 'user', 'turn_index': (user_msg.turn_index if not request.is_retry else history_map[last_user_msg_id].turn_index) if last_user_msg_id in history_map or not request.is_retry else 0})}\n\n"
+    yield "message_created", {'id': last_user_msg_id, 'role': 'user', 'turn_index': user_turn_index}
     
-    # Group messages by turn_index and pick the latest of each
-    turn_to_latest = {}
-    for msg in all_history:
-        t = msg.turn_index or 0
-        if t not in turn_to_latest or msg.id > turn_to_latest[t].id:
-            turn_to_latest[t] = msg
-
-    # Identify the relevant turn range
-    import time
+    # 3. Load only the active branch for context reconstruction
     start_time = time.time()
-    
-    max_turn = -1
-    if request.parent_id and (request.parent_id in history_map):
-        max_turn = history_map[request.parent_id].turn_index
-        if request.is_retry:
-            max_turn -= 1
-
-    branch_messages = []
-    for t in range(max_turn + 1):
-        if t in turn_to_latest:
-            branch_messages.append(turn_to_latest[t])
+
+    branch_messages = await chat_service.get_branch_history(
+        session_id, branch_leaf_id, max_turns=settings.HISTORY_MAX_TURNS
+    )
     
     logger.info(f"⏱️ History assembly took {(time.time() - start_time) * 1000:.2f}ms, {len(branch_messages)} messages")
     
     from langchain_core.messages import AIMessage, HumanMessage
 
-    formatted_history = []
+    # Diagrams live in the artifact store; history only carries references to them
+    branch_artifacts = await chat_service.get_artifacts([m.id for m in branch_messages if m.role == "assistant"])
+    latest_artifacts = {}
     for msg in branch_messages:
+        for artifact in branch_artifacts.get(msg.id, []):
+            latest_artifacts[artifact.agent] = artifact.content
+
+    # Datasets attached to the session: the chart agent sees their schema, never the rows
+    datasets = [d.model_dump(exclude={"created_at"}) for d in await chat_service.get_datasets(session_id)]
+
+    # Turns folded into the running summary are replaced by it
+    summary = await chat_service.get_summary(session_id, branch_leaf_id) if settings.COMPACTION_TRIGGER_TURNS else None
+    recent_messages = split_at_summary(branch_messages, summary)
+    pending_turns = count_turns(recent_messages)
+    if summary and len(recent_messages) == len(branch_messages):
+        # The summary's anchor is older than the history window: count from its turn index
+        anchor = await chat_service.get_message(summary.through_message_id)
+        if anchor:
+            pending_turns = (user_turn_index - anchor.turn_index - 1) // 2
+
+    formatted_history = [summary_message(summary)] if summary else []
+    for msg in recent_messages:
         if msg.role == "user":
             if msg.images:
                 human_content = [{"type": "text", "text": msg.content}]
@@ -91,11 +123,13 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                 formatted_history.append(HumanMessage(content=msg.content))
         elif msg.role == "assistant":
             # Augment assistant message with tool inputs/outputs for better context
-            content = msg.content or ""
+            # (reasoning is never sent back; older messages may still have it inline)
+            content = strip_reasoning(msg.content or "")
             if msg.steps:
                 execution_details = []
                 last_tool_desc = ""
                 agent_name = msg.agent or "general"
+                artifacts = iter(branch_artifacts.get(msg.id, []))
                 
                 # Format steps following user suggestion
                 for s in msg.steps:
@@ -104,15 +138,18 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                         execution_details.append(details_line)
                     elif s["type"] == "tool_start":
                         last_tool_desc = f"toolName: {s['name']}, toolArgs: {s.get('content', '')}"
-                    elif s["type"] == "tool_end" and last_tool_desc:
-                        output = s.get('content', '')
-                        # Combine start and end into a single execution line
-                        execution_details.append(f"{last_tool_desc}, toolsOutput: {output}")
-                        last_tool_desc = ""
                     elif s["type"] == "tool_end":
-                         # Fallback if no tool_start found
-                         output = s.get('content', '')
-                         execution_details.append(f"toolName: {s['name']}, toolsOutput: {output}")
+                        output = s.get('content', '')
+                        artifact = next(artifacts, None) if s.get("artifact") else None
+                        if artifact:
+                            output = artifact.reference()
+                        if last_tool_desc:
+                            # Combine start and end into a single execution line
+                            execution_details.append(f"{last_tool_desc}, toolsOutput: {output}")
+                            last_tool_desc = ""
+                        else:
+                            # Fallback if no tool_start found
+                            execution_details.append(f"toolName: {s['name']}, toolsOutput: {output}")
                 
                 if last_tool_desc:
                     execution_details.append(last_tool_desc)
@@ -146,13 +183,35 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
     inputs = {
         "messages": full_messages,
     }
+
+    # Shared by every graph node and tool of this run
+    init_context(
+        session_id=session_id,
+        bypass_cache=request.bypass_cache or request.is_retry,
+        on_llm_queue=on_llm_queue,
+        thinking_verbosity=request.thinking_verbosity,
+        # agent -> latest diagram on this branch, the only copy agents see in full
+        artifacts=latest_artifacts,
+        datasets=datasets
+    )
     
     full_response_content = ""
     accumulated_steps = []
+    # (agent, diagram) produced this turn, stored once the assistant message exists
+    turn_artifacts = []
     selected_agent = None
+    routing_source = None
     
     # Buffer to capture raw streamed content (including thoughts) for the current tool logic
     current_tool_content = ""
+    # Incremental parser turning the tool's raw stream into diagram_patch events
+    patch_parser = None
+    # <think> reasoning is split off both streams and sent as "reasoning" events
+    splitters = {"thought": ThinkTagSplitter(), "tool_code": ThinkTagSplitter()}
+    full_reasoning = ""
+    # Concurrent sub-generations of the current tool (FANOUT_TAG), buffered per run id
+    fanout_buffers: dict[str, str] = {}
+    fanout_header_sent = False
     
     logger.info(f"🚀 Starting LLM stream with {len(full_messages)} messages, is_retry={request.is_retry}")
     
@@ -173,10 +232,16 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                     if event_type == "on_chain_end":
                         # The router returns {"intent": "..."}
                         output = data.get("output")
-                        if output and "intent" in output:
+                        if isinstance(output, dict) and "intent" in output:
                             intent = output["intent"]
                             selected_agent = intent
-                            yield f"event: agent_selected\ndata: {json.dumps({'agent': intent, 'session_id': session_id})}\n\n"
+                            routing_source = output.get("routing_source")
+                            yield "agent_selected", {
+                                'agent': intent,
+                                'latency_ms': output.get("routing_ms"),
+                                'source': output.get("routing_source"),
+                                'session_id': session_id
+                            }
                             
                             # Also add a pseudo-step for history
                             accumulated_steps.append({
@@ -185,26 +250,70 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                                 "status": "done",
                                 "timestamp": int(datetime.utcnow().timestamp() * 1000)
                             })
+
+                            # Committed speculative agent output was buffered, flush it now
+                            for msg in output.get("messages", []):
+                                if isinstance(msg.content, str) and msg.content:
+                                    full_response_content += msg.content
+                                    yield "thought", {'content': msg.content, 'session_id': session_id}
                     continue # Skip all other events from "router" node
 
+                # Fan-out branches would interleave token by token: each is forwarded whole when it ends
+                if FANOUT_TAG in event.get("tags", []):
+                    run_id = event.get("run_id", "")
+                    if event_type == "on_chat_model_stream":
+                        chunk = data.get("chunk")
+                        if chunk and isinstance(chunk.content, str):
+                            fanout_buffers[run_id] = fanout_buffers.get(run_id, "") + chunk.content
+                        continue
+                    if event_type != "on_chat_model_end":
+                        continue
+                    content = fanout_buffers.pop(run_id, "")
+                    if metadata.get("fanout_header") and not fanout_header_sent:
+                        content = metadata["fanout_header"] + content
+                        fanout_header_sent = True
+                    event_type, data = "on_chat_model_stream", {"chunk": AIMessageChunk(content=content + "\n\n")}
+
                 if event_type == "on_chat_model_stream":
+                    # Edit-mode patches are applied server-side; only the result (tool_end) is sent
+                    if EDIT_TAG in event.get("tags", []):
+                        continue
                     chunk = data.get("chunk")
                     if chunk:
-                        content = chunk.content
-                        if content:
-                            is_tool_stream = node_name.endswith("_tools")
-                            if is_tool_stream:
+                        is_tool_stream = node_name.endswith("_tools")
+                        channel = "tool_code" if is_tool_stream else "thought"
+
+                        # Reasoning models that report it out of band (e.g. deepseek-reasoner)
+                        reasoning = getattr(chunk, "additional_kwargs", {}).get("reasoning_content")
+                        if reasoning:
+                            full_reasoning += reasoning
+                            yield "reasoning", {'content': reasoning, 'channel': channel, 'session_id': session_id}
+
+                        fragments = splitters[channel].feed(chunk.content) if chunk.content else []
+                        for is_reasoning, content in fragments:
+                            if is_reasoning:
+                                full_reasoning += content
+                                yield "reasoning", {'content': content, 'channel': channel, 'session_id': session_id}
+                            elif is_tool_stream:
                                 current_tool_content += content
-                                yield f"event: tool_code\ndata: {json.dumps({'content': content, 'session_id': session_id})}\n\n"
+                                yield "tool_code", {'content': content, 'session_id': session_id}
+
+                                if patch_parser is None:
+                                    patch_parser = create_patch_parser(node_name) or False
+                                if patch_parser:
+                                    agent_name, parser = patch_parser
+                                    patches = parser.feed(content)
+                                    if patches:
+                                        yield "diagram_patch", {'agent': agent_name, 'patches': patches, 'session_id': session_id}
                             else:
                                 full_response_content += content
-                                yield f"event: thought\ndata: {json.dumps({'content': content, 'session_id': session_id})}\n\n"
+                                yield "thought", {'content': content, 'session_id': session_id}
                         
                         if hasattr(chunk, 'tool_call_chunks'):
                             for tool_chunk in chunk.tool_call_chunks or []:
                                 if tool_chunk and tool_chunk.get('args'):
                                     args_chunk = tool_chunk['args']
-                                    yield f"event: tool_args_stream\ndata: {json.dumps({'args': args_chunk, 'session_id': session_id})}\n\n"
+                                    yield "tool_args_stream", {'args': args_chunk, 'session_id': session_id}
 
                 elif event_type == "on_tool_start":
                     # Filter out internal LangChain/OpenAI calls that are mistakenly reported as tools in v1
@@ -216,6 +325,10 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                     
                     # Reset buffer for new tool
                     current_tool_content = ""
+                    patch_parser = None
+                    splitters["tool_code"] = ThinkTagSplitter()
+                    fanout_buffers.clear()
+                    fanout_header_sent = False
                     
                     step = {
                         "type": "tool_start",
@@ -225,7 +338,7 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                         "timestamp": int(datetime.utcnow().timestamp() * 1000)
                     }
                     accumulated_steps.append(step)
-                    yield f"event: tool_start\ndata: {json.dumps({'tool': event['name'], 'input': data.get('input'), 'session_id': session_id})}\n\n"
+                    yield "tool_start", {'tool': event['name'], 'input': data.get('input'), 'session_id': session_id}
 
                 elif event_type == "on_tool_end":
                     output = data.get('output')
@@ -236,24 +349,40 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                     
                     # Update steps
                     if accumulated_steps:
-                        # If we captured raw content (with thoughts), use it for persistence
-                        # fallback to output (cleaned) if no stream was captured (e.g. cache or simple tool)
-                        final_content = current_tool_content if current_tool_content else (output if isinstance(output, str) else json.dumps(output))
+                        # Persist the tool's output: it is validated/repaired (and laid out or compiled)
+                        # after the raw stream; fall back to the stream if there's no text output
+                        if isinstance(output, str) and output:
+                            final_content = output
+                        else:
+                            final_content = current_tool_content if current_tool_content else json.dumps(output)
                         
-                        accumulated_steps.append({
+                        step = {
                             "type": "tool_end",
                             "name": event["name"],
                             "content": final_content,
                             "status": "done",
                             "timestamp": int(datetime.utcnow().timestamp() * 1000)
-                        })
+                        }
+                        if selected_agent and selected_agent != "general" and isinstance(output, str) \
+                                and output.strip() and not output.startswith("Error"):
+                            turn_artifacts.append((selected_agent, output.strip()))
+                            step["artifact"] = True
+                        accumulated_steps.append(step)
                         for s in reversed(accumulated_steps):
                             if s["type"] == "tool_start" and s["status"] == "running":
                                 s["status"] = "done"
                                 break
 
-                    yield f"event: tool_end\ndata: {json.dumps({'output': output, 'session_id': session_id})}\n\n"
+                    yield "tool_end", {'output': output, 'session_id': session_id}
             
+            # A partial tag held back at the very end is plain text after all
+            for is_reasoning, content in splitters["thought"].flush():
+                if is_reasoning:
+                    full_reasoning += content
+                else:
+                    full_response_content += content
+                    yield "thought", {'content': content, 'session_id': session_id}
+
             # 4. Save Assistant Message (Normal completion)
             if full_response_content or accumulated_steps:
                 assistant_msg = await chat_service.add_message(
@@ -261,10 +390,16 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                     full_response_content, 
                     steps=accumulated_steps,
                     agent=selected_agent,
-                    parent_id=last_user_msg_id
+                    routing_source=routing_source,
+                    parent_id=last_user_msg_id,
+                    reasoning=stored_reasoning(full_reasoning)
                 )
                 assistant_msg_saved = True
-                yield f"event: message_created\ndata: {json.dumps({'id': assistant_msg.id, 'role': 'assistant', 'turn_index': assistant_msg.turn_index, 'session_id': session_id})}\n\n"
+                await chat_service.add_artifacts(session_id, assistant_msg, turn_artifacts)
+                # Older turns are folded into the summary in the background
+                if should_compact(pending_turns + 1):
+                    schedule_compaction(session_id, assistant_msg.id)
+                yield "message_created", {'id': assistant_msg.id, 'role': 'assistant', 'turn_index': assistant_msg.turn_index, 'session_id': session_id}
                 
         finally:
             import asyncio
@@ -273,13 +408,16 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
                 error_marker = "\n\n[Generation stopped by user/connection lost]"
                 try:
                     # Use asyncio.shield to prevent the save operation from being cancelled
-                    await asyncio.shield(chat_service.add_message(
+                    partial_msg = await asyncio.shield(chat_service.add_message(
                         session_id, "assistant", 
                         full_response_content + error_marker, 
                         steps=accumulated_steps,
                         agent=selected_agent,
-                        parent_id=last_user_msg_id
+                        routing_source=routing_source,
+                        parent_id=last_user_msg_id,
+                        reasoning=stored_reasoning(full_reasoning)
                     ))
+                    await asyncio.shield(chat_service.add_artifacts(session_id, partial_msg, turn_artifacts))
                     logger.info(f"💾 Robust Persistence: Saved partial assistant message for session {session_id}")
                 except Exception as save_err:
                     logger.error(f"Failed to save partial message: {save_err}")
@@ -289,11 +427,117 @@ async def event_generator(request: ChatRequest, db: AsyncSession) -> AsyncGenera
         error_msg = str(e)
         logger.error(f"Error in chat stream: {error_msg}")
         logger.error(traceback.format_exc())
-        yield f"event: error\ndata: {json.dumps({'message': error_msg})}\n\n"
+        busy = upstream_busy(e)
+        if busy:
+            yield "error", {'message': str(busy), 'retry_after': busy.retry_after}
+        else:
+            yield "error", {'message': error_msg}
+
+async def generation_events(request: ChatRequest, generation_id: str) -> AsyncGenerator[tuple[str, dict], None]:
+    # The run outlives the HTTP request, so it owns its database session
+    generation = generation_registry.get(generation_id)
+    # Set once the first turn of a new session has created it (session_created)
+    session = {'id': request.session_id}
+
+    def on_llm_queue(position: int, upstream: str):
+        # Called by the LLM admission controller while this run waits for an upstream slot
+        asyncio.get_running_loop().create_task(
+            generation.publish("queue_position", {'position': position, 'upstream': upstream, 'session_id': session['id']})
+        )
+
+    async with async_session() as db:
+        yield "generation_created", {'generation_id': generation_id, 'session_id': request.session_id}
+        flush_ms = request.stream_flush_ms if request.stream_flush_ms is not None else settings.SSE_FLUSH_MS
+        events = event_generator(request, db, on_llm_queue=on_llm_queue)
+        async for item in coalesce_events(events, flush_ms, settings.SSE_FLUSH_BYTES):
+            if item[0] == "session_created":
+                session['id'] = item[1]['session_id']
+            yield item
+
+async def sse_stream(generation: Generation, last_event_id: int = 0) -> AsyncGenerator[str, None]:
+    async for seq, event, data in generation.subscribe(last_event_id, heartbeat_s=settings.SSE_HEARTBEAT_S):
+        if event == HEARTBEAT:
+            yield ": keep-alive\n\n"
+        else:
+            yield format_sse(event, data, seq)
+
+def start_generation(request: ChatRequest) -> Generation:
+    if llm_registry.saturated():
+        # Every upstream queue is full: reject now instead of failing mid-stream
+        raise HTTPException(
+            status_code=503,
+            detail="LLM upstreams are saturated",
+            headers={"Retry-After": str(settings.LLM_QUEUE_RETRY_AFTER_S)}
+        )
+    try:
+        generation = generation_registry.create(detached=request.detached)
+    except TooManyGenerations as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(settings.GENERATION_RETRY_AFTER_S)}
+        )
+    generation_registry.run(generation, generation_events(request, generation.id))
+    return generation
 
 @router.post("/chat/completions")
-async def chat_completions(request: ChatRequest, db: AsyncSession = Depends(get_session)):
-    return StreamingResponse(event_generator(request, db), media_type="text/event-stream")
+async def chat_completions(request: ChatRequest):
+    generation = start_generation(request)
+    if request.detached:
+        return JSONResponse(
+            status_code=202,
+            content={"generation_id": generation.id, "events_url": f"/api/generations/{generation.id}/events"}
+        )
+    return StreamingResponse(
+        sse_stream(generation),
+        media_type="text/event-stream",
+        headers={"X-Generation-Id": generation.id}
+    )
+
+def get_generation_or_404(generation_id: str) -> Generation:
+    generation = generation_registry.get(generation_id)
+    if not generation:
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
+    return generation
+
+@router.get("/generations/{generation_id}")
+async def get_generation(generation_id: str):
+    generation = get_generation_or_404(generation_id)
+    return {
+        "generation_id": generation.id,
+        "status": generation.status,
+        "detached": generation.detached,
+        "last_event_id": generation.last_seq,
+        "subscribers": generation.subscribers
+    }
+
+@router.get("/generations/{generation_id}/events")
+async def resume_generation(
+    generation_id: str,
+    last_event_id: int | None = None,
+    last_event_id_header: str | None = Header(default=None, alias="Last-Event-ID")
+):
+    """Replays the events after Last-Event-ID (header or query) and keeps tailing the live run."""
+    generation = get_generation_or_404(generation_id)
+
+    cursor = last_event_id
+    if cursor is None and last_event_id_header and last_event_id_header.isdigit():
+        cursor = int(last_event_id_header)
+    return StreamingResponse(sse_stream(generation, cursor or 0), media_type="text/event-stream")
+
+@router.post("/generations/{generation_id}/cancel")
+async def cancel_generation(generation_id: str):
+    get_generation_or_404(generation_id)
+    generation = generation_registry.cancel(generation_id)
+    return {"generation_id": generation.id, "status": generation.status}
+
+@router.get("/cache/stats")
+async def cache_stats():
+    return await generation_cache.stats()
+
+@router.get("/llm/pool")
+async def llm_pool_stats():
+    return llm_registry.stats()
 
 @router.get("/sessions")
 async def list_sessions(db: AsyncSession = Depends(get_session)):
@@ -312,6 +556,55 @@ async def get_session_history(session_id: int, db: AsyncSession = Depends(get_se
         "session": session
     }
 
+async def read_body_limited(request: Request, limit: int) -> bytes:
+    """The request body, rejected (413) as soon as it's known to exceed `limit` bytes."""
+    too_large = HTTPException(status_code=413, detail=f"Datasets are limited to {limit} bytes")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+@router.post("/datasets")
+async def upload_dataset(request: Request, name: str, session_id: int | None = None, db: AsyncSession = Depends(get_session)):
+    """Raw CSV or JSON body. Creates a session named after the file when none is given."""
+    raw = await read_body_limited(request, settings.DATASET_MAX_BYTES)
+
+    chat_service = ChatService(db)
+    if session_id is not None and not await chat_service.get_session(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    # Parsing a large upload is CPU-bound: keep it off the event loop
+    start = time.perf_counter()
+    try:
+        arrays, columns, rows = await asyncio.to_thread(parse_upload, raw, name)
+    except DatasetError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    storage_key = await asyncio.to_thread(save_columns, arrays)
+
+    if session_id is None:
+        session_id = (await chat_service.create_session(title=name)).id
+    dataset = await chat_service.add_dataset(session_id, name, rows, columns, storage_key, len(raw))
+    logger.info(f"📊 Dataset {dataset.id} ({name}): {rows} rows, {len(columns)} columns in {(time.perf_counter() - start) * 1000:.0f}ms")
+    return {"dataset": dataset, "session_id": session_id}
+
+@router.get("/sessions/{session_id}/datasets")
+async def list_datasets(session_id: int, db: AsyncSession = Depends(get_session)):
+    chat_service = ChatService(db)
+    return await chat_service.get_datasets(session_id)
+
+@router.delete("/datasets/{dataset_id}")
+async def delete_dataset(dataset_id: int, db: AsyncSession = Depends(get_session)):
+    chat_service = ChatService(db)
+    if not await chat_service.delete_dataset(dataset_id):
+        raise HTTPException(status_code=404, detail="Dataset not found")
+    return {"status": "success"}
+
 @router.delete("/sessions/{session_id}")
 async def delete_session(session_id: int, db: AsyncSession = Depends(get_session)):
     chat_service = ChatService(db)
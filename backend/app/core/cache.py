@@ -0,0 +1,367 @@
+import functools
+import hashlib
+import math
+import re
+import time
+import zlib
+from collections import OrderedDict
+from datetime import timedelta
+from sqlmodel import select, delete, func
+from app.core.config import settings
+from app.core.context import get_context, get_messages
+from app.core.database import async_session
+from app.core.llm import thinking_verbosity
+from app.core.logger import logger
+from app.models.cache import GenerationCacheEntry
+from app.models.chat import utc_now
+
+
+def normalize_instruction(instruction: str) -> str:
+    return re.sub(r"\s+", " ", (instruction or "").strip().lower())
+
+
+def generation_modes() -> str:
+    """Settings that change a tool's output for the same prompt (graph, edit, layout, IR... modes)."""
+    return "|".join([
+        settings.GRAPH_MODE, settings.EDIT_MODE, settings.FLOW_LAYOUT, settings.DRAWIO_MODE,
+        settings.MINDMAP_MODE, settings.ARTIFACT_VALIDATION,
+    ])
+
+
+def cache_key(agent: str, instruction: str, current_code: str, model: str, temperature, verbosity: str, datasets: str = "", history: str = "") -> str:
+    """Content address of one tool generation."""
+    code_hash = hashlib.sha256((current_code or "").encode("utf-8")).hexdigest()
+    parts = [agent, normalize_instruction(instruction), code_hash, model or "", str(temperature), verbosity or "", generation_modes()]
+    if datasets:
+        parts.append(datasets)
+    if history:
+        parts.append(history)
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """In-process LRU with per-entry TTL."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, agent: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl_s, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def size(self) -> int:
+        return len(self._entries)
+
+
+class PostgresCacheBackend:
+    """
+    Shared cache in the `generation_cache` table, so hits survive restarts and are shared
+    between workers. LRU order is tracked with last_hit_at.
+    """
+
+    name = "postgres"
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+
+    async def get(self, key: str) -> str | None:
+        async with async_session() as session:
+            entry = await session.get(GenerationCacheEntry, key)
+            if entry is None:
+                return None
+            now = utc_now()
+            if entry.expires_at < now:
+                await session.delete(entry)
+                await session.commit()
+                return None
+            entry.last_hit_at = now
+            entry.hits += 1
+            session.add(entry)
+            await session.commit()
+            return entry.value
+
+    async def set(self, key: str, agent: str, value: str):
+        now = utc_now()
+        async with async_session() as session:
+            await session.merge(GenerationCacheEntry(
+                key=key, agent=agent, value=value, created_at=now, last_hit_at=now,
+                expires_at=now + timedelta(seconds=self.ttl_s)
+            ))
+            await session.execute(delete(GenerationCacheEntry).where(GenerationCacheEntry.expires_at < now))
+            # Evict least recently used entries beyond the limit
+            stale = (
+                select(GenerationCacheEntry.key)
+                .order_by(GenerationCacheEntry.last_hit_at.desc())
+                .offset(self.max_entries)
+            )
+            await session.execute(delete(GenerationCacheEntry).where(GenerationCacheEntry.key.in_(stale)))
+            await session.commit()
+
+    async def size(self) -> int:
+        async with async_session() as session:
+            result = await session.execute(select(func.count()).select_from(GenerationCacheEntry))
+            return result.scalar_one()
+
+
+class GenerationCache:
+    """Exact-match cache of diagram tool outputs with hit/miss counters per agent."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.counters: dict[str, dict[str, int]] = {}
+
+    def _count(self, agent: str, outcome: str):
+        counters = self.counters.setdefault(agent, {"hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0})
+        counters[outcome] += 1
+
+    def record_bypass(self, agent: str):
+        self._count(agent, "bypassed")
+
+    def record_semantic_hit(self, agent: str):
+        # The exact lookup already counted a miss; reclassify it
+        self.counters[agent]["misses"] -= 1
+        self._count(agent, "semantic_hits")
+
+    async def get(self, agent: str, key: str) -> str | None:
+        if self.backend is None:
+            return None
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Generation cache lookup failed: {e}")
+            value = None
+        self._count(agent, "hits" if value is not None else "misses")
+        return value
+
+    async def set(self, agent: str, key: str, value: str):
+        if self.backend is None or not value:
+            return
+        try:
+            await self.backend.set(key, agent, value)
+        except Exception as e:
+            logger.warning(f"Generation cache store failed: {e}")
+
+    async def stats(self) -> dict:
+        totals = {"hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0}
+        for counters in self.counters.values():
+            for outcome, count in counters.items():
+                totals[outcome] += count
+        lookups = totals["hits"] + totals["semantic_hits"] + totals["misses"]
+        return {
+            "backend": self.backend.name if self.backend else "off",
+            "entries": await self.backend.size() if self.backend else 0,
+            "semantic_entries": semantic_cache.size(),
+            **totals,
+            "hit_rate": round((totals["hits"] + totals["semantic_hits"]) / lookups, 4) if lookups else 0.0,
+            "agents": self.counters,
+        }
+
+
+# --- Semantic (near-duplicate) cache -------------------------------------------------
+
+# Filler words that say "make me a diagram" rather than what the diagram is about
+STOP_WORDS = {
+    "a", "an", "the", "as", "of", "for", "to", "me", "please", "draw", "create", "make",
+    "generate", "show", "diagram", "chart", "flow", "flowchart", "process", "with", "and",
+    "in", "on", "my", "us", "i", "can", "you",
+}
+ZH_FILLER = re.compile("请|帮我|画|生成|制作|一个|一张|的|流程图|流程|图表|图")
+EMBEDDING_DIMS = 4096
+# Tokens that must match exactly: "3 steps" vs "5 steps" or "with" vs "without" embed
+# almost identically but ask for a different diagram
+GUARD_TOKENS = re.compile(
+    r"\d+(?:\.\d+)?|[零一二三四五六七八九十百千万两]+"
+    r"|\b(?:no|not|non|none|nothing|never|without|except|excluding|exclude)\b|n't\b"
+    r"|不|没|无|非|别|除了"
+)
+
+
+def guard_tokens(text: str) -> tuple[str, ...]:
+    return tuple(sorted(GUARD_TOKENS.findall(ZH_FILLER.sub(" ", text.lower()))))
+
+
+def embed(text: str) -> dict[int, float]:
+    """
+    Local hashing embedding: word features plus char trigrams (CJK runs use char bigrams),
+    hashed into EMBEDDING_DIMS buckets and L2-normalized. Returned sparse.
+    """
+    text = ZH_FILLER.sub(" ", text.lower())
+    vector: dict[int, float] = {}
+
+    def add(feature: str, weight: float = 1.0):
+        bucket = zlib.crc32(feature.encode("utf-8")) % EMBEDDING_DIMS
+        vector[bucket] = vector.get(bucket, 0.0) + weight
+
+    for word in re.findall(r"[\u4e00-\u9fff]+|\w+", text):
+        if word in STOP_WORDS:
+            continue
+        if "\u4e00" <= word[0] <= "\u9fff":
+            for i in range(max(1, len(word) - 1)):
+                add("w:" + word[i:i + 2], 2.0)
+            continue
+        add("w:" + word, 2.0)
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            add("c:" + padded[i:i + 3])
+
+    norm = math.sqrt(sum(x * x for x in vector.values()))
+    return {k: x / norm for k, x in vector.items()} if norm else {}
+
+
+def cosine(a: dict[int, float], b: dict[int, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(x * b.get(k, 0.0) for k, x in a.items())
+
+
+class SemanticCache:
+    """
+    Nearest-neighbour index of first-turn generations, one per agent (and model settings).
+    A linear scan over sparse vectors is plenty for a few thousand entries; the oldest
+    entries are evicted first. Only entries with the same numbers and negations
+    (guard_tokens) are candidates.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._indexes: dict[str, OrderedDict[str, tuple[dict[int, float], tuple[str, ...], str]]] = {}
+
+    def lookup(self, index: str, text: str, threshold: float) -> tuple[float, str] | None:
+        vector = embed(text)
+        entries = self._indexes.get(index)
+        if not vector or not entries:
+            return None
+        guards = guard_tokens(text)
+        best = max(
+            ((cosine(vector, v), key) for key, (v, g, _) in entries.items() if g == guards),
+            default=None
+        )
+        if best is None or best[0] < threshold:
+            return None
+        entries.move_to_end(best[1])
+        return best[0], entries[best[1]][2]
+
+    def add(self, index: str, text: str, value: str):
+        vector = embed(text)
+        if not vector:
+            return
+        entries = self._indexes.setdefault(index, OrderedDict())
+        entries[normalize_instruction(text)] = (vector, guard_tokens(text), value)
+        entries.move_to_end(normalize_instruction(text))
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def size(self) -> int:
+        return sum(len(entries) for entries in self._indexes.values())
+
+
+semantic_cache = SemanticCache(settings.GENERATION_CACHE_MAX_ENTRIES)
+
+
+def _text(content) -> str:
+    if isinstance(content, list):
+        return " ".join(p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text")
+    return str(content or "")
+
+
+def latest_user_prompt(default: str) -> str:
+    for msg in reversed(get_messages()):
+        if msg.type == "human":
+            return _text(msg.content) or default
+    return default
+
+
+def history_digest() -> str:
+    """
+    Digest of the conversation before the latest user prompt ("" on a first turn): follow-ups
+    such as "make it blue" only mean the same thing after the same history.
+    """
+    messages = get_messages()
+    latest = next((i for i in range(len(messages) - 1, -1, -1) if messages[i].type == "human"), 0)
+    earlier = [f"{msg.type}:{_text(msg.content)}" for msg in messages[:latest]]
+    return hashlib.sha256("\x1e".join(earlier).encode("utf-8")).hexdigest() if earlier else ""
+
+
+def create_backend():
+    kind = settings.GENERATION_CACHE.lower()
+    if kind == "memory":
+        return MemoryCacheBackend(settings.GENERATION_CACHE_MAX_ENTRIES, settings.GENERATION_CACHE_TTL_S)
+    if kind == "postgres":
+        return PostgresCacheBackend(settings.GENERATION_CACHE_MAX_ENTRIES, settings.GENERATION_CACHE_TTL_S)
+    return None
+
+
+generation_cache = GenerationCache(create_backend())
+
+
+def cached_tool(agent: str, llm):
+    """
+    Decorator for a diagram tool `async def tool(instruction)`: returns the stored output
+    for an identical (agent, instruction, current_code, conversation history, model,
+    temperature, verbosity, generation modes) generation. First-turn generations (no
+    history, no current_code) also fall back to the semantic cache, matched on the user's
+    prompt. Requests with `bypass_cache` in the context (e.g. an explicit retry) always run
+    the tool, and refresh the stored entries. "Error: ..." results are never stored.
+    Goes between @tool and the function.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(instruction: str):
+            context = get_context()
+            current_code = context.get("current_code", "")
+            model = getattr(llm, "model_name", "")
+            temperature = getattr(llm, "temperature", None)
+            verbosity = thinking_verbosity()
+            # Charts bound to session datasets depend on which datasets are attached
+            datasets = ",".join(str(d["id"]) for d in context.get("datasets") or []) if agent == "charts" else ""
+            history = history_digest()
+            key = cache_key(agent, instruction, current_code, model, temperature, verbosity, datasets, history)
+
+            use_semantic = (
+                generation_cache.backend is not None and not history and not current_code
+                and settings.SEMANTIC_CACHE_THRESHOLD > 0
+            )
+            semantic_index = f"{agent}|{model}|{temperature}|{verbosity}|{generation_modes()}" + (f"|{datasets}" if datasets else "")
+            prompt = latest_user_prompt(instruction)
+
+            if context.get("bypass_cache"):
+                generation_cache.record_bypass(agent)
+            else:
+                cached = await generation_cache.get(agent, key)
+                if cached is not None:
+                    logger.info(f"⚡ Generation cache hit ({agent})")
+                    return cached
+                if use_semantic:
+                    match = semantic_cache.lookup(semantic_index, prompt, settings.SEMANTIC_CACHE_THRESHOLD)
+                    if match:
+                        generation_cache.record_semantic_hit(agent)
+                        logger.info(f"⚡ Semantic cache hit ({agent}, similarity {match[0]:.2f})")
+                        return match[1]
+
+            result = await fn(instruction)
+            # Failures come back as "Error: ..." text; replaying them would pin the failure for the TTL
+            if isinstance(result, str) and result and not result.startswith("Error:"):
+                await generation_cache.set(agent, key, result)
+                if use_semantic:
+                    semantic_cache.add(semantic_index, prompt, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,167 @@
+import asyncio
+import re
+from langchain_core.messages import SystemMessage, HumanMessage
+from app.core.config import settings
+from app.core.database import async_session
+from app.core.llm import get_llm, llm_priority, PRIORITY_BULK
+from app.core.logger import logger
+from app.core.tokens import count_text_tokens, truncate_text
+from app.models.chat import ChatMessage, ConversationSummary
+from app.services.chat import ChatService
+
+SUMMARY_HEADER = "### Conversation Summary (earlier turns)"
+OMITTED_LINE = "- (earlier turns omitted)"
+# Characters kept from each prompt / reply in the extractive digest
+EXCERPT_CHARS = 200
+
+_THINK = re.compile(r"<think>[\s\S]*?(</think>|$)")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])")
+
+SUMMARY_PROMPT = """You maintain the running summary of a conversation with a diagramming assistant.
+Merge the previous summary and the new turns into one updated summary, as a bullet list:
+what the user asked for, which diagrams were produced (keep the artifact references such as
+[artifact drawio v3, ...] verbatim), decisions and preferences that still apply.
+Drop chit-chat and superseded details. Be concise. Output ONLY the bullet list."""
+
+_tasks: dict[int, asyncio.Task] = {}
+
+
+def excerpt(text: str, limit: int = EXCERPT_CHARS) -> str:
+    """First sentence of a message (without reasoning or the execution trace), on one line."""
+    text = _THINK.sub("", text or "").split("### Execution Trace:")[0]
+    text = " ".join(text.split())
+    parts = _SENTENCE_END.split(text, maxsplit=1)
+    text = parts[0] if parts else text
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def split_at_summary(messages: list[ChatMessage], summary: ConversationSummary | None) -> list[ChatMessage]:
+    """
+    The messages of the branch that come after the summary. Without the anchor among them
+    (it is older than the history window) all of them do.
+    """
+    if summary is None:
+        return messages
+    for i, msg in enumerate(messages):
+        if msg.id == summary.through_message_id:
+            return messages[i + 1:]
+    return messages
+
+
+def count_turns(messages: list[ChatMessage]) -> int:
+    return sum(1 for m in messages if m.role == "user")
+
+
+def should_compact(turns: int) -> bool:
+    """`turns` since the last summary, including the one just completed."""
+    return settings.COMPACTION_TRIGGER_TURNS > 0 and turns > settings.COMPACTION_TRIGGER_TURNS
+
+
+def summary_message(summary: ConversationSummary) -> SystemMessage:
+    return SystemMessage(content=f"{SUMMARY_HEADER}\n{summary.content}")
+
+
+def turns_to_fold(recent: list[ChatMessage]) -> list[ChatMessage]:
+    """Everything but the last COMPACTION_KEEP_TURNS turns (complete turns only)."""
+    starts = [i for i, m in enumerate(recent) if m.role == "user"]
+    keep = settings.COMPACTION_KEEP_TURNS
+    if keep <= 0:
+        return recent
+    if len(starts) <= keep:
+        return []
+    return recent[:starts[-keep]]
+
+
+def digest(messages: list[ChatMessage], artifacts: dict) -> list[str]:
+    lines = []
+    for msg in messages:
+        if msg.role == "user":
+            images = f" [{len(msg.images)} image(s)]" if msg.images else ""
+            lines.append(f"- User: {excerpt(msg.content)}{images}")
+            continue
+        produced = ", ".join(a.reference() for a in artifacts.get(msg.id, []))
+        reply = excerpt(msg.content)
+        line = f"  Assistant ({msg.agent or 'general'})"
+        if reply:
+            line += f": {reply}"
+        if produced:
+            line += f" -> {produced}"
+        lines.append(line)
+    return lines
+
+
+def extractive_summary(previous: str, lines: list[str], budget: int) -> str:
+    """Appends the new digest lines, dropping the oldest ones once over budget."""
+    lines = [l for l in previous.split("\n") if l and l != OMITTED_LINE] + lines
+    omitted = False
+    while len(lines) > 1 and count_text_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+        omitted = True
+    if omitted:
+        lines.insert(0, OMITTED_LINE)
+    return "\n".join(lines)
+
+
+async def llm_summary(previous: str, lines: list[str], budget: int) -> str:
+    llm = get_llm(role="summary")
+    prompt = [
+        SystemMessage(content=SUMMARY_PROMPT),
+        HumanMessage(content=f"PREVIOUS SUMMARY:\n{previous or '(none)'}\n\nNEW TURNS:\n" + "\n".join(lines)),
+    ]
+    # Background work, admitted after interactive requests
+    with llm_priority(PRIORITY_BULK):
+        response = await llm.ainvoke(prompt)
+    content = _THINK.sub("", str(response.content)).strip()
+    if not content:
+        raise ValueError("empty summary")
+    return truncate_text(content, budget)
+
+
+async def compact(session_id: int, leaf_id: int):
+    """Folds the older turns of the branch ending at leaf_id into a new running summary."""
+    async with async_session() as db:
+        chat_service = ChatService(db)
+        summary = await chat_service.get_summary(session_id, leaf_id)
+        # Only the turns after the summary are loaded, down to its anchor
+        since_id = summary.through_message_id if summary else None
+        branch = await chat_service.get_branch_history(session_id, leaf_id, since_id=since_id)
+        if summary and (not branch or branch[0].id != since_id):
+            # Anchor not reached: nothing new to fold rather than refolding covered turns
+            return
+        folded = turns_to_fold(split_at_summary(branch, summary))
+        if not folded:
+            return
+
+        artifacts = await chat_service.get_artifacts([m.id for m in folded if m.role == "assistant"])
+        lines = digest(folded, artifacts)
+        previous = summary.content if summary else ""
+        budget = settings.COMPACTION_SUMMARY_TOKENS
+
+        content = None
+        if settings.COMPACTION_MODE == "llm":
+            try:
+                content = await llm_summary(previous, lines, budget)
+            except Exception as e:
+                logger.warning(f"🗜️ LLM compaction failed ({e}), using extractive summary")
+        if content is None:
+            content = extractive_summary(previous, lines, budget)
+
+        turns = (summary.turns if summary else 0) + count_turns(folded)
+        await chat_service.add_summary(session_id, folded[-1].id, turns, content)
+        logger.info(f"🗜️ Compacted session {session_id}: {turns} turns in {count_text_tokens(content)} tokens")
+
+
+def schedule_compaction(session_id: int, leaf_id: int):
+    """Runs compaction off the request path; at most one run per session at a time."""
+    if session_id in _tasks:
+        return
+
+    async def run():
+        try:
+            await compact(session_id, leaf_id)
+        except Exception as e:
+            logger.error(f"🗜️ Compaction of session {session_id} failed: {e}")
+        finally:
+            _tasks.pop(session_id, None)
+
+    _tasks[session_id] = asyncio.create_task(run())
@@ -21,6 +21,9 @@ class Settings:
 
     MAX_TOKENS: int = int(os.getenv("MAX_TOKENS", 1024*16))
 
+    # History window: number of most recent turns sent as context (0 = whole branch)
+    HISTORY_MAX_TURNS: int = int(os.getenv("HISTORY_MAX_TURNS", 0))
+
     # DeepSeek
     DEEPSEEK_API_KEY: str = os.getenv("DEEPSEEK_API_KEY", "")
     DEEPSEEK_BASE_URL: str = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
@@ -28,7 +31,113 @@ class Settings:
     # Model Selection
     MODEL_ID: str = os.getenv("MODEL_ID", "")
     
+    # SSE: merge consecutive content events for up to this many ms / bytes (0 ms = one frame per token)
+    SSE_FLUSH_MS: int = int(os.getenv("SSE_FLUSH_MS", 40))
+    SSE_FLUSH_BYTES: int = int(os.getenv("SSE_FLUSH_BYTES", 4096))
+
+    # Resumable generations: events kept per generation for Last-Event-ID replay, how long a
+    # run survives without any connected client, and how long finished runs stay replayable
+    GENERATION_BUFFER_SIZE: int = int(os.getenv("GENERATION_BUFFER_SIZE", 2048))
+    GENERATION_RESUME_GRACE_S: float = float(os.getenv("GENERATION_RESUME_GRACE_S", 30))
+    GENERATION_RETENTION_S: float = float(os.getenv("GENERATION_RETENTION_S", 300))
+
+    # Background generation runner: max concurrent runs (0 = unlimited), Retry-After hint
+    # when the cap is hit, and SSE keep-alive interval for proxies with short idle timeouts
+    MAX_CONCURRENT_GENERATIONS: int = int(os.getenv("MAX_CONCURRENT_GENERATIONS", 32))
+    GENERATION_RETRY_AFTER_S: int = int(os.getenv("GENERATION_RETRY_AFTER_S", 5))
+    SSE_HEARTBEAT_S: float = float(os.getenv("SSE_HEARTBEAT_S", 15))
+
+    # Diagram edits: "patch" asks the model for a compact patch against the current diagram
+    # (falling back to full regeneration if it doesn't apply), "full" always regenerates
+    EDIT_MODE: str = os.getenv("EDIT_MODE", "patch")
+
+    # Flowchart node positions: "server" (layered auto-layout, the model only emits topology)
+    # or "model" (the model computes coordinates)
+    FLOW_LAYOUT: str = os.getenv("FLOW_LAYOUT", "server")
+
+    # draw.io generation: "ir" (the model emits a compact JSON description that the server
+    # lays out and compiles to XML) or "xml" (the model writes the mxGraph XML itself)
+    DRAWIO_MODE: str = os.getenv("DRAWIO_MODE", "ir")
+
+    # New mindmaps: "fanout" (outline first, then each main branch expanded by its own call,
+    # MINDMAP_FANOUT_CONCURRENCY at a time) or "single" (one sequential stream)
+    MINDMAP_MODE: str = os.getenv("MINDMAP_MODE", "fanout")
+    MINDMAP_FANOUT_CONCURRENCY: int = int(os.getenv("MINDMAP_FANOUT_CONCURRENCY", 4))
+
+    # Chart datasets: uploads are parsed into NumPy columns under DATASET_DIR; bound charts
+    # get at most CHART_MAX_POINTS points per series (LTTB) and CHART_MAX_GROUPS groups
+    DATASET_DIR: str = os.getenv("DATASET_DIR", "data/datasets")
+    DATASET_MAX_BYTES: int = int(os.getenv("DATASET_MAX_BYTES", 200 * 1024 * 1024))
+    DATASET_MAX_ROWS: int = int(os.getenv("DATASET_MAX_ROWS", 5_000_000))
+    CHART_MAX_POINTS: int = int(os.getenv("CHART_MAX_POINTS", 2000))
+    CHART_MAX_GROUPS: int = int(os.getenv("CHART_MAX_GROUPS", 20))
+
+    # Generated diagrams are validated per format: "off", "repair" (local repairs only) or
+    # "fix" (plus one LLM call on VALIDATION_FIX_LINES lines around what's still broken)
+    ARTIFACT_VALIDATION: str = os.getenv("ARTIFACT_VALIDATION", "repair")
+    VALIDATION_FIX_LINES: int = int(os.getenv("VALIDATION_FIX_LINES", 20))
+
+    # Router latency budget (seconds); past it the last active agent (or general) is used
+    ROUTER_TIMEOUT_S: float = float(os.getenv("ROUTER_TIMEOUT_S", 8))
+
+    # Local router classifier: skip the router model when its confidence reaches this
+    # threshold (0 disables it); trained on up to N stored routing decisions at startup
+    ROUTER_CLASSIFIER_THRESHOLD: float = float(os.getenv("ROUTER_CLASSIFIER_THRESHOLD", 0.9))
+    ROUTER_CLASSIFIER_TRAINING_LIMIT: int = int(os.getenv("ROUTER_CLASSIFIER_TRAINING_LIMIT", 5000))
+
+    # Run the last active agent concurrently with the router on follow-up turns
+    SPECULATIVE_ROUTING: bool = os.getenv("SPECULATIVE_ROUTING", "false").lower() == "true"
+
+    # Exact-match cache of tool outputs: memory, postgres or off
+    GENERATION_CACHE: str = os.getenv("GENERATION_CACHE", "memory")
+    GENERATION_CACHE_TTL_S: int = int(os.getenv("GENERATION_CACHE_TTL_S", 86400))
+    GENERATION_CACHE_MAX_ENTRIES: int = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", 1000))
+    # Minimum cosine similarity for a near-duplicate first-turn prompt to reuse a generation (0 = off)
+    SEMANTIC_CACHE_THRESHOLD: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0))
+
+    # Shared HTTP connection pool per LLM upstream
+    LLM_POOL_MAX_CONNECTIONS: int = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", 100))
+    LLM_POOL_MAX_KEEPALIVE: int = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", 20))
+    LLM_POOL_KEEPALIVE_S: float = float(os.getenv("LLM_POOL_KEEPALIVE_S", 60))
+    LLM_HTTP2: bool = os.getenv("LLM_HTTP2", "true").lower() == "true"
+
+    # Several OpenAI-compatible upstreams (JSON list of {name, base_url, api_key, weight, model}),
+    # balanced by rolling time-to-first-token and error rate. Empty = DeepSeek / OpenAI above.
+    LLM_UPSTREAMS: str = os.getenv("LLM_UPSTREAMS", "")
+    LLM_STATS_WINDOW: int = int(os.getenv("LLM_STATS_WINDOW", 100))
+    # Hedging: race a second upstream when the first token is later than the primary's TTFT quantile
+    LLM_HEDGE: bool = os.getenv("LLM_HEDGE", "false").lower() == "true"
+    LLM_HEDGE_QUANTILE: float = float(os.getenv("LLM_HEDGE_QUANTILE", 0.95))
+    LLM_HEDGE_MIN_SAMPLES: int = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+
+    # Admission control per upstream: concurrent requests, waiting requests, Retry-After when full
+    LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", 16))
+    LLM_QUEUE_SIZE: int = int(os.getenv("LLM_QUEUE_SIZE", 64))
+    LLM_QUEUE_RETRY_AFTER_S: int = int(os.getenv("LLM_QUEUE_RETRY_AFTER_S", 5))
+
+    # Per role / per agent model settings (JSON), see .env.example
+    LLM_MODEL_MATRIX: str = os.getenv("LLM_MODEL_MATRIX", "")
+
+    # react: agent LLM call -> tool LLM call -> closing agent call; direct: straight to the tool
+    GRAPH_MODE: str = os.getenv("GRAPH_MODE", "react")
+    # End the graph right after the tool node (no closing agent message)
+    GRAPH_END_AFTER_TOOL: bool = os.getenv("GRAPH_END_AFTER_TOOL", "false").lower() == "true"
+
+    # Token budgets for the assembled prompt per role (0 = unlimited)
+    CONTEXT_BUDGET_ROUTER: int = int(os.getenv("CONTEXT_BUDGET_ROUTER", 4000))
+    CONTEXT_BUDGET_AGENT: int = int(os.getenv("CONTEXT_BUDGET_AGENT", 16000))
+    CONTEXT_BUDGET_TOOL: int = int(os.getenv("CONTEXT_BUDGET_TOOL", 32000))
+
+    # Rolling compaction: once a branch has more than COMPACTION_TRIGGER_TURNS unsummarized
+    # turns, all but the last COMPACTION_KEEP_TURNS are folded into a stored summary (0 = off)
+    COMPACTION_TRIGGER_TURNS: int = int(os.getenv("COMPACTION_TRIGGER_TURNS", 0))
+    COMPACTION_KEEP_TURNS: int = int(os.getenv("COMPACTION_KEEP_TURNS", 6))
+    COMPACTION_MODE: str = os.getenv("COMPACTION_MODE", "extractive") # extractive, llm
+    COMPACTION_SUMMARY_TOKENS: int = int(os.getenv("COMPACTION_SUMMARY_TOKENS", 1500))
+
     # Thinking Control
     THINKING_VERBOSITY: str = os.getenv("THINKING_VERBOSITY", "normal") # normal, concise, verbose
+    # Where streamed <think> reasoning is persisted: "separate" (ChatMessage.reasoning) or "none"
+    REASONING_STORE: str = os.getenv("REASONING_STORE", "separate")
 
 settings = Settings()
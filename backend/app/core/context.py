@@ -4,20 +4,40 @@ from langchain_core.messages import BaseMessage
 
 # A ContextVar to store the current conversation messages
 # This allows tools to access the context without passing it as an argument.
-request_context: ContextVar[Dict[str, Any]] = ContextVar("request_context", default={})
+# LangGraph runs every node in a *copy* of the caller's contextvars, so the value is a
+# mutable dict installed once per request (init_context) and updated in place; that way
+# what an agent node sets is visible to its tool node.
+request_context: ContextVar[Optional[Dict[str, Any]]] = ContextVar("request_context", default=None)
+
+def init_context(**kwargs):
+    """Installs a fresh context for one request. Call before running the graph."""
+    request_context.set({"messages": [], **kwargs})
 
 def set_context(messages: List[BaseMessage], **kwargs):
     """Sets the current request context."""
-    context = {
-        "messages": messages,
-        **kwargs
-    }
-    request_context.set(context)
+    context = request_context.get()
+    if context is None:
+        request_context.set({"messages": messages, **kwargs})
+        return
+    context["messages"] = messages
+    context.update(kwargs)
 
 def get_context() -> Dict[str, Any]:
     """Retrieves the current request context."""
-    return request_context.get()
+    return request_context.get() or {}
 
 def get_messages() -> List[BaseMessage]:
     """Retrieves the messages from the current context."""
     return get_context().get("messages", [])
+
+def current_artifact(agent: str, messages: List[BaseMessage]) -> str:
+    """
+    The diagram an agent should build on: its own tool result if that's what it's reacting
+    to in this run, else the latest stored artifact of the branch (loaded once per request
+    into the context, keyed by agent).
+    """
+    if messages and messages[-1].type == "tool" and isinstance(messages[-1].content, str):
+        content = messages[-1].content.strip()
+        if content and not content.startswith("Error"):
+            return content
+    return get_context().get("artifacts", {}).get(agent, "")
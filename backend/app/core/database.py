@@ -14,9 +14,10 @@ async def init_db():
         await conn.run_sync(SQLModel.metadata.create_all)
         await run_migrations(conn)
 
+async_session = sessionmaker(
+    engine, class_=AsyncSession, expire_on_commit=False
+)
+
 async def get_session() -> AsyncSession:
-    async_session = sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
-    )
     async with async_session() as session:
         yield session
@@ -0,0 +1,560 @@
+import copy
+import csv
+import functools
+import io
+import json
+import os
+import uuid
+import numpy as np
+from app.core.config import settings
+
+# Column types: "number" (float64, NaN = missing), "time" (datetime64[ms], NaT = missing)
+# and "category" (int32 codes into a sorted array of distinct strings)
+BUCKETS = {"year": "Y", "month": "M", "week": "W", "day": "D", "hour": "h", "minute": "m", "second": "s"}
+AGGREGATIONS = ("sum", "mean", "avg", "count", "min", "max", "median")
+FILTER_OPS = ("==", "!=", ">", ">=", "<", "<=", "in", "not in", "between")
+TOP_VALUES = 5
+
+
+class DatasetError(ValueError):
+    """Raised for uploads that can't be parsed and chart bindings that don't match the data."""
+
+
+# --- Parsing ----------------------------------------------------------------------------
+
+def _records(raw: bytes, name: str) -> tuple[list[str], list[list[str]]]:
+    """Header and string columns of a CSV or JSON (array of objects) upload."""
+    text = raw.decode("utf-8-sig", errors="replace")
+    if name.lower().endswith(".json") or text.lstrip().startswith(("[", "{")):
+        try:
+            doc = json.loads(text)
+        except ValueError as e:
+            raise DatasetError(f"Invalid JSON: {e}")
+        if isinstance(doc, dict):
+            doc = next((v for v in doc.values() if isinstance(v, list)), None)
+        if not isinstance(doc, list) or not doc or not all(isinstance(r, dict) for r in doc):
+            raise DatasetError("JSON datasets must be an array of objects")
+        header = list(dict.fromkeys(key for record in doc for key in record))
+        cell = lambda v: "" if v is None else (json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else str(v))
+        return header, [[cell(record.get(key)) for record in doc] for key in header]
+
+    try:
+        dialect = csv.Sniffer().sniff(text[:8192], delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    rows = csv.reader(io.StringIO(text), dialect)
+    header = next(rows, None)
+    if not header:
+        raise DatasetError("The CSV file is empty")
+    width = len(header)
+    columns: list[list[str]] = [[] for _ in range(width)]
+    for row in rows:
+        if not row:
+            continue
+        row = (row + [""] * width)[:width]
+        for column, value in zip(columns, row):
+            column.append(value.strip())
+    header = [h.strip() or f"column_{i + 1}" for i, h in enumerate(header)]
+    return header, columns
+
+
+def _infer(values: list[str]) -> tuple[str, np.ndarray, np.ndarray | None]:
+    """(type, data, categories) of one column, trying number, then time, then category."""
+    strings = np.asarray(values, dtype=str)
+    empty = strings == ""
+    if not empty.all():
+        try:
+            return "number", np.where(empty, "nan", strings).astype(np.float64), None
+        except ValueError:
+            pass
+        try:
+            return "time", np.where(empty, "NaT", strings).astype("datetime64[ms]"), None
+        except ValueError:
+            pass
+    categories, codes = np.unique(strings, return_inverse=True)
+    return "category", codes.astype(np.int32), categories
+
+
+def _summary(kind: str, data: np.ndarray, categories: np.ndarray | None) -> dict:
+    """Statistics shown to the model instead of the data."""
+    if kind == "number":
+        valid = data[~np.isnan(data)]
+        stats = {"missing": int(len(data) - len(valid))}
+        if len(valid):
+            stats.update(min=float(valid.min()), max=float(valid.max()),
+                         mean=round(float(valid.mean()), 4), std=round(float(valid.std()), 4))
+        return stats
+    if kind == "time":
+        valid = data[~np.isnat(data)]
+        stats = {"missing": int(len(data) - len(valid))}
+        if len(valid):
+            stats.update(min=str(valid.min().astype("datetime64[s]")), max=str(valid.max().astype("datetime64[s]")))
+        return stats
+    counts = np.bincount(data, minlength=len(categories))
+    top = np.argsort(-counts, kind="stable")[:TOP_VALUES]
+    return {"distinct": int(len(categories)), "top": {str(categories[i]): int(counts[i]) for i in top}}
+
+
+def parse_upload(raw: bytes, name: str) -> tuple[dict[str, np.ndarray], list[dict], int]:
+    """Columnar arrays (for storage), schema with summary statistics, and the row count."""
+    header, columns = _records(raw, name)
+    rows = len(columns[0]) if columns else 0
+    if not rows:
+        raise DatasetError("The dataset has no rows")
+    if rows > settings.DATASET_MAX_ROWS:
+        raise DatasetError(f"The dataset has {rows} rows (limit {settings.DATASET_MAX_ROWS})")
+
+    arrays, schema = {}, []
+    for i, (column, values) in enumerate(zip(header, columns)):
+        kind, data, categories = _infer(values)
+        arrays[f"c{i}"] = data
+        if categories is not None:
+            arrays[f"c{i}_categories"] = categories
+        schema.append({"name": column, "type": kind, **_summary(kind, data, categories)})
+    return arrays, schema, rows
+
+
+# --- Storage ----------------------------------------------------------------------------
+
+def dataset_path(storage_key: str) -> str:
+    return os.path.join(settings.DATASET_DIR, f"{storage_key}.npz")
+
+
+def save_columns(arrays: dict[str, np.ndarray]) -> str:
+    os.makedirs(settings.DATASET_DIR, exist_ok=True)
+    storage_key = uuid.uuid4().hex
+    np.savez(dataset_path(storage_key), **arrays)
+    return storage_key
+
+
+def remove_columns(storage_key: str):
+    try:
+        os.remove(dataset_path(storage_key))
+    except FileNotFoundError:
+        pass
+    load_columns.cache_clear()
+
+
+@functools.lru_cache(maxsize=8)
+def load_columns(storage_key: str) -> dict[str, np.ndarray]:
+    """Column arrays of a stored dataset; the most recently used ones stay in memory."""
+    with np.load(dataset_path(storage_key), allow_pickle=False) as stored:
+        return {key: stored[key] for key in stored.files}
+
+
+class Table:
+    """A stored dataset: its schema and column arrays, addressed by column name."""
+
+    def __init__(self, schema: list[dict], arrays: dict[str, np.ndarray]):
+        self.schema = {c["name"]: (i, c["type"]) for i, c in enumerate(schema)}
+        self.arrays = arrays
+
+    def kind(self, name: str) -> str:
+        if not isinstance(name, str) or name not in self.schema:
+            raise DatasetError(f"Unknown column {name!r} (columns: {', '.join(self.schema)})")
+        return self.schema[name][1]
+
+    def column(self, name: str) -> np.ndarray:
+        self.kind(name)
+        return self.arrays[f"c{self.schema[name][0]}"]
+
+    def categories(self, name: str) -> np.ndarray:
+        return self.arrays[f"c{self.schema[name][0]}_categories"]
+
+    def present(self, name: str) -> np.ndarray:
+        """Rows of a category column that have a value (empty cells are missing)."""
+        categories = self.categories(name)
+        # Categories are sorted: the empty string, if any, is the first one
+        if len(categories) and categories[0] == "":
+            return self.column(name) != 0
+        return np.ones(len(self.column(name)), dtype=bool)
+
+    def numeric(self, name: str) -> np.ndarray:
+        """The column as float64 (times in epoch ms, categories as codes), NaN = missing."""
+        data, kind = self.column(name), self.kind(name)
+        if kind == "time":
+            values = data.astype("int64").astype(np.float64)
+            values[np.isnat(data)] = np.nan
+            return values
+        values = data.astype(np.float64)
+        if kind == "category":
+            values[~self.present(name)] = np.nan
+        return values
+
+
+# --- Aggregation ------------------------------------------------------------------------
+
+def aggregate(inverse: np.ndarray, groups: int, values: np.ndarray | None, agg: str) -> np.ndarray:
+    """Per-group aggregate of `values` (NaN ignored); `inverse` maps every row to its group."""
+    if agg == "avg":
+        agg = "mean"
+    if agg not in AGGREGATIONS:
+        raise DatasetError(f"Unknown aggregation {agg!r} (use {', '.join(AGGREGATIONS)})")
+    if values is None:
+        if agg != "count":
+            raise DatasetError(f"Aggregation {agg!r} needs a column")
+        return np.bincount(inverse, minlength=groups).astype(np.float64)
+
+    valid = ~np.isnan(values)
+    inverse, values = inverse[valid], values[valid]
+    counts = np.bincount(inverse, minlength=groups)
+    if agg == "count":
+        return counts.astype(np.float64)
+    if agg in ("sum", "mean"):
+        sums = np.bincount(inverse, weights=values, minlength=groups)
+        if agg == "sum":
+            return sums
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+    if agg in ("min", "max"):
+        result = np.full(groups, np.inf if agg == "min" else -np.inf)
+        (np.minimum if agg == "min" else np.maximum).at(result, inverse, values)
+        return np.where(counts > 0, result, np.nan)
+    # median: sort by (group, value) and take the middle of every group
+    order = np.argsort(values)
+    order = order[np.argsort(inverse[order], kind="stable")]
+    ordered = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    low = starts + np.maximum(counts - 1, 0) // 2
+    high = starts + counts // 2
+    safe = np.minimum(np.stack([low, high]), max(len(ordered) - 1, 0))
+    with np.errstate(invalid="ignore"):
+        medians = (ordered[safe[0]] + ordered[safe[1]]) / 2 if len(ordered) else np.full(groups, np.nan)
+    return np.where(counts > 0, medians, np.nan)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: indices of `threshold` points of a series sorted by x
+    that keep its visual shape (first and last points included).
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    y = np.nan_to_num(y)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        next_end = max(next_end, next_start + 1)
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+# --- Binding ------------------------------------------------------------------------------
+
+def _filter_mask(table: Table, filters: list[dict]) -> np.ndarray | None:
+    mask = None
+    if isinstance(filters, dict):
+        filters = [filters]
+    if filters is not None and not isinstance(filters, list):
+        raise DatasetError(f'"filter" must be a list of {{"column", "op", "value"}} conditions, not {filters!r}')
+    for condition in filters or []:
+        if not isinstance(condition, dict):
+            raise DatasetError(f"Invalid filter condition {condition!r}")
+        name, op, value = condition.get("column"), condition.get("op", "=="), condition.get("value")
+        if not isinstance(op, str) or op not in FILTER_OPS:
+            raise DatasetError(f"Unknown filter operator {op!r} (use {', '.join(FILTER_OPS)})")
+        if op in ("in", "not in") and not isinstance(value, list):
+            raise DatasetError(f"Operator {op!r} needs a list of values")
+        if op == "between" and not (isinstance(value, list) and len(value) == 2):
+            raise DatasetError('Operator "between" needs a [low, high] value')
+        kind = table.kind(name)
+        if kind == "category":
+            categories = table.categories(name)
+            wanted = value if isinstance(value, list) else [value]
+            codes = np.searchsorted(categories, np.asarray([str(v) for v in wanted]))
+            codes = [c for c, v in zip(codes, wanted) if c < len(categories) and categories[c] == str(v)]
+            hit = np.isin(table.column(name), codes)
+            if op in ("!=", "not in"):
+                hit = ~hit
+            elif op not in ("==", "in"):
+                raise DatasetError(f"Operator {op!r} doesn't apply to the text column {name!r}")
+        else:
+            data = table.column(name)
+            convert = (lambda v: np.datetime64(str(v), "ms")) if kind == "time" else float
+            try:
+                if op == "between":
+                    low, high = value
+                    hit = (data >= convert(low)) & (data <= convert(high))
+                elif op in ("in", "not in"):
+                    hit = np.isin(data, [convert(v) for v in value])
+                    if op == "not in":
+                        hit = ~hit
+                else:
+                    hit = {"==": np.equal, "!=": np.not_equal, ">": np.greater, ">=": np.greater_equal,
+                           "<": np.less, "<=": np.less_equal}[op](data, convert(value))
+            except (TypeError, ValueError) as e:
+                raise DatasetError(f"Invalid filter value for {name!r}: {e}")
+        mask = hit if mask is None else mask & hit
+    return mask
+
+
+def _labels(table: Table, name: str, keys: np.ndarray, bucket: str | None) -> list:
+    """Values of the x column for output: category strings, ISO times or numbers."""
+    kind = table.kind(name)
+    if kind == "category":
+        return table.categories(name)[keys.astype(np.int64)].tolist()
+    if kind == "time":
+        unit = "D" if bucket == "week" else BUCKETS.get(bucket, "s")
+        times = keys.astype("int64").astype("datetime64[ms]").astype(f"datetime64[{unit}]")
+        return np.datetime_as_string(times, unit=unit).tolist()
+    return _clean(keys)
+
+
+def _clean(values: np.ndarray) -> list:
+    """Floats rounded for the wire, NaN as null."""
+    values = np.round(values.astype(np.float64), 6)
+    return [None if v != v else (int(v) if v.is_integer() and abs(v) < 2 ** 53 else v) for v in values.tolist()]
+
+
+def _measures(spec: dict) -> list[tuple[str | None, str | None, str]]:
+    """(column, aggregation, output name) of every y measure."""
+    measures = []
+    y = spec.get("y") or []
+    # A single measure may be given bare ("y": "sales"), not just as a list
+    if not isinstance(y, (str, dict, list)):
+        raise DatasetError(f"Invalid y measure {y!r}")
+    for item in [y] if isinstance(y, (str, dict)) else y:
+        if isinstance(item, str):
+            item = {"column": item}
+        if not isinstance(item, dict):
+            raise DatasetError(f"Invalid y measure {item!r}")
+        column, agg = item.get("column"), item.get("agg")
+        if column is not None and not isinstance(column, str):
+            raise DatasetError(f"Invalid y column {column!r}")
+        if agg is not None and (not isinstance(agg, str) or agg not in AGGREGATIONS):
+            raise DatasetError(f"Unknown aggregation {agg!r} (use {', '.join(AGGREGATIONS)})")
+        if item.get("as") is not None and not isinstance(item["as"], str):
+            raise DatasetError(f"Invalid measure name {item['as']!r}")
+        if agg == "count" and column is None:
+            name = item.get("as") or "count"
+        else:
+            name = item.get("as") or (f"{column}_{agg}" if agg else column)
+        measures.append((column, agg, name))
+    return measures
+
+
+def _positive_int(spec: dict, key: str) -> int | None:
+    """An optional count in the spec (bins, limit, maxPoints)."""
+    value = spec.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise DatasetError(f'"{key}" must be a positive integer, not {value!r}')
+    try:
+        number = int(value)
+    except ValueError:
+        raise DatasetError(f'"{key}" must be a positive integer, not {value!r}')
+    if number <= 0:
+        raise DatasetError(f'"{key}" must be a positive integer, not {value!r}')
+    return number
+
+
+def compute_binding(table: Table, spec: dict) -> tuple[list[str], list[list], list[str]]:
+    """
+    Evaluates a dataset binding:
+      {"x": col, "bucket": "month", "bins": 20, "y": [{"column": col, "agg": "sum", "as": name}],
+       "groupBy": col, "filter": [...], "sort": "x" | "y" | "-y", "limit": n}
+    Measures without `agg` are plotted raw (sorted by x). Returns (dimensions, rows, group
+    values); with groupBy the dimensions are x followed by one column per group.
+    """
+    x, measures, group_by = spec.get("x"), _measures(spec), spec.get("groupBy")
+    if not x:
+        raise DatasetError('A dataset binding needs an "x" column')
+    if not isinstance(x, str):
+        raise DatasetError(f'"x" must be one column name, not {x!r}')
+    if group_by is not None and not isinstance(group_by, str):
+        raise DatasetError(f'"groupBy" must be one column name, not {group_by!r}')
+    if not measures:
+        measures = [(None, "count", "count")]
+    bins, limit = _positive_int(spec, "bins"), _positive_int(spec, "limit")
+    max_points = _positive_int(spec, "maxPoints") or settings.CHART_MAX_POINTS
+    sort, bucket = spec.get("sort"), spec.get("bucket")
+    if sort is not None and sort not in ("x", "y", "-y"):
+        raise DatasetError(f'Unknown sort {sort!r} (use "x", "y" or "-y")')
+    if bucket is not None and bucket not in BUCKETS:
+        raise DatasetError(f"Unknown time bucket {bucket!r} (use {', '.join(BUCKETS)})")
+    mask = _filter_mask(table, spec.get("filter"))
+    take = (lambda a: a[mask]) if mask is not None else (lambda a: a)
+    kind = table.kind(x)
+    aggregated = any(agg for _, agg, _ in measures) or group_by or kind == "category" or bins
+    for column, agg, _ in measures:
+        # Category codes have no magnitude: only their count means something
+        if column is not None and table.kind(column) == "category" and (agg or "sum") != "count":
+            how = f"aggregated with {agg or 'sum'!r}" if aggregated else "plotted raw"
+            raise DatasetError(f"The text column {column!r} can't be {how}, only counted")
+
+    if not aggregated:
+        # Raw series: sorted by x, downsampled with LTTB
+        xs = take(table.numeric(x))
+        columns = [take(table.numeric(c)) for c, _, _ in measures]
+        order = np.argsort(xs, kind="stable")
+        order = order[~np.isnan(xs[order]) & ~np.isnan(columns[0][order])]
+        xs, columns = xs[order], [c[order] for c in columns]
+        if len(xs) > max_points:
+            keep = lttb(xs, columns[0], max_points)
+            xs, columns = xs[keep], [c[keep] for c in columns]
+        labels = _labels(table, x, xs, None)
+        rows = [list(r) for r in zip(labels, *[_clean(c) for c in columns])]
+        return [x] + [name for _, _, name in measures], rows, []
+
+    # Group keys of the x axis
+    raw = take(table.column(x))
+    edges = None
+    if kind == "category":
+        keys = raw.astype(np.int64)
+        valid = take(table.present(x))
+    elif kind == "time":
+        valid = ~np.isnat(raw)
+        if bucket == "week":
+            # datetime64[W] weeks start on Thursday (like the epoch): shift to Mondays
+            monday = np.timedelta64(4, "D")
+            floored = (raw - monday).astype("datetime64[W]").astype("datetime64[D]") + monday
+        else:
+            floored = raw.astype(f"datetime64[{BUCKETS[bucket]}]") if bucket else raw
+        keys = floored.astype("datetime64[ms]").astype("int64")
+    else:
+        valid = ~np.isnan(raw)
+        keys = raw
+        if bins:
+            edges = np.histogram_bin_edges(raw[valid], bins=bins)
+            keys = np.clip(np.searchsorted(edges, raw, side="right") - 1, 0, len(edges) - 2)
+    if group_by:
+        if table.kind(group_by) != "category":
+            raise DatasetError(f"groupBy needs a text column, {group_by!r} is a {table.kind(group_by)}")
+        # Rows without a group value belong to no series
+        valid = valid & take(table.present(group_by))
+    unique, inverse = np.unique(keys[valid], return_inverse=True)
+
+    def column_values(column):
+        return None if column is None else take(table.numeric(column))[valid]
+
+    groups: list[str] = []
+    if group_by:
+        column, agg, _ = measures[0]
+        codes = take(table.column(group_by))[valid].astype(np.int64)
+        categories = table.categories(group_by)
+        present, group_inverse = np.unique(codes, return_inverse=True)
+        totals = aggregate(group_inverse, len(present), column_values(column), agg or "sum")
+        top = np.argsort(-np.nan_to_num(totals, nan=-np.inf), kind="stable")[:settings.CHART_MAX_GROUPS]
+        top.sort()
+        slot = np.full(len(present), -1)
+        slot[top] = np.arange(len(top))
+        keep = slot[group_inverse] >= 0
+        cells = inverse[keep] * len(top) + slot[group_inverse][keep]
+        values = column_values(column)
+        matrix = aggregate(cells, len(unique) * len(top), None if values is None else values[keep], agg or "sum")
+        series = [matrix.reshape(len(unique), len(top))[:, j] for j in range(len(top))]
+        groups = [str(categories[present[j]]) for j in top]
+        names = groups
+    else:
+        series = [aggregate(inverse, len(unique), column_values(c), agg or "sum") for c, agg, _ in measures]
+        names = [name for _, _, name in measures]
+
+    order = np.arange(len(unique))
+    if sort in ("y", "-y") and series:
+        order = np.argsort(np.nan_to_num(series[0], nan=-np.inf), kind="stable")
+        if sort == "-y":
+            order = order[::-1]
+    if limit:
+        order = order[:limit]
+    unique, series = unique[order], [s[order] for s in series]
+
+    if kind != "category" and not sort and len(unique) > max_points:
+        keep = lttb(unique.astype(np.float64), series[0], max_points)
+        unique, series = unique[keep], [s[keep] for s in series]
+
+    if edges is not None:
+        labels = [f"{_clean(edges[i:i + 1])[0]}–{_clean(edges[i + 1:i + 2])[0]}" for i in unique.astype(np.int64)]
+    else:
+        labels = _labels(table, x, unique, bucket)
+    rows = [list(r) for r in zip(labels, *[_clean(s) for s in series])]
+    return [x] + names, rows, groups
+
+
+def _table(datasets: list[dict], reference) -> Table:
+    """The session dataset a binding refers to, by id or name."""
+    for dataset in datasets:
+        if str(reference) in (str(dataset["id"]), dataset["name"]):
+            return Table(dataset["columns"], load_columns(dataset["storage_key"]))
+    names = ", ".join(f"{d['id']} ({d['name']})" for d in datasets)
+    raise DatasetError(f"Unknown dataset {reference!r} (datasets: {names or 'none'})")
+
+
+def bind_option(option: dict, datasets: list[dict]) -> dict:
+    """
+    Fills every `dataset` entry that has a `bind` spec with computed `dimensions` and
+    `source` (the spec stays for later edits). With groupBy, series whose encode.y is
+    "@group" are repeated once per group value.
+    """
+    option = copy.deepcopy(option)
+    declared = option.get("dataset")
+    entries = declared if isinstance(declared, list) else [declared] if isinstance(declared, dict) else []
+    expanded: dict[int, list[str]] = {}
+    for index, entry in enumerate(entries):
+        spec = entry.get("bind") if isinstance(entry, dict) else None
+        if not isinstance(spec, dict):
+            continue
+        table = _table(datasets, spec.get("dataset"))
+        entry["dimensions"], entry["source"], groups = compute_binding(table, spec)
+        if groups:
+            expanded[index] = groups
+
+    if expanded and isinstance(option.get("series"), list):
+        series = []
+        for item in option["series"]:
+            encode = item.get("encode") if isinstance(item, dict) else None
+            groups = expanded.get(item.get("datasetIndex", 0)) if encode else None
+            if not groups or encode.get("y") != "@group":
+                series.append(item)
+                continue
+            for group in groups:
+                series.append({**item, "name": group, "encode": {**encode, "y": group}, "bindGroup": group})
+        option["series"] = series
+    return option
+
+
+def strip_bound_data(code: str) -> str:
+    """The chart as the model wrote it: computed sources dropped, group series folded back."""
+    try:
+        option = json.loads(code)
+    except ValueError:
+        return code
+    if not isinstance(option, dict):
+        return code
+    datasets = option.get("dataset")
+    for entry in datasets if isinstance(datasets, list) else [datasets]:
+        if isinstance(entry, dict) and "bind" in entry:
+            entry.pop("source", None)
+            entry.pop("dimensions", None)
+    if isinstance(option.get("series"), list):
+        series, folded = [], set()
+        for item in option["series"]:
+            if isinstance(item, dict) and "bindGroup" in item:
+                key = (item.get("datasetIndex", 0), item.get("type"))
+                if key in folded:
+                    continue
+                folded.add(key)
+                item = {k: v for k, v in item.items() if k not in ("bindGroup", "name")}
+                item["encode"] = {**item.get("encode", {}), "y": "@group"}
+            series.append(item)
+        option["series"] = series
+    return json.dumps(option, ensure_ascii=False, indent=2)
+
+
+def describe(datasets: list[dict]) -> str:
+    """Schema and statistics of the session's datasets, for the chart prompt."""
+    lines = []
+    for dataset in datasets:
+        lines.append(f"- dataset {dataset['id']} \"{dataset['name']}\": {dataset['rows']} rows")
+        for column in dataset["columns"]:
+            stats = {k: v for k, v in column.items() if k not in ("name", "type")}
+            lines.append(f"    - {column['name']} ({column['type']}): {json.dumps(stats, ensure_ascii=False)}")
+    return "\n".join(lines)
@@ -0,0 +1,270 @@
+import json
+import re
+import xml.etree.ElementTree as ET
+
+# Tag on sub-generations that run concurrently inside one tool call (e.g. mindmap branches):
+# the event pipeline buffers each run and forwards it whole as tool_code when it ends, after
+# the run's `fanout_header` metadata (sent once per tool call)
+FANOUT_TAG = "fanout_branch"
+
+
+class PatchParser:
+    """
+    Base class for streaming parsers that turn raw tool output into `diagram_patch`
+    operations as soon as each element (node, edge, series, cell...) is complete.
+    """
+
+    def feed(self, text: str) -> list[dict]:
+        """Takes the next chunk of output (reasoning already split off) and returns the completed patches."""
+        raise NotImplementedError
+
+
+class JsonItemParser(PatchParser):
+    """
+    Incremental scanner for a single top-level JSON object.
+    - Every element of the arrays listed in `item_keys` (e.g. {"nodes": "node"}) is emitted
+      as soon as its closing bracket arrives.
+    - With `emit_fields`, every other top-level object/array value is emitted as a
+      `field` patch once complete (e.g. an ECharts `title` or `xAxis`).
+    """
+
+    def __init__(self, item_keys: dict[str, str], emit_fields: bool = False):
+        self.item_keys = item_keys
+        self.emit_fields = emit_fields
+        self._buf = ""
+        self._pos = 0
+        # Frames: [bracket, key in parent object, start offset]
+        self._stack: list[list] = []
+        self._in_string = False
+        self._escape = False
+        self._str_start = -1
+        self._last_string: tuple[int, int] | None = None
+        self._pending_key: str | None = None
+        self._counts: dict[str, int] = {}
+
+    def feed(self, text: str) -> list[dict]:
+        self._buf += text
+        buf = self._buf
+        patches = []
+
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = (self._str_start, i + 1)
+                continue
+
+            if not self._stack:
+                # Skip anything (fences, prose) before the root object
+                if ch == "{":
+                    self._stack.append(["{", None, i])
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._str_start = i
+            elif ch == ":" and self._stack[-1][0] == "{" and self._last_string:
+                try:
+                    self._pending_key = json.loads(buf[self._last_string[0]:self._last_string[1]])
+                except ValueError:
+                    self._pending_key = None
+            elif ch in "{[":
+                key = self._pending_key if self._stack[-1][0] == "{" else None
+                self._stack.append([ch, key, i])
+                self._pending_key = None
+            elif ch in "}]":
+                bracket, key, start = self._stack.pop()
+                patch = self._on_close(bracket, key, buf[start:i + 1])
+                if patch:
+                    patches.append(patch)
+                if not self._stack:
+                    # Root closed: anything after it is ignored
+                    self._pos = len(buf)
+                    return patches
+
+        self._pos = len(buf)
+        return patches
+
+    def _on_close(self, bracket: str, key: str | None, raw: str) -> dict | None:
+        depth = len(self._stack)
+        if depth == 2 and self._stack[1][0] == "[" and self._stack[1][1] in self.item_keys and bracket == "{":
+            # An element of a tracked top-level array
+            array_key = self._stack[1][1]
+            value = self._load(raw)
+            if value is None:
+                return None
+            index = self._counts.get(array_key, 0)
+            self._counts[array_key] = index + 1
+            return {"op": "add", "kind": self.item_keys[array_key], "index": index, "item": value}
+
+        if depth == 1 and self.emit_fields and key and key not in self.item_keys:
+            value = self._load(raw)
+            if value is None:
+                return None
+            return {"op": "set", "kind": "field", "key": key, "item": value}
+        return None
+
+    @staticmethod
+    def _load(raw: str):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+
+class MxCellParser(PatchParser):
+    """Emits every `<mxCell>` of a draw.io document as soon as the element is closed."""
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._count = 0
+
+    def feed(self, text: str) -> list[dict]:
+        self._buf += text
+        patches = []
+        while True:
+            start = self._buf.find("<mxCell", self._pos)
+            if start < 0:
+                # Keep a possible partial "<mxCell" for the next chunk
+                self._pos = max(self._pos, len(self._buf) - len("<mxCell"))
+                return patches
+
+            end = self._element_end(start)
+            if end < 0:
+                self._pos = start
+                return patches
+
+            self._pos = end
+            patch = self._parse(self._buf[start:end])
+            if patch:
+                patches.append(patch)
+
+    def _element_end(self, start: int) -> int:
+        """Offset just past the element starting at `start`, or -1 if it's incomplete."""
+        in_quote = None
+        for i in range(start, len(self._buf)):
+            ch = self._buf[i]
+            if in_quote:
+                if ch == in_quote:
+                    in_quote = None
+            elif ch in "\"'":
+                in_quote = ch
+            elif ch == ">":
+                if self._buf[i - 1] == "/":
+                    return i + 1
+                close = self._buf.find("</mxCell>", i)
+                return close + len("</mxCell>") if close >= 0 else -1
+        return -1
+
+    def _parse(self, fragment: str) -> dict | None:
+        try:
+            element = ET.fromstring(fragment)
+        except ET.ParseError:
+            return None
+
+        item = dict(element.attrib)
+        geometry = element.find("mxGeometry")
+        if geometry is not None:
+            item["geometry"] = dict(geometry.attrib)
+
+        kind = "edge" if item.get("edge") == "1" else "vertex" if item.get("vertex") == "1" else "cell"
+        index = self._count
+        self._count += 1
+        return {"op": "add", "kind": kind, "index": index, "item": item}
+
+
+class OutlineParser(PatchParser):
+    """
+    Emits a node for every completed heading / list line of a markdown outline (Markmap),
+    with its depth and the index of its parent node.
+    """
+
+    LINE = re.compile(r"^(?P<indent>\s*)(?:(?P<hashes>#{1,6})\s+|(?:[-*+]|\d+\.)\s+)(?P<text>.+?)\s*$")
+
+    def __init__(self):
+        self._partial = ""
+        self._count = 0
+        self._heading_depth = -1
+        # (depth, index) of the open ancestors
+        self._ancestors: list[tuple[int, int]] = []
+
+    def feed(self, text: str) -> list[dict]:
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        patches = []
+        for line in lines:
+            patch = self._parse_line(line)
+            if patch:
+                patches.append(patch)
+        return patches
+
+    def _parse_line(self, line: str) -> dict | None:
+        match = self.LINE.match(line)
+        if not match:
+            return None
+
+        if match.group("hashes"):
+            depth = len(match.group("hashes")) - 1
+            self._heading_depth = depth
+        else:
+            indent = len(match.group("indent").replace("\t", "  "))
+            depth = self._heading_depth + 1 + indent // 2
+
+        while self._ancestors and self._ancestors[-1][0] >= depth:
+            self._ancestors.pop()
+        parent = self._ancestors[-1][1] if self._ancestors else None
+
+        index = self._count
+        self._count += 1
+        self._ancestors.append((depth, index))
+        return {
+            "op": "add",
+            "kind": "node",
+            "index": index,
+            "item": {"depth": depth, "text": match.group("text"), "parent": parent}
+        }
+
+
+class DrawioParser(PatchParser):
+    """draw.io output is either the compact IR (JSON, DRAWIO_MODE=ir) or raw XML: the first "{" or "<" decides."""
+
+    def __init__(self):
+        self._inner: PatchParser | None = None
+        self._head = ""
+
+    def feed(self, text: str) -> list[dict]:
+        if self._inner is None:
+            self._head += text
+            starts = [i for i in (self._head.find("{"), self._head.find("<")) if i >= 0]
+            if not starts:
+                return []
+            if self._head[min(starts)] == "{":
+                self._inner = JsonItemParser({"groups": "group", "nodes": "node", "edges": "edge"})
+            else:
+                self._inner = MxCellParser()
+            text, self._head = self._head, ""
+        return self._inner.feed(text)
+
+
+# Tool node name -> (agent, parser factory)
+PATCH_PARSERS = {
+    "flow_tools": ("flowchart", lambda: JsonItemParser({"nodes": "node", "edges": "edge"})),
+    "charts_tools": ("charts", lambda: JsonItemParser({"series": "series"}, emit_fields=True)),
+    "drawio_tools": ("drawio", DrawioParser),
+    "mindmap_tools": ("mindmap", OutlineParser),
+}
+
+
+def create_patch_parser(node_name: str) -> tuple[str, PatchParser] | None:
+    """Returns (agent, parser) for tool nodes whose output can be previewed incrementally."""
+    entry = PATCH_PARSERS.get(node_name)
+    if not entry:
+        return None
+    agent, factory = entry
+    return agent, factory()
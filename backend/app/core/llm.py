@@ -1,50 +1,614 @@
+import asyncio
+import heapq
+import importlib.util
+import itertools
+import json
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable
+import httpx
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from langchain_openai import ChatOpenAI
 from app.core.config import settings
+from app.core.context import get_context
+from app.core.logger import logger
 
-def get_llm(model_name: str | None = None, temperature: float = 0.3):
+# Admission priorities (lower is served first)
+PRIORITY_ROUTER = 0
+PRIORITY_EDIT = 1
+PRIORITY_DEFAULT = 2
+PRIORITY_BULK = 3
+
+_llm_priority: ContextVar[int] = ContextVar("llm_priority", default=PRIORITY_DEFAULT)
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """Admission priority for the LLM calls made inside the block."""
+    token = _llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        _llm_priority.reset(token)
+
+
+class UpstreamBusy(Exception):
+    """Raised when an upstream's admission queue is full."""
+
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(f"LLM upstream {upstream} is saturated, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def upstream_busy(error: BaseException) -> UpstreamBusy | None:
+    """The UpstreamBusy behind an error (the OpenAI client wraps transport errors)."""
+    while error is not None:
+        if isinstance(error, UpstreamBusy):
+            return error
+        error = error.__cause__ or error.__context__
+    return None
+
+
+class AdmissionController:
     """
-    Returns a ChatOpenAI instance configured for either OpenAI or DeepSeek
-    based on environment variables.
+    At most `limit` concurrent requests to one upstream; up to `queue_size` more wait in a
+    priority queue (FIFO within a priority). Waiters are told their queue position through
+    their `notify(position)` callback whenever it changes.
     """
 
-    max_tokens = settings.MAX_TOKENS
-    # Priority: DeepSeek if key is present
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.rejected = 0
+        # (priority, seq, future, notify)
+        self._waiters: list[tuple[int, int, asyncio.Future, Callable | None]] = []
+        self._seq = itertools.count()
+        # seq -> last position reported to that waiter
+        self._positions: dict[int, int] = {}
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def saturated(self) -> bool:
+        return bool(self.limit) and self.active >= self.limit and self.waiting >= self.queue_size
+
+    async def acquire(self, priority: int, notify: Callable | None = None):
+        if not self.limit or (self.active < self.limit and not self._waiters):
+            self.active += 1
+            return
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise UpstreamBusy(self.name, settings.LLM_QUEUE_RETRY_AFTER_S)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future, notify)
+        heapq.heappush(self._waiters, entry)
+        self._notify_positions()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled
+                self.release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._notify_positions()
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.limit:
+            _, _, future, _ = heapq.heappop(self._waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        positions = {}
+        for position, (_, seq, _, notify) in enumerate(sorted(self._waiters), start=1):
+            positions[seq] = position
+            if notify and self._positions.get(seq) != position:
+                try:
+                    notify(position, self.name)
+                except Exception as e:
+                    logger.warning(f"Queue position callback failed: {e}")
+        self._positions = positions
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "rejected": self.rejected}
+
+
+class CountingTransport(httpx.AsyncHTTPTransport):
+    """
+    HTTP transport that admits requests through the upstream's AdmissionController and
+    tracks in-flight requests (until the response body is closed).
+    """
+
+    def __init__(self, admission: AdmissionController, **kwargs):
+        super().__init__(**kwargs)
+        self.admission = admission
+        self.in_flight = 0
+        self.total_requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # The request context may carry a callback that turns queue positions into SSE events
+        await self.admission.acquire(_llm_priority.get(), get_context().get("on_llm_queue"))
+        self.in_flight += 1
+        self.total_requests += 1
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self._release()
+            raise
+        response.stream = _ReleasingStream(response.stream, self)
+        return response
+
+    def _release(self):
+        self.in_flight -= 1
+        self.admission.release()
+
+    def connection_stats(self) -> dict:
+        connections = list(self._pool.connections)
+        idle = sum(1 for c in connections if c.is_idle())
+        return {"connections": len(connections), "idle": idle, "active": len(connections) - idle}
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, transport: CountingTransport):
+        self._stream = stream
+        self._transport = transport
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._released:
+            self._released = True
+            self._transport._release()
+        await self._stream.aclose()
+
+
+class LLMClientRegistry:
+    """
+    Process-wide registry of LLM clients. Every upstream (base URL) gets exactly one
+    async HTTP connection pool, shared by all ChatOpenAI instances that talk to it, and
+    ChatOpenAI instances / tool bindings are built once per configuration.
+    """
+
+    def __init__(self):
+        self._transports: dict[str, CountingTransport] = {}
+        self._http_clients: dict[str, httpx.AsyncClient] = {}
+        self._models: dict[tuple, ChatOpenAI] = {}
+        self._bound: dict[tuple, object] = {}
+
+    def http_client(self, base_url: str) -> httpx.AsyncClient:
+        key = base_url or "default"
+        client = self._http_clients.get(key)
+        if client is None:
+            http2 = settings.LLM_HTTP2 and importlib.util.find_spec("h2") is not None
+            transport = CountingTransport(
+                AdmissionController(key, settings.LLM_MAX_CONCURRENCY, settings.LLM_QUEUE_SIZE),
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=settings.LLM_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.LLM_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=settings.LLM_POOL_KEEPALIVE_S,
+                ),
+            )
+            client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(120, connect=10))
+            self._transports[key] = transport
+            self._http_clients[key] = client
+        return client
+
+    def chat_model(
+        self, api_key: str, base_url: str, model: str, temperature: float, max_tokens: int,
+        max_retries: int = 2, timeout: float = 120
+    ) -> ChatOpenAI:
+        key = (api_key, base_url, model, temperature, max_tokens, max_retries, timeout)
+        llm = self._models.get(key)
+        if llm is None:
+            llm = ChatOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                model=model,
+                temperature=temperature,
+                streaming=True,
+                request_timeout=timeout,
+                max_tokens=max_tokens,
+                max_retries=max_retries,
+                http_async_client=self.http_client(base_url),
+            )
+            self._models[key] = llm
+        return llm
+
+    def balanced_model(self, model: str, temperature: float, max_tokens: int, timeout: float = 120) -> "BalancedChatModel":
+        key = ("balanced", model, temperature, max_tokens, timeout)
+        llm = self._models.get(key)
+        if llm is None:
+            # The balancer fails over itself, so the per-upstream clients don't retry
+            clients = [
+                self.chat_model(u.api_key, u.base_url, u.model or model, temperature, max_tokens, max_retries=0, timeout=timeout)
+                for u in upstream_balancer.upstreams
+            ]
+            llm = BalancedChatModel(model_name=model, temperature=temperature, clients=clients)
+            self._models[key] = llm
+        return llm
+
+    def bind_tools(self, llm, tools: list):
+        """Cached llm.bind_tools(tools); tools are identified by name."""
+        key = (id(llm), tuple(t.name for t in tools))
+        bound = self._bound.get(key)
+        if bound is None:
+            bound = llm.bind_tools(tools)
+            self._bound[key] = bound
+        return bound
+
+    def stats(self) -> dict:
+        upstreams = {}
+        for key, transport in self._transports.items():
+            upstreams[key] = {
+                "in_flight": transport.in_flight,
+                "total_requests": transport.total_requests,
+                "max_connections": settings.LLM_POOL_MAX_CONNECTIONS,
+                **transport.connection_stats(),
+                "admission": transport.admission.stats(),
+            }
+        return {
+            "upstreams": upstreams,
+            "balancer": upstream_balancer.stats(),
+            "models": len(self._models),
+            "tool_bindings": len(self._bound),
+        }
+
+    def saturated(self) -> bool:
+        """True when every upstream's admission queue is full."""
+        transports = list(self._transports.values())
+        return bool(transports) and all(t.admission.saturated() for t in transports)
+
+    async def aclose(self):
+        for client in self._http_clients.values():
+            await client.aclose()
+        self._http_clients.clear()
+        self._transports.clear()
+
+
+class Upstream:
+    """One OpenAI-compatible endpoint with rolling time-to-first-token and error stats."""
+
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0, model: str | None = None):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.01)
+        self.model = model
+        self.ttft: deque[float] = deque(maxlen=settings.LLM_STATS_WINDOW)
+        # 1 = failed call, 0 = successful call
+        self.outcomes: deque[int] = deque(maxlen=settings.LLM_STATS_WINDOW)
+        self.in_flight = 0
+
+    def record_ttft(self, seconds: float):
+        self.ttft.append(seconds)
+
+    def record_outcome(self, failed: bool):
+        self.outcomes.append(1 if failed else 0)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def percentile(self, q: float) -> float | None:
+        if not self.ttft:
+            return None
+        ordered = sorted(self.ttft)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def score(self) -> float:
+        """Lower is better: expected TTFT, inflated by errors and load, divided by weight."""
+        median = self.percentile(0.5)
+        if median is None:
+            # Unmeasured upstreams go first so they get measured, unless they only ever failed
+            return 1e6 * self.error_rate
+        return median * (1 + 4 * self.error_rate) * (1 + 0.1 * self.in_flight) / self.weight
+
+    def stats(self) -> dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "samples": len(self.ttft),
+            "ttft_p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "ttft_p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "error_rate": round(self.error_rate, 4),
+        }
+
+
+class UpstreamBalancer:
+    def __init__(self, upstreams: list[Upstream]):
+        self.upstreams = upstreams
+
+    def ranked(self) -> list[tuple[int, Upstream]]:
+        """(client index, upstream), best first. Jitter spreads load between close scores."""
+        scored = [(u.score() * random.uniform(0.9, 1.1), i, u) for i, u in enumerate(self.upstreams)]
+        return [(i, u) for _, i, u in sorted(scored, key=lambda x: (x[0], -x[2].weight * random.random()))]
+
+    def hedge_delay(self, upstream: Upstream) -> float | None:
+        """Deadline for the first token before a hedged request is fired, or None."""
+        if not settings.LLM_HEDGE or len(self.upstreams) < 2:
+            return None
+        if len(upstream.ttft) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return upstream.percentile(settings.LLM_HEDGE_QUANTILE)
+
+    def stats(self) -> dict:
+        return {u.name: u.stats() for u in self.upstreams}
+
+
+def configured_upstreams() -> list[Upstream]:
+    """LLM_UPSTREAMS if set, otherwise the single DeepSeek / OpenAI endpoint."""
+    if settings.LLM_UPSTREAMS:
+        entries = json.loads(settings.LLM_UPSTREAMS)
+        return [
+            Upstream(
+                name=e.get("name") or e["base_url"],
+                base_url=e["base_url"],
+                api_key=e.get("api_key") or settings.OPENAI_API_KEY,
+                weight=e.get("weight", 1.0),
+                model=e.get("model"),
+            )
+            for e in entries
+        ]
     if settings.DEEPSEEK_API_KEY:
-        # Override standard OpenAI model names to DeepSeek default
-        model = settings.MODEL_ID or "deepseek-chat"
-    
-        
-        return ChatOpenAI(
-            api_key=settings.DEEPSEEK_API_KEY,
-            base_url=settings.DEEPSEEK_BASE_URL,
-            model=model,
-            temperature=temperature,
-            streaming=True,
-            request_timeout=120,
-            max_tokens=max_tokens
-        )
-    
-    # Fallback to OpenAI
-    return ChatOpenAI(
-        api_key=settings.OPENAI_API_KEY,
-        base_url=settings.OPENAI_BASE_URL,
-        model=model_name or settings.MODEL_ID or "claude-sonnet-3.7",
-        temperature=temperature,
-        streaming=True,
-        request_timeout=120,
-        max_tokens=max_tokens
-    )
+        return [Upstream("deepseek", settings.DEEPSEEK_BASE_URL, settings.DEEPSEEK_API_KEY)]
+    return [Upstream("openai", settings.OPENAI_BASE_URL, settings.OPENAI_API_KEY)]
+
+
+upstream_balancer = UpstreamBalancer(configured_upstreams())
+
+
+class BalancedChatModel(BaseChatModel):
+    """
+    Chat model spread over several OpenAI-compatible upstreams (one ChatOpenAI client
+    each, same order as upstream_balancer.upstreams). Every call goes to the best-ranked
+    upstream; a call that fails before its first token fails over to the next one. With
+    LLM_HEDGE, a second upstream is raced once the first token is later than the primary's
+    TTFT percentile, and the slower stream is cancelled.
+    """
+
+    model_name: str
+    temperature: float = 0.3
+    clients: list[Any]
+
+    @property
+    def _llm_type(self) -> str:
+        return "balanced-openai"
+
+    def bind_tools(self, tools, **kwargs):
+        kwargs.pop("tool_choice", None)
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    async def _first_chunk(self, index: int, upstream: Upstream, messages, stop, kwargs):
+        started = time.monotonic()
+        # The client's own _astream, not the public astream: that would open a second callback
+        # run and stream every token twice through astream_events. langchain-openai is pinned
+        # to the 1.1 line in pyproject.toml for this private signature.
+        stream = self.clients[index]._astream(messages, stop=stop, **kwargs)
+        try:
+            chunk = await stream.__anext__()
+        except BaseException:
+            await stream.aclose()
+            raise
+        upstream.record_ttft(time.monotonic() - started)
+        return upstream, stream, chunk
+
+    async def _race(self, messages, stop, kwargs):
+        """
+        Returns (upstream, stream, first chunk) of the winning upstream. Every other launched
+        upstream is settled here, whatever its task ended with: its in_flight slot is released
+        and its outcome recorded. The winner is settled by the caller once its stream ends.
+        """
+        candidates = upstream_balancer.ranked()
+        launched: list[tuple[asyncio.Task, Upstream]] = []
+        pending: set[asyncio.Task] = set()
+        winner = None
+        deadline = upstream_balancer.hedge_delay(candidates[0][1])
+        last_error = None
+
+        def launch():
+            index, upstream = candidates.pop(0)
+            upstream.in_flight += 1
+            task = asyncio.create_task(self._first_chunk(index, upstream, messages, stop, kwargs))
+            launched.append((task, upstream))
+            pending.add(task)
+
+        launch()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # First token is late: hedge with the next upstream (once)
+                    deadline = None
+                    if candidates:
+                        logger.info("🏁 LLM first token past hedge deadline, racing a second upstream")
+                        launch()
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"LLM upstream failed before first token: {last_error}")
+                if not pending and candidates:
+                    launch()
+            raise last_error
+        finally:
+            for task, _ in launched:
+                if task is not winner:
+                    task.cancel()
+            for task, upstream in launched:
+                if task is winner:
+                    continue
+                failed = False
+                try:
+                    _, stream, _ = await task
+                    # Finished in the same tick as the winner
+                    await stream.aclose()
+                except asyncio.CancelledError:
+                    pass
+                except Exception:
+                    failed = True
+                upstream.in_flight -= 1
+                upstream.record_outcome(failed=failed)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        upstream, stream, chunk = await self._race(messages, stop, kwargs)
+        failed = False
+        try:
+            while True:
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+                try:
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+        except Exception:
+            failed = True
+            raise
+        finally:
+            upstream.in_flight -= 1
+            upstream.record_outcome(failed=failed)
+            await stream.aclose()
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Sync calls: the best-ranked upstream, failing over in rank order (no hedging)."""
+        last_error = None
+        for index, upstream in upstream_balancer.ranked():
+            upstream.in_flight += 1
+            failed = True
+            try:
+                result = self.clients[index]._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                failed = False
+                return result
+            except Exception as e:
+                last_error = e
+                logger.warning(f"LLM upstream {upstream.name} failed: {e}")
+            finally:
+                upstream.in_flight -= 1
+                upstream.record_outcome(failed=failed)
+        raise last_error
+
+
+llm_registry = LLMClientRegistry()
+
+
+def load_model_matrix() -> dict:
+    if not settings.LLM_MODEL_MATRIX:
+        return {}
+    try:
+        return json.loads(settings.LLM_MODEL_MATRIX)
+    except ValueError as e:
+        logger.error(f"Invalid LLM_MODEL_MATRIX, ignoring it: {e}")
+        return {}
+
+
+MODEL_MATRIX = load_model_matrix()
+
+
+def model_config(role: str | None = None, agent: str | None = None) -> dict:
+    """
+    Model settings for a role ("router", "agent" = orchestrator, "tool" = inner generator),
+    optionally per agent. Later entries win: defaults, "<role>", "<agent>.<role>".
+    """
+    config = {"model": None, "max_tokens": settings.MAX_TOKENS, "temperature": 0.3, "timeout": 120}
+    for key in (role, f"{agent}.{role}" if agent and role else None):
+        if key and key in MODEL_MATRIX:
+            config.update({k: v for k, v in MODEL_MATRIX[key].items() if v is not None})
+    return config
+
+
+def get_llm(model_name: str | None = None, temperature: float | None = None, role: str | None = None, agent: str | None = None):
+    """
+    Returns a shared chat model configured for either OpenAI or DeepSeek based on
+    environment variables, or balanced over LLM_UPSTREAMS when several are configured.
+    Model, max_tokens, temperature and timeout come from LLM_MODEL_MATRIX for the given
+    role / agent; explicit arguments win.
+    """
+    config = model_config(role, agent)
+    if temperature is None:
+        temperature = config["temperature"]
+    max_tokens = config["max_tokens"]
+    timeout = config["timeout"]
+    model = model_name or config["model"] or settings.MODEL_ID
+
+    if len(upstream_balancer.upstreams) > 1:
+        return llm_registry.balanced_model(model or "deepseek-chat", temperature, max_tokens, timeout)
+
+    # Priority: DeepSeek if key is present
+    if settings.DEEPSEEK_API_KEY and not settings.LLM_UPSTREAMS:
+        return llm_registry.chat_model(settings.DEEPSEEK_API_KEY, settings.DEEPSEEK_BASE_URL, model or "deepseek-chat", temperature, max_tokens, timeout=timeout)
+
+    # Fallback to OpenAI (or the single configured upstream)
+    upstream = upstream_balancer.upstreams[0]
+    model = upstream.model or model or "claude-sonnet-3.7"
+    return llm_registry.chat_model(upstream.api_key, upstream.base_url, model, temperature, max_tokens, timeout=timeout)
+
+
+def bind_tools(llm, tools: list):
+    return llm_registry.bind_tools(llm, tools)
+
+
+def thinking_verbosity() -> str:
+    """The request's thinking level (ChatRequest.thinking_verbosity), else THINKING_VERBOSITY."""
+    return (get_context().get("thinking_verbosity") or settings.THINKING_VERBOSITY).lower()
 
 
 def get_thinking_instructions() -> str:
     """
-    Returns system prompt instructions based on thinking verbosity setting.
+    Returns system prompt instructions based on the thinking verbosity of the request.
     """
-    verbosity = settings.THINKING_VERBOSITY.lower()
-    
+    verbosity = thinking_verbosity()
+
     if verbosity == "concise":
         return "\n\n### THINKING PROCESS\n- Please be extremely concise in your internal thinking (<think> tags).\n- Focus ONLY on critical reasoning steps.\n- Avoid restating the obvious or verbose planning."
     elif verbosity == "verbose":
         return "\n\n### THINKING PROCESS\n- Please explore all possibilities in your internal thinking.\n- Verify assumptions and plan in detail."
-    
+
     return "" # Normal - rely on model default
@@ -0,0 +1,354 @@
+import copy
+import json
+import re
+import xml.etree.ElementTree as ET
+from langchain_core.messages import HumanMessage
+from app.core.logger import logger
+from app.core.llm import llm_priority, PRIORITY_EDIT
+from app.core.tokens import assemble_context
+
+# Tag on edit-mode LLM calls so the event pipeline doesn't stream patches as diagram code
+EDIT_TAG = "diagram_edit"
+
+
+class PatchError(ValueError):
+    """Raised when a model-produced patch can't be validated or applied."""
+
+
+# --- RFC 6902 JSON Patch -------------------------------------------------------------
+
+def _parse_pointer(pointer: str) -> list[str]:
+    if not isinstance(pointer, str):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in pointer[1:].split("/")]
+
+
+def _resolve_parent(doc, parts: list[str]):
+    target = doc
+    for part in parts[:-1]:
+        target = _get_child(target, part)
+    return target
+
+
+def _get_child(container, part: str):
+    if isinstance(container, list):
+        # Negative indexes would silently address from the end; RFC 6902 has none
+        return container[_list_index(container, part, allow_end=False)]
+    if isinstance(container, dict) and part in container:
+        return container[part]
+    raise PatchError(f"Path segment {part!r} not found")
+
+
+def _list_index(container: list, part: str, allow_end: bool) -> int:
+    if part == "-" and allow_end:
+        return len(container)
+    try:
+        index = int(part)
+    except ValueError:
+        raise PatchError(f"Invalid array index {part!r}")
+    upper = len(container) if allow_end else len(container) - 1
+    if not 0 <= index <= upper:
+        raise PatchError(f"Array index {index} out of range")
+    return index
+
+
+def _add(doc, parts: list[str], value):
+    if not parts:
+        return value
+    parent = _resolve_parent(doc, parts)
+    key = parts[-1]
+    if isinstance(parent, list):
+        parent.insert(_list_index(parent, key, allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[key] = value
+    else:
+        raise PatchError(f"Cannot add to a scalar at {key!r}")
+    return doc
+
+
+def _remove(doc, parts: list[str]):
+    if not parts:
+        raise PatchError("Cannot remove the document root")
+    parent = _resolve_parent(doc, parts)
+    key = parts[-1]
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, key, allow_end=False))
+    if isinstance(parent, dict) and key in parent:
+        return parent.pop(key)
+    raise PatchError(f"Path segment {key!r} not found")
+
+
+def apply_json_patch(doc, operations: list[dict]):
+    """Applies RFC 6902 operations to a copy of `doc`. Raises PatchError on any failure."""
+    if not isinstance(operations, list):
+        raise PatchError("A JSON Patch must be an array of operations")
+
+    doc = copy.deepcopy(doc)
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(operation.get("op"), str) or "path" not in operation:
+            raise PatchError(f"Malformed operation: {operation!r}")
+        op = operation["op"]
+        parts = _parse_pointer(operation["path"])
+
+        if op == "add":
+            doc = _add(doc, parts, operation.get("value"))
+        elif op == "remove":
+            _remove(doc, parts)
+        elif op == "replace":
+            if not parts:
+                doc = operation.get("value")
+                continue
+            _remove(doc, parts)
+            doc = _add(doc, parts, operation.get("value"))
+        elif op in ("move", "copy"):
+            source = _parse_pointer(operation.get("from", ""))
+            if op == "move":
+                value = _remove(doc, source)
+            else:
+                value = copy.deepcopy(_get_child(_resolve_parent(doc, source), source[-1]) if source else doc)
+            doc = _add(doc, parts, value)
+        elif op == "test":
+            actual = _get_child(_resolve_parent(doc, parts), parts[-1]) if parts else doc
+            if actual != operation.get("value"):
+                raise PatchError(f"Test failed at {operation['path']}")
+        else:
+            raise PatchError(f"Unknown operation {op!r}")
+    return doc
+
+
+# --- Line diff ----------------------------------------------------------------------
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+
+def apply_line_diff(text: str, diff: str) -> str:
+    """
+    Applies a unified diff to `text`. Hunks are located by their context/removed lines
+    (searching outwards from the declared line number), so slightly wrong line numbers
+    from the model are tolerated. Raises PatchError if a hunk doesn't match.
+    """
+    lines = text.split("\n")
+    hunks: list[tuple[int, list[str], list[str]]] = []
+    current = None
+
+    for raw in diff.split("\n"):
+        header = _HUNK_HEADER.match(raw)
+        if header:
+            current = (int(header.group(1)) - 1, [], [])
+            hunks.append(current)
+            continue
+        if current is None or raw.startswith(("---", "+++")):
+            continue
+        if raw.startswith("+"):
+            current[2].append(raw[1:])
+        elif raw.startswith("-"):
+            current[1].append(raw[1:])
+        elif raw.startswith(" ") or raw == "":
+            current[1].append(raw[1:])
+            current[2].append(raw[1:])
+
+    if not hunks:
+        raise PatchError("No hunks found in diff")
+
+    offset = 0
+    for hint, old, new in hunks:
+        # Trailing blank context is usually an artifact of the model's formatting
+        while old and new and old[-1] == "" and new[-1] == "":
+            old.pop()
+            new.pop()
+        position = _find_block(lines, old, hint + offset)
+        if position < 0:
+            raise PatchError(f"Hunk at line {hint + 1} does not match the current code")
+        lines[position:position + len(old)] = new
+        offset += len(new) - len(old)
+
+    return "\n".join(lines)
+
+
+def _find_block(lines: list[str], block: list[str], hint: int) -> int:
+    if not block:
+        return max(0, min(hint, len(lines)))
+    normalized = [l.rstrip() for l in block]
+    candidates = range(len(lines) - len(block) + 1)
+    for start in sorted(candidates, key=lambda i: abs(i - hint)):
+        if [l.rstrip() for l in lines[start:start + len(block)]] == normalized:
+            return start
+    return -1
+
+
+# --- draw.io cell operations ----------------------------------------------------------
+
+def apply_cell_ops(xml: str, operations: list[dict]) -> str:
+    """
+    Applies cell-level operations to a draw.io document:
+      {"op": "add", "cell": "<mxCell .../>"}
+      {"op": "update", "id": "...", "attrs": {...}, "geometry": {...}}
+      {"op": "remove", "id": "..."}   (also removes its descendants and every edge attached to them)
+    Raises PatchError on any failure.
+    """
+    if not isinstance(operations, list):
+        raise PatchError("Cell operations must be an array")
+    try:
+        document = ET.fromstring(xml)
+    except ET.ParseError as e:
+        raise PatchError(f"Current diagram is not valid XML: {e}")
+
+    root = document if document.tag == "root" else document.find(".//root")
+    if root is None:
+        raise PatchError("No <root> element in the current diagram")
+
+    def find_cell(cell_id: str):
+        for cell in root:
+            if cell.get("id") == cell_id:
+                return cell
+        raise PatchError(f"Cell {cell_id!r} not found")
+
+    def attributes(operation: dict, field: str, numeric: bool = False) -> dict[str, str]:
+        """An {attribute: scalar} object of the operation, as XML attribute strings."""
+        values = operation.get(field) or {}
+        if not isinstance(values, dict):
+            raise PatchError(f"{field!r} must be an object, got {values!r}")
+        result = {}
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise PatchError(f"Invalid {field} value for {key!r}: {value!r}")
+            if numeric:
+                try:
+                    float(value)
+                except ValueError:
+                    raise PatchError(f"Geometry {key!r} must be a number, got {value!r}")
+            result[key] = str(value)
+        return result
+
+    for operation in operations:
+        op = operation.get("op") if isinstance(operation, dict) else None
+        if op == "add":
+            if not isinstance(operation.get("cell"), str):
+                raise PatchError(f"'cell' must be an <mxCell> XML string: {operation!r}")
+            try:
+                cell = ET.fromstring(operation["cell"])
+            except ET.ParseError as e:
+                raise PatchError(f"Invalid cell XML: {e}")
+            if cell.tag != "mxCell":
+                raise PatchError(f"Expected an <mxCell>, got <{cell.tag}>")
+            if any(c.get("id") == cell.get("id") for c in root):
+                raise PatchError(f"Cell {cell.get('id')!r} already exists")
+            root.append(cell)
+        elif op == "update":
+            cell = find_cell(operation.get("id"))
+            attrs, geometry_attrs = attributes(operation, "attrs"), attributes(operation, "geometry", numeric=True)
+            for key, value in attrs.items():
+                cell.set(key, value)
+            if geometry_attrs:
+                geometry = cell.find("mxGeometry")
+                if geometry is None:
+                    geometry = ET.SubElement(cell, "mxGeometry", {"as": "geometry"})
+                for key, value in geometry_attrs.items():
+                    geometry.set(key, value)
+        elif op == "remove":
+            removed = [find_cell(operation.get("id"))]
+            removed_ids = {removed[0].get("id")}
+            # Children (and their children...) go with their container, edges with either end
+            while True:
+                cascade = [
+                    cell for cell in root
+                    if cell not in removed
+                    and any(cell.get(key) in removed_ids for key in ("parent", "source", "target"))
+                ]
+                if not cascade:
+                    break
+                removed += cascade
+                removed_ids |= {cell.get("id") for cell in cascade}
+            for cell in removed:
+                root.remove(cell)
+        else:
+            raise PatchError(f"Unknown operation {operation!r}")
+
+    return ET.tostring(document, encoding="unicode")
+
+
+# --- Edit mode ------------------------------------------------------------------------
+
+EDIT_INSTRUCTIONS = {
+    "json": """
+
+### EDIT MODE (OVERRIDES THE OUTPUT FORMAT ABOVE)
+The current code is shown below. Do NOT re-emit it. Return ONLY an RFC 6902 JSON Patch:
+a JSON array of operations such as
+[{"op": "replace", "path": "/nodes/3/data/label", "value": "New label"}, {"op": "add", "path": "/edges/-", "value": {...}}]
+Use the exact paths of the current code. No markdown, no explanations.
+""",
+    "lines": """
+
+### EDIT MODE (OVERRIDES THE OUTPUT FORMAT ABOVE)
+The current code is shown below. Do NOT re-emit it. Return ONLY a unified diff against it:
+hunks starting with `@@ -<line>,<count> +<line>,<count> @@`, followed by lines prefixed with
+' ' (unchanged context, include 2 lines around each change), '-' (removed) or '+' (added).
+No markdown fences, no explanations.
+""",
+    "cells": """
+
+### EDIT MODE (OVERRIDES THE OUTPUT FORMAT ABOVE)
+The current diagram is shown below. Do NOT re-emit it. Return ONLY a JSON array of cell operations:
+- {"op": "add", "cell": "<mxCell id=\\"n10\\" value=\\"Cache\\" style=\\"...\\" vertex=\\"1\\" parent=\\"1\\"><mxGeometry x=\\"0\\" y=\\"0\\" width=\\"120\\" height=\\"60\\" as=\\"geometry\\"/></mxCell>"}
+- {"op": "update", "id": "<cell id>", "attrs": {"value": "...", "style": "..."}, "geometry": {"x": "...", "y": "..."}}
+- {"op": "remove", "id": "<cell id>"}
+Use ids that exist in the current diagram. No markdown, no explanations.
+""",
+}
+
+
+def _strip_output(content: str) -> str:
+    content = re.sub(r'<think>[\s\S]*?</think>', '', content, flags=re.DOTALL).strip()
+    content = re.sub(r'^```[a-zA-Z]*\n', '', content)
+    content = re.sub(r'\n?```$', '', content)
+    return content.strip()
+
+
+def apply_edit(patch_format: str, current_code: str, output: str) -> str:
+    """Validates and applies a model-produced patch to the current code."""
+    output = _strip_output(output)
+    if patch_format == "lines":
+        return apply_line_diff(current_code, output)
+
+    try:
+        operations = json.loads(output)
+    except ValueError as e:
+        raise PatchError(f"Patch is not valid JSON: {e}")
+
+    if patch_format == "cells":
+        return apply_cell_ops(current_code, operations)
+
+    try:
+        document = json.loads(current_code)
+    except ValueError as e:
+        raise PatchError(f"Current code is not valid JSON: {e}")
+    return json.dumps(apply_json_patch(document, operations), ensure_ascii=False, indent=2)
+
+
+async def generate_edit(llm, patch_format: str, system_msg: str, messages: list, instruction: str, current_code: str) -> str | None:
+    """
+    Asks the model for a compact patch against current_code instead of the whole diagram.
+    Returns the patched code, or None when the patch doesn't apply (the caller then falls
+    back to full regeneration).
+    """
+    system_msg = system_msg + EDIT_INSTRUCTIONS[patch_format] + f"\n### CURRENT CODE\n```\n{current_code}\n```"
+    tail = [HumanMessage(content=f"Instruction: {instruction}")] if instruction else []
+    prompt = assemble_context(system_msg, messages, "tool", agent=f"edit:{patch_format}", tail=tail)
+
+    full_content = ""
+    # Short edits are admitted ahead of full generations
+    with llm_priority(PRIORITY_EDIT):
+        async for chunk in llm.astream(prompt, config={"tags": [EDIT_TAG]}):
+            if chunk.content:
+                full_content += chunk.content
+
+    try:
+        return apply_edit(patch_format, current_code, full_content)
+    except PatchError as e:
+        logger.warning(f"✏️ Edit patch rejected ({patch_format}): {e}. Falling back to full regeneration.")
+        return None
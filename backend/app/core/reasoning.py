@@ -0,0 +1,56 @@
+import re
+
+OPEN_TAG = "<think>"
+CLOSE_TAG = "</think>"
+
+_THINK_BLOCK = re.compile(r"<think>[\s\S]*?(</think>|$)")
+
+
+def strip_reasoning(text: str) -> str:
+    """Removes <think> blocks (including an unterminated trailing one)."""
+    return _THINK_BLOCK.sub("", text).strip()
+
+
+def _partial_tag(text: str, tag: str) -> int:
+    """Length of the longest suffix of `text` that is a prefix of `tag`."""
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkTagSplitter:
+    """
+    Splits a token stream into reasoning (inside <think>...</think>) and content. Tags may be
+    split across chunks: a trailing partial tag is held back until the next chunk (or flush).
+    """
+
+    def __init__(self):
+        self.inside = False
+        self.buffer = ""
+
+    def feed(self, text: str) -> list[tuple[bool, str]]:
+        """Returns (is_reasoning, text) fragments, in order; tags themselves are dropped."""
+        self.buffer += text
+        fragments = []
+        while self.buffer:
+            tag = CLOSE_TAG if self.inside else OPEN_TAG
+            index = self.buffer.find(tag)
+            if index >= 0:
+                if index:
+                    fragments.append((self.inside, self.buffer[:index]))
+                self.buffer = self.buffer[index + len(tag):]
+                self.inside = not self.inside
+                continue
+            keep = _partial_tag(self.buffer, tag)
+            ready = self.buffer[:len(self.buffer) - keep]
+            if ready:
+                fragments.append((self.inside, ready))
+            self.buffer = self.buffer[len(ready):]
+            break
+        return fragments
+
+    def flush(self) -> list[tuple[bool, str]]:
+        fragments = [(self.inside, self.buffer)] if self.buffer else []
+        self.buffer = ""
+        return fragments
@@ -0,0 +1,116 @@
+import asyncio
+import json
+from typing import AsyncGenerator, AsyncIterator
+
+# Streaming content events that can be merged by concatenating one (str or list) field
+COALESCE_FIELDS = {
+    "thought": "content",
+    "tool_code": "content",
+    "tool_args_stream": "args",
+    "diagram_patch": "patches",
+}
+
+_DONE = object()
+
+
+def format_sse(event: str, data: dict, event_id: int | None = None) -> str:
+    """Serializes one event into an SSE frame, optionally tagged with an `id:` for resumption."""
+    frame = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    if event_id is not None:
+        frame = f"id: {event_id}\n" + frame
+    return frame
+
+
+def _field_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(json.dumps(value))
+
+
+async def coalesce_events(
+    events: AsyncIterator[tuple[str, dict]],
+    flush_ms: int,
+    max_bytes: int,
+) -> AsyncGenerator[tuple[str, dict], None]:
+    """
+    Merges content events of the same type (see COALESCE_FIELDS) into a single event.
+    Merged events are flushed, in arrival order, once the oldest is flush_ms old, once they
+    hold max_bytes of content, or right before any non-content event so lifecycle ordering
+    (tool_start/tool_end...) is preserved. flush_ms <= 0 passes every event through
+    unchanged (one frame per token).
+    """
+    if flush_ms <= 0:
+        async for item in events:
+            yield item
+        return
+
+    # The upstream is drained by a separate task so pending merges can be flushed on
+    # time even while the model is silent.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1024)
+
+    async def pump():
+        try:
+            async for item in events:
+                await queue.put(item)
+            await queue.put(_DONE)
+        except Exception as e:
+            await queue.put(e)
+
+    pump_task = asyncio.create_task(pump())
+    loop = asyncio.get_running_loop()
+    window = flush_ms / 1000
+
+    # event type -> merged payload, in order of first arrival
+    pending: dict[str, dict] = {}
+    pending_bytes = 0
+    deadline = 0.0
+
+    try:
+        while True:
+            timeout = None if not pending else max(0.0, deadline - loop.time())
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                for merged in pending.items():
+                    yield merged
+                pending.clear()
+                continue
+
+            if item is _DONE or isinstance(item, Exception):
+                for merged in pending.items():
+                    yield merged
+                pending.clear()
+                if isinstance(item, Exception):
+                    raise item
+                break
+
+            event, data = item
+            field = COALESCE_FIELDS.get(event)
+
+            if field is None:
+                for merged in pending.items():
+                    yield merged
+                pending.clear()
+                yield item
+                continue
+
+            if not pending:
+                pending_bytes = 0
+                deadline = loop.time() + window
+            pending_bytes += _field_size(data.get(field))
+            if event in pending:
+                pending[event][field] = pending[event][field] + data[field]
+            else:
+                pending[event] = dict(data)
+
+            if pending_bytes >= max_bytes:
+                for merged in pending.items():
+                    yield merged
+                pending.clear()
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+            try:
+                await pump_task
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -0,0 +1,172 @@
+import asyncio
+import re
+from langchain_core.messages import BaseMessage, SystemMessage
+from app.core.config import settings
+from app.core.logger import logger
+
+# Rough cost of one image input (a 512px tile plus base cost on OpenAI-style models)
+IMAGE_TOKENS = 765
+# Don't bother keeping a truncated message with less room than this
+MIN_TRUNCATED_TOKENS = 200
+TRUNCATION_MARKER = "\n...[truncated]"
+
+_CJK = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+# tiktoken's cl100k_base once load_encoding() has run; until then (or without tiktoken)
+# counts use the heuristic
+_encoding = None
+
+
+def load_encoding():
+    """Loads cl100k_base. Blocking: tiktoken may download its BPE file (see TIKTOKEN_CACHE_DIR)."""
+    global _encoding
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("cl100k_base")
+        logger.info("🔢 tiktoken cl100k_base loaded for token counts")
+    except Exception as e:
+        logger.info(f"tiktoken unavailable ({e}), using heuristic token counts")
+
+
+async def warm_up_encoding():
+    """Startup hook: loads the encoding in a worker thread so the event loop never waits on it."""
+    await asyncio.to_thread(load_encoding)
+
+
+def _get_encoding():
+    # Never loads on the request path: a first request would block on the download
+    return _encoding
+
+
+def count_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Heuristic: ~1 token per CJK character, ~4 characters per token otherwise
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(msg: BaseMessage) -> int:
+    tokens = 4  # role and message framing
+    content = msg.content
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+            elif isinstance(part, dict):
+                tokens += count_text_tokens(part.get("text", ""))
+            else:
+                tokens += count_text_tokens(str(part))
+    else:
+        tokens += count_text_tokens(str(content))
+    for call in getattr(msg, "tool_calls", None) or []:
+        tokens += count_text_tokens(call.get("name", "")) + count_text_tokens(str(call.get("args", "")))
+    return tokens
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Keeps the beginning of `text` within max_tokens (deterministic)."""
+    budget = max(0, max_tokens - count_text_tokens(TRUNCATION_MARKER))
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:budget]) + TRUNCATION_MARKER
+    if count_text_tokens(text) <= max_tokens:
+        return text
+    # Binary search on the prefix length
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_text_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + TRUNCATION_MARKER
+
+
+def _strip_images(msg: BaseMessage) -> BaseMessage:
+    """Older turns keep their text only; images are replaced with a placeholder."""
+    if not isinstance(msg.content, list):
+        return msg
+    parts = []
+    for part in msg.content:
+        if isinstance(part, dict) and part.get("type") == "image_url":
+            parts.append("[image]")
+        elif isinstance(part, dict):
+            parts.append(part.get("text", ""))
+        else:
+            parts.append(str(part))
+    return msg.model_copy(update={"content": " ".join(p for p in parts if p)})
+
+
+def role_budget(role: str) -> int:
+    return {
+        "router": settings.CONTEXT_BUDGET_ROUTER,
+        "agent": settings.CONTEXT_BUDGET_AGENT,
+        "tool": settings.CONTEXT_BUDGET_TOOL,
+    }.get(role, 0)
+
+
+def assemble_context(
+    system: str | SystemMessage | None,
+    messages: list[BaseMessage],
+    role: str,
+    agent: str = "",
+    tail: list[BaseMessage] | None = None,
+) -> list[BaseMessage]:
+    """
+    Builds [system] + history + tail within the role's token budget (CONTEXT_BUDGET_*;
+    0 = unlimited). Always kept: the system prompt (which carries the current artifact),
+    the running conversation summary (a system message in the history), `tail`, and the
+    current turn, i.e. everything from the latest user message on (tool calls and their
+    results stay paired). Earlier turns are added newest first, without
+    images; the first one that doesn't fit is truncated if enough room is left, and
+    everything older is dropped.
+    """
+    if isinstance(system, str):
+        system = SystemMessage(content=system)
+    head = [system] if system is not None else []
+    tail = tail or []
+
+    # The current turn starts at the latest user message
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].type == "human":
+            start = i
+            break
+    current, history = list(messages[start:]), messages[:start]
+    pinned = [m for m in history if m.type == "system"]
+    history = [m for m in history if m.type != "system"]
+
+    budget = role_budget(role)
+    used = sum(count_message_tokens(m) for m in head + pinned + current + tail)
+    kept: list[BaseMessage] = []
+    truncated = 0
+
+    for msg in reversed(history):
+        msg = _strip_images(msg)
+        cost = count_message_tokens(msg)
+        if not budget or used + cost <= budget:
+            kept.append(msg)
+            used += cost
+            continue
+        room = budget - used - 4
+        if room >= MIN_TRUNCATED_TOKENS and isinstance(msg.content, str):
+            msg = msg.model_copy(update={"content": truncate_text(msg.content, room)})
+            kept.append(msg)
+            used += count_message_tokens(msg)
+            truncated += 1
+        break
+
+    kept.reverse()
+    dropped = len(history) - len(kept)
+    logger.info(
+        f"🧮 Context [{role}{'/' + agent if agent else ''}]: {used} tokens"
+        f"{f' of {budget}' if budget else ''}, history {len(kept)}/{len(history)} messages"
+        f" ({truncated} truncated, {dropped} dropped)"
+    )
+    return head + pinned + kept + current + tail
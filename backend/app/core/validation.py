@@ -0,0 +1,485 @@
+import functools
+import json
+import re
+import xml.etree.ElementTree as ET
+from langchain_core.messages import SystemMessage, HumanMessage
+from app.core.config import settings
+from app.core.llm import llm_priority, PRIORITY_EDIT
+from app.core.logger import logger
+from app.core.patching import EDIT_TAG
+from app.core.reasoning import strip_reasoning
+
+
+class ArtifactError(ValueError):
+    """Raised when generated output is invalid and can't be repaired locally."""
+
+    def __init__(self, message: str, line: int | None = None):
+        super().__init__(message)
+        self.line = line
+
+
+def _strip_fences(text: str) -> str:
+    text = re.sub(r'^```[a-zA-Z]*\n', '', text.strip())
+    return re.sub(r'\n?```$', '', text).strip()
+
+
+def _json_object(text: str) -> str:
+    """First "{" to last "}" (what the tools extracted before validation), else the unfenced text."""
+    match = re.search(r'(\{[\s\S]*\})', text)
+    return match.group(1).strip() if match else _strip_fences(text)
+
+
+def _code_block(text: str) -> str:
+    match = re.search(r'```(?:\w+)?\n([\s\S]*?)```', text)
+    return match.group(1).strip() if match else text.strip()
+
+
+# --- JSON (flow, charts) ----------------------------------------------------------------
+
+def _rstrip_comma(out: list[str]) -> bool:
+    """Drops a trailing comma (before whitespace) from the output buffer."""
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+        return True
+    return False
+
+
+def repair_json(text: str) -> tuple[object, str, list[str]]:
+    """
+    Parses the first JSON object in `text`, repairing comments, trailing commas, stray or
+    missing closing brackets and an unterminated string on the way. Returns
+    (document, json text, repairs). Raises ArtifactError if it still doesn't parse.
+    """
+    start = text.find("{")
+    if start < 0:
+        raise ArtifactError("No JSON object found")
+
+    out: list[str] = []
+    stack: list[str] = []
+    repairs: set[str] = set()
+    in_string = escaped = False
+    i, n = start, len(text)
+    while i < n:
+        c = text[i]
+        if in_string:
+            out.append(c)
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+            i += 1
+            continue
+        if text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            repairs.add("comments")
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            repairs.add("comments")
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if _rstrip_comma(out):
+                repairs.add("trailing commas")
+            if not stack or stack[-1] != c:
+                repairs.add("stray brackets")
+                i += 1
+                continue
+            stack.pop()
+            if not stack:
+                out.append(c)
+                break
+        out.append(c)
+        i += 1
+
+    if in_string:
+        out.append('"')
+        repairs.add("unterminated string")
+    if stack:
+        repairs.add("unclosed brackets")
+        while stack:
+            _rstrip_comma(out)
+            if "".join(out).rstrip().endswith(":"):
+                out.append(" null")
+            out.append(stack.pop())
+
+    source = "".join(out)
+    try:
+        return json.loads(source), source, sorted(repairs)
+    except json.JSONDecodeError as e:
+        raise ArtifactError(f"Invalid JSON: {e.msg} (line {e.lineno}, column {e.colno})", line=e.lineno)
+
+
+def _dump(doc) -> str:
+    return json.dumps(doc, ensure_ascii=False, indent=2)
+
+
+def repair_flow(text: str, positions: bool = True) -> tuple[str, list[str]]:
+    """
+    React Flow JSON: unique node ids, labels, edges between existing nodes and, unless the
+    server lays the flow out (positions=False), a position for every node.
+    """
+    doc, source, repairs = repair_json(text)
+    if not isinstance(doc, dict) or not isinstance(doc.get("nodes"), list):
+        raise ArtifactError('Flowchart JSON needs a "nodes" array')
+
+    nodes, ids = [], set()
+    for index, node in enumerate(doc["nodes"]):
+        if not isinstance(node, dict):
+            repairs.append("invalid nodes")
+            continue
+        node_id = str(node.get("id") or f"n{index + 1}")
+        if node_id in ids:
+            suffix = 2
+            while f"{node_id}-{suffix}" in ids:
+                suffix += 1
+            node_id = f"{node_id}-{suffix}"
+            repairs.append("duplicate node ids")
+        if node.get("id") != node_id:
+            node["id"] = node_id
+        if positions and not isinstance(node.get("position"), dict):
+            node["position"] = {"x": 0, "y": index * 100}
+            repairs.append("missing positions")
+        if not isinstance(node.get("data"), dict):
+            node["data"] = {"label": node_id}
+            repairs.append("missing labels")
+        ids.add(node_id)
+        nodes.append(node)
+
+    edges, edge_ids = [], set()
+    for edge in doc.get("edges") if isinstance(doc.get("edges"), list) else []:
+        if not isinstance(edge, dict) or str(edge.get("source")) not in ids or str(edge.get("target")) not in ids:
+            repairs.append("dangling edges")
+            continue
+        edge_id = str(edge.get("id") or f"e{edge['source']}-{edge['target']}")
+        while edge_id in edge_ids:
+            edge_id += "'"
+            repairs.append("duplicate edge ids")
+        edge["id"] = edge_id
+        edge_ids.add(edge_id)
+        edges.append(edge)
+
+    doc["nodes"], doc["edges"] = nodes, edges
+    return (_dump(doc) if repairs else source), sorted(set(repairs))
+
+
+def repair_charts(text: str) -> tuple[str, list[str]]:
+    """ECharts option. JavaScript literals (formatter functions) are left to the frontend."""
+    try:
+        doc, source, repairs = repair_json(text)
+    except ArtifactError:
+        if re.search(r"\bfunction\b|=>", text):
+            return text[text.find("{"):].strip(), []
+        raise
+    if not isinstance(doc, dict):
+        raise ArtifactError("ECharts option must be a JSON object")
+    if "series" not in doc:
+        raise ArtifactError('ECharts option has no "series"')
+    return (_dump(doc) if repairs else source), repairs
+
+
+# --- draw.io XML ------------------------------------------------------------------------
+
+_TAG = re.compile(r"<(/?)([A-Za-z_][\w:.-]*)[^<>]*?(/?)>")
+_BARE_AMPERSAND = re.compile(r"&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)")
+
+
+def _close_xml(xml: str) -> str:
+    """Drops a trailing partial tag and closes every element left open."""
+    last_open, last_close = xml.rfind("<"), xml.rfind(">")
+    if last_open > last_close:
+        xml = xml[:last_open]
+    stack = []
+    for match in _TAG.finditer(xml):
+        closing, name, self_closing = match.groups()
+        if self_closing:
+            continue
+        if not closing:
+            stack.append(name)
+        elif name in stack:
+            while stack and stack.pop() != name:
+                pass
+    return xml + "".join(f"</{name}>" for name in reversed(stack))
+
+
+def repair_drawio(text: str) -> tuple[str, list[str]]:
+    """Well-formed mxfile/mxGraphModel with unique cell ids and no dangling edges."""
+    repairs = []
+    starts = [i for i in (text.find("<mxfile"), text.find("<mxGraphModel")) if i >= 0]
+    if starts:
+        xml = text[min(starts):]
+    elif "<mxCell" in text:
+        xml = "<mxGraphModel><root>" + text[text.find("<mxCell"):] + "</root></mxGraphModel>"
+        repairs.append("missing mxGraphModel")
+    else:
+        raise ArtifactError("No <mxfile> or <mxGraphModel> found")
+    for closing in ("</mxfile>", "</mxGraphModel>"):
+        end = xml.rfind(closing)
+        if end >= 0:
+            xml = xml[:end + len(closing)]
+            break
+
+    try:
+        document = ET.fromstring(xml)
+    except ET.ParseError:
+        xml = _close_xml(_BARE_AMPERSAND.sub("&amp;", xml))
+        repairs.append("malformed XML")
+        try:
+            document = ET.fromstring(xml)
+        except ET.ParseError as e:
+            raise ArtifactError(f"Invalid XML: {e}", line=e.position[0])
+
+    for root in document.iter("root"):
+        cells = [c for c in root if c.tag == "mxCell"]
+        ids = set()
+        for cell in cells:
+            cell_id = cell.get("id")
+            if cell_id is None or cell_id in ids:
+                suffix = 2
+                base = cell_id or "cell"
+                while f"{base}-{suffix}" in ids:
+                    suffix += 1
+                cell.set("id", f"{base}-{suffix}")
+                repairs.append("duplicate cell ids")
+            ids.add(cell.get("id"))
+        for cell in cells:
+            if cell.get("edge") == "1" and any(cell.get(end) and cell.get(end) not in ids for end in ("source", "target")):
+                root.remove(cell)
+                repairs.append("dangling edges")
+        if "0" not in ids:
+            root.insert(0, ET.Element("mxCell", {"id": "0"}))
+            repairs.append("missing root cells")
+        if "1" not in ids:
+            root.insert(1, ET.Element("mxCell", {"id": "1", "parent": "0"}))
+            repairs.append("missing root cells")
+
+    if not repairs:
+        return xml, []
+    return ET.tostring(document, encoding="unicode"), sorted(set(repairs))
+
+
+def repair_drawio_ir(text: str) -> tuple[str, list[str]]:
+    """
+    Compact draw.io IR (DRAWIO_MODE=ir): unique ids across groups and nodes, containers that
+    exist and don't nest in a cycle, edges between existing elements.
+    """
+    doc, source, repairs = repair_json(text)
+    if not isinstance(doc, dict) or not isinstance(doc.get("nodes"), list):
+        raise ArtifactError('Diagram IR needs a "nodes" array')
+
+    ids = set()
+    for kind in ("groups", "nodes"):
+        items = []
+        for index, item in enumerate(doc.get(kind) if isinstance(doc.get(kind), list) else []):
+            if not isinstance(item, dict):
+                repairs.append(f"invalid {kind}")
+                continue
+            item_id = str(item.get("id") or f"{kind[0]}{index + 1}")
+            if item_id in ids:
+                suffix = 2
+                while f"{item_id}-{suffix}" in ids:
+                    suffix += 1
+                item_id = f"{item_id}-{suffix}"
+                repairs.append("duplicate ids")
+            item["id"] = item_id
+            ids.add(item_id)
+            items.append(item)
+        doc[kind] = items
+
+    groups = {g["id"]: g for g in doc["groups"]}
+    for item, key in [(g, "parent") for g in doc["groups"]] + [(n, "group") for n in doc["nodes"]]:
+        if item.get(key) is None:
+            item.pop(key, None)
+        elif str(item[key]) in groups:
+            item[key] = str(item[key])
+        else:
+            item.pop(key)
+            repairs.append("unknown containers")
+    for group in doc["groups"]:
+        # Drop the link that closes the cycle, not the one this walk started from
+        seen, item = {group["id"]}, group
+        while item.get("parent") is not None:
+            if item["parent"] in seen:
+                item.pop("parent")
+                repairs.append("nested container cycle")
+                break
+            item = groups[item["parent"]]
+            seen.add(item["id"])
+
+    edges = []
+    for edge in doc.get("edges") if isinstance(doc.get("edges"), list) else []:
+        if not isinstance(edge, dict) or str(edge.get("from")) not in ids or str(edge.get("to")) not in ids:
+            repairs.append("dangling edges")
+            continue
+        edges.append(edge)
+    doc["edges"] = edges
+    return (_dump(doc) if repairs else source), sorted(set(repairs))
+
+
+# --- Text DSLs (mermaid, mindmap, infographic) ------------------------------------------
+
+MERMAID_TYPES = re.compile(
+    r"^(graph|flowchart|sequenceDiagram|classDiagram|stateDiagram(-v2)?|erDiagram|gantt|pie|journey|"
+    r"gitGraph|mindmap|timeline|quadrantChart|requirementDiagram|C4\w+|xychart(-beta)?|sankey(-beta)?|"
+    r"block(-beta)?|packet(-beta)?|kanban|architecture(-beta)?)\b"
+)
+# Lines opening a block that must be closed with `end`
+MERMAID_BLOCKS = re.compile(r"^(subgraph|loop|alt|opt|par|critical|break|rect|box)\b")
+_QUOTED = re.compile(r'"[^"]*"|\|[^|]*\|')
+# Asymmetric flowchart node, e.g. A>label]
+_ASYMMETRIC = re.compile(r"\w>(?!>)")
+# Inline HTML in unquoted labels, e.g. A[Line 1<br>Line 2] or <b>bold</b>
+_HTML_TAG = re.compile(r"</?[a-zA-Z][\w-]*(?:\s[^<>]*)?/?>")
+
+
+def repair_mermaid(text: str) -> tuple[str, list[str]]:
+    """
+    Known diagram type first, every block closed with `end`; flowcharts also need balanced
+    quotes and brackets on each line (other types allow free text in messages).
+    """
+    repairs = []
+    lines = text.strip().split("\n")
+    header = next((i for i, l in enumerate(lines) if MERMAID_TYPES.match(l.strip())), None)
+    if header is None:
+        raise ArtifactError("No mermaid diagram type (graph, sequenceDiagram, ...) found", line=1)
+    if header and any(not l.strip().startswith(("%%", "---")) and l.strip() for l in lines[:header]):
+        lines = lines[header:]
+        repairs.append("leading text")
+
+    flowchart = lines[0].strip().startswith(("graph", "flowchart"))
+    open_blocks = 0
+    for number, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if stripped.startswith("%%"):
+            continue
+        if flowchart:
+            if stripped.count('"') % 2:
+                raise ArtifactError(f"Unbalanced quotes on line {number}: {stripped}", line=number)
+            bare = _HTML_TAG.sub("", _QUOTED.sub("", stripped))
+            opened = {"[": bare.count("[") + len(_ASYMMETRIC.findall(bare)), "(": bare.count("("), "{": bare.count("{")}
+            for opening, closing in ("[]", "()", "{}"):
+                if opened[opening] != bare.count(closing):
+                    raise ArtifactError(f"Unbalanced {opening}{closing} on line {number}: {stripped}", line=number)
+        if MERMAID_BLOCKS.match(stripped):
+            open_blocks += 1
+        elif stripped == "end" and open_blocks:
+            open_blocks -= 1
+    if open_blocks:
+        lines += ["end"] * open_blocks
+        repairs.append("unclosed blocks")
+    return "\n".join(lines), repairs
+
+
+def repair_mindmap(text: str) -> tuple[str, list[str]]:
+    """Markdown outline with at least one heading (the root)."""
+    lines = [l for l in text.strip().split("\n")]
+    if not any(l.strip() for l in lines):
+        raise ArtifactError("Empty mindmap")
+    if any(l.lstrip().startswith("#") for l in lines):
+        return "\n".join(lines), []
+    first = next(i for i, l in enumerate(lines) if l.strip())
+    lines[first] = "# " + lines[first].strip().lstrip("-*+ ").strip()
+    return "\n".join(lines), ["missing root heading"]
+
+
+def repair_infographic(text: str) -> tuple[str, list[str]]:
+    """`infographic <template>` header, a data block, two-space indentation."""
+    repairs = []
+    lines = text.strip().split("\n")
+    header = next((i for i, l in enumerate(lines) if l.startswith("infographic")), None)
+    if header is None:
+        raise ArtifactError("No `infographic <template-name>` line found", line=1)
+    if header:
+        lines = lines[header:]
+        repairs.append("leading text")
+    if len(lines[0].split()) < 2:
+        raise ArtifactError("Missing template name after `infographic`", line=1)
+    if any("\t" in l for l in lines):
+        lines = [l.replace("\t", "  ") for l in lines]
+        repairs.append("tabs")
+    for number, line in enumerate(lines, 1):
+        indent = len(line) - len(line.lstrip(" "))
+        if line.strip() and indent % 2:
+            raise ArtifactError(f"Odd indentation on line {number}: {line.strip()}", line=number)
+    if not any(l.strip() == "data" and not l.startswith(" ") for l in lines):
+        raise ArtifactError("Missing `data` block")
+    return "\n".join(lines), repairs
+
+
+# --- Validation stage -----------------------------------------------------------------
+
+# format -> (extract, repair, label)
+FORMATS = {
+    "flow": (_json_object, repair_flow, "React Flow JSON"),
+    "flow_topology": (_json_object, functools.partial(repair_flow, positions=False), "React Flow JSON"),
+    "charts": (_json_object, repair_charts, "ECharts option JSON"),
+    "drawio": (_strip_fences, repair_drawio, "draw.io XML"),
+    "drawio_ir": (_json_object, repair_drawio_ir, "draw.io diagram IR"),
+    "mermaid": (_strip_fences, repair_mermaid, "Mermaid code"),
+    "mindmap": (_code_block, repair_mindmap, "Markdown mindmap"),
+    "infographic": (_code_block, repair_infographic, "AntV Infographic DSL"),
+}
+
+FIX_PROMPT = """The {label} below was cut from a larger document that failed validation:
+{error}
+
+Return ONLY the corrected version of exactly these lines (the same range, fixed), so it can
+be pasted back in place. No markdown fences, no explanations."""
+
+
+async def llm_fix(llm, label: str, text: str, error: ArtifactError) -> str:
+    """Asks the model to fix only the lines around the error and splices them back."""
+    lines = text.split("\n")
+    around = settings.VALIDATION_FIX_LINES
+    line = error.line or len(lines)
+    first, last = max(0, line - 1 - around), min(len(lines), line + around)
+    excerpt = "\n".join(lines[first:last])
+    prompt = [
+        SystemMessage(content=FIX_PROMPT.format(label=label, error=error)),
+        HumanMessage(content=f"Lines {first + 1}-{last}:\n{excerpt}"),
+    ]
+    # Small, latency-sensitive call; not streamed to the client
+    with llm_priority(PRIORITY_EDIT):
+        response = await llm.ainvoke(prompt, config={"tags": [EDIT_TAG]})
+    fixed = _strip_fences(strip_reasoning(str(response.content)))
+    return "\n".join(lines[:first] + [fixed] + lines[last:])
+
+
+async def validate_output(fmt: str, output: str, llm) -> str:
+    """
+    Extracts the artifact from a tool's raw output and validates it (ARTIFACT_VALIDATION):
+    cheap local repairs first, then, in "fix" mode, one LLM call on a slice around what's
+    still broken. Output that can't be fixed is returned as extracted.
+    """
+    extract, repair, label = FORMATS[fmt]
+    text = extract(strip_reasoning(output))
+    if settings.ARTIFACT_VALIDATION == "off":
+        return text
+
+    try:
+        repaired, repairs = repair(text)
+    except ArtifactError as e:
+        if settings.ARTIFACT_VALIDATION != "fix":
+            logger.warning(f"🩺 Invalid {label}: {e}")
+            return text
+        logger.info(f"🩺 Invalid {label}: {e}. Asking the model to fix it")
+        try:
+            repaired, repairs = repair(await llm_fix(llm, label, text, e))
+            repairs = ["llm fix"] + repairs
+        except Exception as fix_error:
+            logger.warning(f"🩺 Could not fix {label}: {fix_error}")
+            return text
+
+    if repairs:
+        logger.info(f"🩹 Repaired {label}: {', '.join(repairs)}")
+    return repaired
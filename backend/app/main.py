@@ -1,5 +1,6 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import sys
 import os
 import uvicorn
@@ -19,15 +20,27 @@ if settings.BACKEND_CORS_ORIGINS:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        # Read by the client to cancel or resume the generation behind a stream
+        expose_headers=["X-Generation-Id"],
     )
 
 app.include_router(api_router, prefix="/api")
 
 from app.core.database import init_db
+from app.services.routing import train_router_classifier
+from app.core.llm import llm_registry
+from app.core.tokens import warm_up_encoding
 
 @app.on_event("startup")
 async def on_startup():
     await init_db()
+    await train_router_classifier()
+    # Heuristic token counts until tiktoken is ready; a slow download doesn't hold up startup
+    app.state.encoding_task = asyncio.create_task(warm_up_encoding())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await llm_registry.aclose()
 
 @app.get("/")
 async def root():
@@ -0,0 +1,14 @@
+from datetime import datetime
+from sqlmodel import Field, SQLModel
+from app.models.chat import utc_now
+
+class GenerationCacheEntry(SQLModel, table=True):
+    __tablename__ = "generation_cache"
+
+    key: str = Field(primary_key=True, max_length=64)
+    agent: str = Field(index=True)
+    value: str
+    created_at: datetime = Field(default_factory=utc_now)
+    expires_at: datetime = Field(index=True)
+    last_hit_at: datetime = Field(default_factory=utc_now, index=True)
+    hits: int = Field(default=0)
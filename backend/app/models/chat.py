@@ -27,9 +27,13 @@ class ChatMessage(SQLModel, table=True):
     parent_id: Optional[int] = Field(default=None, foreign_key="chatmessage.id")
     role: str # "user" or "assistant"
     content: str
+    # Model reasoning (<think>), kept out of content so it's never sent back as history
+    reasoning: Optional[str] = Field(default=None)
     images: Optional[List[str]] = Field(default=None, sa_column=Column(JSON))
     steps: Optional[List[Any]] = Field(default=None, sa_column=Column(JSON))
     agent: Optional[str] = Field(default=None)
+    # Who chose the agent: explicit / llm / classifier / fallback (router_node)
+    routing_source: Optional[str] = Field(default=None)
     turn_index: int = Field(default=0)
     created_at: datetime = Field(default_factory=utc_now)
     
@@ -40,3 +44,45 @@ class ChatMessage(SQLModel, table=True):
         if dt.tzinfo is None:
             return dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
         return dt.isoformat().replace("+00:00", "Z")
+
+class Artifact(SQLModel, table=True):
+    """One diagram produced by a turn. Versions count up per (session, agent)."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    session_id: int = Field(foreign_key="chatsession.id", index=True)
+    message_id: Optional[int] = Field(default=None, foreign_key="chatmessage.id", index=True)
+    agent: str = Field(index=True)
+    turn_index: int = Field(default=0)
+    version: int = Field(default=1)
+    content: str
+    created_at: datetime = Field(default_factory=utc_now)
+
+    def reference(self) -> str:
+        """Short stand-in for the artifact in reconstructed history."""
+        return f"[artifact {self.agent} v{self.version}, {len(self.content)} chars]"
+
+class ConversationSummary(SQLModel, table=True):
+    """Running summary of a branch: every turn up to and including through_message_id."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    session_id: int = Field(foreign_key="chatsession.id", index=True)
+    through_message_id: int = Field(foreign_key="chatmessage.id", index=True)
+    turns: int = Field(default=0)
+    content: str
+    created_at: datetime = Field(default_factory=utc_now)
+
+class Dataset(SQLModel, table=True):
+    """A CSV/JSON upload attached to a session. Columns are stored as NumPy arrays on disk."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    session_id: int = Field(foreign_key="chatsession.id", index=True)
+    name: str
+    rows: int = Field(default=0)
+    # [{"name", "type", ...summary statistics}], what the chart agent sees instead of the data
+    columns: List[Any] = Field(default=[], sa_column=Column(JSON))
+    storage_key: str
+    size_bytes: int = Field(default=0)
+    created_at: datetime = Field(default_factory=utc_now)
+
+    @field_serializer("created_at")
+    def serialize_dt(self, dt: datetime, _info):
+        if dt.tzinfo is None:
+            return dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+        return dt.isoformat().replace("+00:00", "Z")
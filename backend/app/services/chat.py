@@ -1,6 +1,12 @@
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
-from app.models.chat import ChatSession, ChatMessage
+from sqlalchemy import func, literal, select as sa_select
+from sqlalchemy.orm import aliased
+from app.models.chat import ChatSession, ChatMessage, Artifact, ConversationSummary, Dataset
+from app.core.datasets import remove_columns
+
+# Routing decisions the local router classifier is trained on (not its own)
+TRAINING_ROUTING_SOURCES = ("llm", "explicit")
 
 class ChatService:
     def __init__(self, session: AsyncSession):
@@ -26,7 +32,9 @@ class ChatService:
         images: list[str] | None = None,
         steps: list[any] | None = None,
         agent: str | None = None,
-        parent_id: int | None = None
+        parent_id: int | None = None,
+        reasoning: str | None = None,
+        routing_source: str | None = None
     ) -> ChatMessage:
         turn_index = 0
         if parent_id:
@@ -40,9 +48,11 @@ class ChatService:
             session_id=session_id, 
             role=role, 
             content=content,
+            reasoning=reasoning,
             images=images,
             steps=steps,
             agent=agent,
+            routing_source=routing_source,
             parent_id=parent_id,
             turn_index=turn_index
         )
@@ -66,6 +76,163 @@ class ChatService:
         result = await self.session.exec(statement)
         return result.all()
 
+    async def get_message(self, message_id: int) -> ChatMessage | None:
+        statement = select(ChatMessage).where(ChatMessage.id == message_id)
+        result = await self.session.exec(statement)
+        return result.first()
+
+    def _branch(self, session_id: int, leaf_id: int, max_depth: int = 0, stop_at: int | None = None):
+        """
+        Recursive CTE of (id, parent_id, depth) walking parent_id links upwards from leaf_id.
+        The walk stops after max_depth messages (if > 0) and at stop_at (included).
+        """
+        anchor = sa_select(
+            ChatMessage.id, ChatMessage.parent_id, literal(1).label("depth")
+        ).where(ChatMessage.id == leaf_id, ChatMessage.session_id == session_id)
+        branch = anchor.cte("branch", recursive=True)
+
+        parent = aliased(ChatMessage)
+        step = sa_select(
+            parent.id, parent.parent_id, (branch.c.depth + 1).label("depth")
+        ).join(branch, parent.id == branch.c.parent_id).where(parent.session_id == session_id)
+        if max_depth > 0:
+            # Stop walking once the window is full instead of trimming afterwards
+            step = step.where(branch.c.depth < max_depth)
+        if stop_at is not None:
+            step = step.where(branch.c.id != stop_at)
+        return branch.union_all(step)
+
+    async def get_branch_history(
+        self, session_id: int, leaf_id: int | None, max_turns: int = 0, since_id: int | None = None
+    ) -> list[ChatMessage]:
+        """
+        Returns only the messages on the branch ending at leaf_id (oldest first), by walking
+        parent_id links upwards in a single recursive CTE. Retries and abandoned branches are
+        never loaded. If max_turns > 0, only the most recent max_turns turns (user + assistant
+        pairs) are returned. If since_id is given, the walk stops at that message (included).
+        """
+        if not leaf_id:
+            return []
+
+        branch = self._branch(session_id, leaf_id, max_depth=max_turns * 2, stop_at=since_id)
+        statement = select(ChatMessage).join(branch, ChatMessage.id == branch.c.id).order_by(branch.c.depth.desc())
+        result = await self.session.exec(statement)
+        return list(result.all())
+
+    async def add_artifacts(self, session_id: int, message: ChatMessage, artifacts: list[tuple[str, str]]) -> list[Artifact]:
+        """Stores the diagrams produced by an assistant message as the next version per agent."""
+        saved = []
+        for agent, content in artifacts:
+            statement = sa_select(func.max(Artifact.version)).where(
+                Artifact.session_id == session_id, Artifact.agent == agent
+            )
+            latest = (await self.session.execute(statement)).scalar()
+            artifact = Artifact(
+                session_id=session_id,
+                message_id=message.id,
+                agent=agent,
+                turn_index=message.turn_index,
+                version=(latest or 0) + 1,
+                content=content
+            )
+            self.session.add(artifact)
+            saved.append(artifact)
+        await self.session.commit()
+        return saved
+
+    async def get_artifacts(self, message_ids: list[int]) -> dict[int, list[Artifact]]:
+        """Artifacts of the given messages (e.g. one branch), grouped by message id, oldest first."""
+        if not message_ids:
+            return {}
+        statement = select(Artifact).where(Artifact.message_id.in_(message_ids)).order_by(Artifact.id)
+        result = await self.session.exec(statement)
+        grouped: dict[int, list[Artifact]] = {}
+        for artifact in result.all():
+            grouped.setdefault(artifact.message_id, []).append(artifact)
+        return grouped
+
+    async def get_summary(self, session_id: int, leaf_id: int | None) -> ConversationSummary | None:
+        """
+        Latest running summary that ends on the branch ending at leaf_id. The whole branch is
+        searched (ids only), so the summary is found even when its anchor is older than the
+        history window.
+        """
+        if not leaf_id:
+            return None
+        branch = self._branch(session_id, leaf_id)
+        statement = (
+            select(ConversationSummary)
+            .join(branch, ConversationSummary.through_message_id == branch.c.id)
+            .order_by(ConversationSummary.id.desc())
+            .limit(1)
+        )
+        result = await self.session.exec(statement)
+        return result.first()
+
+    async def add_summary(self, session_id: int, through_message_id: int, turns: int, content: str) -> ConversationSummary:
+        summary = ConversationSummary(
+            session_id=session_id,
+            through_message_id=through_message_id,
+            turns=turns,
+            content=content
+        )
+        self.session.add(summary)
+        await self.session.commit()
+        await self.session.refresh(summary)
+        return summary
+
+    async def add_dataset(self, session_id: int, name: str, rows: int, columns: list[dict], storage_key: str, size_bytes: int) -> Dataset:
+        dataset = Dataset(
+            session_id=session_id,
+            name=name,
+            rows=rows,
+            columns=columns,
+            storage_key=storage_key,
+            size_bytes=size_bytes
+        )
+        self.session.add(dataset)
+        await self.session.commit()
+        await self.session.refresh(dataset)
+        return dataset
+
+    async def get_datasets(self, session_id: int) -> list[Dataset]:
+        statement = select(Dataset).where(Dataset.session_id == session_id).order_by(Dataset.id)
+        result = await self.session.exec(statement)
+        return list(result.all())
+
+    async def delete_dataset(self, dataset_id: int) -> bool:
+        dataset = await self.session.get(Dataset, dataset_id)
+        if dataset is None:
+            return False
+        await self.session.delete(dataset)
+        await self.session.commit()
+        remove_columns(dataset.storage_key)
+        return True
+
+    async def get_routing_samples(self, limit: int = 5000) -> list[tuple[str, str | None, str]]:
+        """
+        Historical routing decisions as (user prompt, previous agent, chosen agent), newest
+        first: every assistant message whose agent was picked by the router model or an
+        explicit @mention, joined to its user message and to the assistant reply that user
+        message followed. The classifier's own (and fallback) decisions are left out so its
+        mistakes don't train it.
+        """
+        user_msg = aliased(ChatMessage)
+        previous = aliased(ChatMessage)
+        statement = (
+            sa_select(user_msg.content, previous.agent, ChatMessage.agent)
+            .join(user_msg, ChatMessage.parent_id == user_msg.id)
+            .outerjoin(previous, user_msg.parent_id == previous.id)
+            .where(
+                ChatMessage.role == "assistant", ChatMessage.agent.is_not(None), user_msg.role == "user",
+                ChatMessage.routing_source.in_(TRAINING_ROUTING_SOURCES)
+            )
+            .order_by(ChatMessage.id.desc())
+            .limit(limit)
+        )
+        result = await self.session.execute(statement)
+        return [tuple(row) for row in result.all()]
+
     async def get_all_sessions(self):
         statement = select(ChatSession).order_by(ChatSession.updated_at.desc())
         result = await self.session.exec(statement)
@@ -78,7 +245,12 @@ class ChatService:
         
         from sqlmodel import delete
         
-        # Delete messages
+        # Delete datasets (and their column files), artifacts and summaries, then messages
+        for dataset in await self.get_datasets(session_id):
+            remove_columns(dataset.storage_key)
+        await self.session.exec(delete(Dataset).where(Dataset.session_id == session_id))
+        await self.session.exec(delete(Artifact).where(Artifact.session_id == session_id))
+        await self.session.exec(delete(ConversationSummary).where(ConversationSummary.session_id == session_id))
         msg_statement = delete(ChatMessage).where(ChatMessage.session_id == session_id)
         await self.session.exec(msg_statement)
         
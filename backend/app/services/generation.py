@@ -0,0 +1,179 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator
+from app.core.config import settings
+from app.core.logger import logger
+
+# Yielded by Generation.subscribe when nothing happened for heartbeat_s seconds
+HEARTBEAT = "heartbeat"
+
+
+class TooManyGenerations(Exception):
+    """Raised when MAX_CONCURRENT_GENERATIONS runs are already in flight."""
+
+
+class Generation:
+    """
+    One LangGraph run. Every emitted event gets a sequential id and is kept in a bounded
+    ring buffer so that a client reconnecting with Last-Event-ID can replay what it missed
+    and then keep tailing the live stream.
+    """
+
+    def __init__(self, generation_id: str, buffer_size: int, detached: bool = False):
+        self.id = generation_id
+        # Detached runs are never cancelled for lack of listeners, only explicitly
+        self.detached = detached
+        self.events: deque[tuple[int, str, dict]] = deque(maxlen=buffer_size)
+        self.last_seq = 0
+        self.done = False
+        self.task: asyncio.Task | None = None
+        self.subscribers = 0
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.status = "running"
+        # Pending grace-period cancellation while nobody listens (see schedule_abandon_check)
+        self.abandon_timer: asyncio.TimerHandle | None = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, event: str, data: dict):
+        async with self._changed:
+            self.last_seq += 1
+            self.events.append((self.last_seq, event, data))
+            self._changed.notify_all()
+
+    async def finish(self):
+        async with self._changed:
+            self.done = True
+            self.finished_at = time.time()
+            self._changed.notify_all()
+
+    async def subscribe(
+        self, last_event_id: int = 0, heartbeat_s: float | None = None
+    ) -> AsyncGenerator[tuple[int | None, str, dict], None]:
+        """
+        Yields (seq, event, data) for every event after last_event_id, then follows the live
+        stream until the run finishes. If the requested events were already evicted from the
+        ring buffer, a `replay_truncated` event (seq None) is yielded first. With heartbeat_s,
+        a HEARTBEAT event (seq None) is yielded whenever the run stays silent that long.
+        """
+        cursor = last_event_id
+        self.subscribers += 1
+        if self.abandon_timer:
+            # Reconnected within the grace period
+            self.abandon_timer.cancel()
+            self.abandon_timer = None
+        try:
+            while True:
+                idle = False
+                async with self._changed:
+                    while not self.done and (not self.events or self.events[-1][0] <= cursor):
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), heartbeat_s)
+                        except asyncio.TimeoutError:
+                            idle = True
+                            break
+                    batch = [e for e in self.events if e[0] > cursor]
+
+                if idle and not batch:
+                    yield None, HEARTBEAT, {}
+                    continue
+
+                if not batch:
+                    return
+
+                if batch[0][0] > cursor + 1:
+                    yield None, "replay_truncated", {"generation_id": self.id, "first_available": batch[0][0]}
+
+                for item in batch:
+                    yield item
+                    cursor = item[0]
+        finally:
+            self.subscribers -= 1
+            generation_registry.schedule_abandon_check(self)
+
+
+class GenerationRegistry:
+    """In-process registry of running and recently finished generations."""
+
+    def __init__(self):
+        self._generations: dict[str, Generation] = {}
+
+    def get(self, generation_id: str) -> Generation | None:
+        return self._generations.get(generation_id)
+
+    def running_count(self) -> int:
+        return sum(1 for g in self._generations.values() if not g.done)
+
+    def create(self, detached: bool = False) -> Generation:
+        limit = settings.MAX_CONCURRENT_GENERATIONS
+        if limit and self.running_count() >= limit:
+            raise TooManyGenerations(f"{limit} generations already running")
+
+        generation = Generation(uuid.uuid4().hex, settings.GENERATION_BUFFER_SIZE, detached=detached)
+        self._generations[generation.id] = generation
+        return generation
+
+    def cancel(self, generation_id: str) -> Generation | None:
+        """
+        Cancels the run. Cancellation propagates into the in-flight `astream` calls, which
+        close their upstream HTTP responses, so the provider stops generating (and billing).
+        """
+        generation = self._generations.get(generation_id)
+        if generation and not generation.done and generation.task:
+            generation.status = "cancelling"
+            generation.task.cancel()
+        return generation
+
+    def run(self, generation: Generation, events: AsyncIterator[tuple[str, dict]]):
+        """Drains `events` into the generation in a background task that outlives any single connection."""
+        generation.task = asyncio.create_task(self._run(generation, events))
+        generation.task.add_done_callback(lambda _: self._on_task_done(generation))
+        # Covers a client that disconnects before it ever subscribes
+        self.schedule_abandon_check(generation)
+
+    async def _run(self, generation: Generation, events: AsyncIterator[tuple[str, dict]]):
+        try:
+            async for event, data in events:
+                await generation.publish(event, data)
+            generation.status = "completed"
+        except asyncio.CancelledError:
+            logger.info(f"🛑 Generation {generation.id} cancelled")
+            generation.status = "cancelled"
+            await generation.publish("generation_cancelled", {"generation_id": generation.id})
+        except Exception as e:
+            logger.error(f"Generation {generation.id} failed: {e}")
+            generation.status = "failed"
+            await generation.publish("error", {"message": str(e)})
+        finally:
+            await generation.finish()
+
+    def _on_task_done(self, generation: Generation):
+        if not generation.done:
+            # Cancelled before _run got to execute at all
+            generation.status = "cancelled"
+            asyncio.ensure_future(generation.finish())
+        asyncio.get_running_loop().call_later(
+            settings.GENERATION_RETENTION_S, self._generations.pop, generation.id, None
+        )
+
+    def schedule_abandon_check(self, generation: Generation):
+        # Nobody is listening any more: give the client a grace period to reconnect
+        # before the run (and its token spend) is stopped.
+        # A new timer replaces any earlier one, so every disconnect gets a full grace period.
+        if generation.subscribers == 0 and not generation.done and not generation.detached:
+            if generation.abandon_timer:
+                generation.abandon_timer.cancel()
+            generation.abandon_timer = asyncio.get_running_loop().call_later(
+                settings.GENERATION_RESUME_GRACE_S, self._cancel_if_abandoned, generation
+            )
+
+    def _cancel_if_abandoned(self, generation: Generation):
+        generation.abandon_timer = None
+        if generation.subscribers == 0 and not generation.done and generation.task:
+            logger.info(f"🔌 Generation {generation.id} abandoned, cancelling")
+            self.cancel(generation.id)
+
+
+generation_registry = GenerationRegistry()
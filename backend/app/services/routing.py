@@ -0,0 +1,76 @@
+"""
+Training and evaluation of the local router classifier against stored routing decisions.
+
+Report the agreement rate with historical routing:
+    python -m app.services.routing
+"""
+import asyncio
+import random
+from app.agents.dispatcher import IntentClassifier, intent_classifier
+from app.core.config import settings
+from app.core.database import async_session
+from app.core.logger import logger
+from app.services.chat import ChatService
+
+
+async def load_routing_samples(limit: int | None = None):
+    async with async_session() as db:
+        return await ChatService(db).get_routing_samples(limit or settings.ROUTER_CLASSIFIER_TRAINING_LIMIT)
+
+
+async def train_router_classifier():
+    """Fits the shared classifier on stored routing decisions (called at startup)."""
+    if settings.ROUTER_CLASSIFIER_THRESHOLD <= 0:
+        return
+    try:
+        samples = await load_routing_samples()
+    except Exception as e:
+        logger.error(f"Router classifier training skipped: {e}")
+        return
+    intent_classifier.fit(samples)
+    logger.info(f"🧭 Router classifier trained on {len(samples)} historical routing decisions")
+
+
+def evaluate(samples: list, threshold: float, folds: int = 5, seed: int = 0) -> dict:
+    """
+    K-fold agreement between the classifier and the historical agent:
+    - agreement: over all samples
+    - coverage: share of samples at or above the confidence threshold (no LLM call needed)
+    - confident_agreement: agreement within that share
+    """
+    samples = list(samples)
+    random.Random(seed).shuffle(samples)
+    agree = confident = confident_agree = 0
+
+    for fold in range(folds):
+        test = samples[fold::folds]
+        train = [s for i, s in enumerate(samples) if i % folds != fold]
+        classifier = IntentClassifier().fit(train)
+        for text, last_active_agent, expected in test:
+            intent, confidence = classifier.predict(text, last_active_agent or "None")
+            agree += intent == expected
+            if confidence >= threshold:
+                confident += 1
+                confident_agree += intent == expected
+
+    total = len(samples) or 1
+    return {
+        "samples": len(samples),
+        "agreement": agree / total,
+        "coverage": confident / total,
+        "confident_agreement": confident_agree / confident if confident else 0.0,
+    }
+
+
+async def main():
+    samples = await load_routing_samples()
+    threshold = settings.ROUTER_CLASSIFIER_THRESHOLD
+    report = evaluate(samples, threshold)
+    print(f"Historical routing decisions: {report['samples']}")
+    print(f"Agreement (all):              {report['agreement']:.1%}")
+    print(f"Coverage at threshold {threshold:.2f}:  {report['coverage']:.1%}")
+    print(f"Agreement (above threshold):  {report['confident_agreement']:.1%}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,4 +6,9 @@ class AgentState(TypedDict):
     messages: Annotated[List[Any], operator.add]
     active_agent: Optional[str] = None
     intent: Optional[str] = None
+    # Router latency (ms) and how the intent was chosen: explicit / llm / fallback
+    routing_ms: Optional[float] = None
+    routing_source: Optional[str] = None
+    # Outcome of speculative agent execution during routing: hit / miss
+    speculation: Optional[str] = None
     # Add other state variables as needed
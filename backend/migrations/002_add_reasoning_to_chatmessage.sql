@@ -0,0 +1,2 @@
+-- Migration to store model reasoning separately from the message content
+ALTER TABLE chatmessage ADD COLUMN IF NOT EXISTS reasoning TEXT;
@@ -0,0 +1,2 @@
+-- Migration to record who chose each assistant message's agent (explicit / llm / classifier / fallback)
+ALTER TABLE chatmessage ADD COLUMN IF NOT EXISTS routing_source VARCHAR;
@@ -0,0 +1,70 @@
+"""
+Minimal OpenAI-compatible streaming server for exercising LLM_UPSTREAMS balancing and
+hedging locally:
+
+    python stub_llm.py --port 9001 --ttft 0.2
+    python stub_llm.py --port 9002 --ttft 2.0 --error-rate 0.2
+
+    LLM_UPSTREAMS='[{"name": "fast", "base_url": "http://localhost:9001/v1", "api_key": "x"},
+                    {"name": "slow", "base_url": "http://localhost:9002/v1", "api_key": "x"}]'
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", type=int, default=9001)
+parser.add_argument("--ttft", type=float, default=0.2, help="Seconds before the first token")
+parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between tokens")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+parser.add_argument("--reply", default="Hello from the stub upstream.")
+args = parser.parse_args()
+
+app = FastAPI()
+stats = {"requests": 0, "completed": 0, "cancelled": 0}
+
+def chunk(model: str, delta: dict, finish_reason=None) -> str:
+    payload = {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.post("/v1/chat/completions")
+async def chat_completions(body: dict):
+    stats["requests"] += 1
+    if random.random() < args.error_rate:
+        return JSONResponse(status_code=500, content={"error": {"message": "stub failure"}})
+
+    model = body.get("model", "stub")
+
+    async def stream():
+        try:
+            await asyncio.sleep(args.ttft)
+            yield chunk(model, {"role": "assistant", "content": ""})
+            for token in args.reply.split(" "):
+                yield chunk(model, {"content": token + " "})
+                await asyncio.sleep(args.token_delay)
+            yield chunk(model, {}, "stop")
+            yield "data: [DONE]\n\n"
+            stats["completed"] += 1
+        except asyncio.CancelledError:
+            stats["cancelled"] += 1
+            raise
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="warning")
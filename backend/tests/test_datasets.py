@@ -0,0 +1,62 @@
+import pytest
+from app.core.datasets import DatasetError, Table, compute_binding, parse_upload
+
+CSV = b"""region,product,sales,day
+EU,a,10,2024-01-01
+EU,,20,2024-01-02
+US,b,5,2024-01-03
+,a,7,2024-01-04
+US,a,1,2024-01-05
+"""
+
+
+@pytest.fixture
+def table():
+    arrays, schema, _ = parse_upload(CSV, "sales.csv")
+    return Table(schema, arrays)
+
+
+@pytest.mark.parametrize("spec", [
+    {"x": ["region"]},
+    {"x": "region", "bins": "ten"},
+    {"x": "sales", "bins": 0},
+    {"x": "region", "limit": True},
+    {"x": "region", "maxPoints": [5]},
+    {"x": "region", "filter": "region == EU"},
+    {"x": "region", "filter": [["region", "==", "EU"]]},
+    {"x": "region", "filter": [{"column": "sales", "op": "between", "value": 3}]},
+    {"x": "region", "filter": [{"column": "sales", "op": "in", "value": 3}]},
+    {"x": "region", "filter": [{"column": ["sales"], "op": ">", "value": 3}]},
+    {"x": "region", "groupBy": ["product"]},
+    {"x": "region", "sort": "sales"},
+    {"x": "day", "bucket": "fortnight"},
+    {"x": "region", "y": 5},
+    {"x": "region", "y": [{"column": ["sales"], "agg": "sum"}]},
+    {"x": "region", "y": [{"column": "sales", "agg": ["sum"]}]},
+    {"x": "region", "y": [{"column": "product", "agg": "sum"}]},
+    {"x": "region", "y": [{"column": "product", "agg": "mean"}]},
+    {"x": "region", "y": [{"column": "product", "agg": "median"}]},
+    {"x": "region", "groupBy": "product", "y": "product"},
+    {"x": "sales", "y": "product"},
+])
+def test_invalid_specs_raise_dataset_error(table, spec):
+    with pytest.raises(DatasetError):
+        compute_binding(table, spec)
+
+
+def test_missing_categories_form_no_group(table):
+    dimensions, rows, _ = compute_binding(table, {"x": "region", "y": [{"column": "sales", "agg": "sum"}]})
+    assert dimensions == ["region", "sales_sum"]
+    assert rows == [["EU", 30], ["US", 6]]
+
+
+def test_missing_categories_form_no_series(table):
+    dimensions, rows, groups = compute_binding(table, {"x": "region", "groupBy": "product", "y": "sales"})
+    assert groups == ["a", "b"]
+    assert dimensions == ["region", "a", "b"]
+    assert rows == [["EU", 10, 0], ["US", 1, 5]]
+
+
+def test_category_columns_can_be_counted(table):
+    _, rows, _ = compute_binding(table, {"x": "region", "y": [{"column": "product", "agg": "count"}]})
+    assert rows == [["EU", 1], ["US", 2]]
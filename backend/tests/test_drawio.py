@@ -0,0 +1,49 @@
+import json
+import xml.etree.ElementTree as ET
+import pytest
+from app.agents.drawio import compile_drawio_ir, extract_ir
+
+
+def sample_ir(direction: str) -> dict:
+    return {
+        "direction": direction, "title": "Shop",
+        "groups": [{"id": "vpc", "label": "VPC", "style": "vpc"}, {"id": "priv", "label": "Private", "style": "subnet", "parent": "vpc"}],
+        "nodes": [
+            {"id": "u", "label": "User", "style": "user"},
+            {"id": "lb", "label": "Load\nBalancer", "style": "loadbalancer", "group": "vpc"},
+            {"id": "db", "label": "DB", "style": "database", "group": "priv"},
+            {"id": "raw", "label": "Custom", "style": "fillColor=#ffffff;"},
+        ],
+        "edges": [
+            {"from": "u", "to": "lb", "style": "async"},
+            {"from": "lb", "to": "db", "label": "SQL", "style": "default"},
+            {"from": "u", "to": "raw", "style": "dashed"},
+        ],
+    }
+
+
+def by_id(items: list[dict]) -> dict:
+    return {item["id"]: item for item in items}
+
+
+@pytest.mark.parametrize("direction", ["TB", "LR"])
+def test_ir_is_read_back_from_the_compiled_cells(direction):
+    ir = sample_ir(direction)
+    xml = ET.tostring(compile_drawio_ir(ir), encoding="unicode")
+    assert 'ir="' not in xml
+
+    extracted = json.loads(extract_ir(xml))
+    assert extracted["direction"] == direction
+    assert extracted["title"] == "Shop"
+    assert by_id(extracted["groups"]) == by_id(ir["groups"])
+    assert by_id(extracted["nodes"]) == by_id(ir["nodes"])
+    assert extracted["edges"] == ir["edges"]
+
+
+@pytest.mark.parametrize("xml", [
+    "not xml",
+    '<mxfile host="Electron"><diagram><mxGraphModel><root/></mxGraphModel></diagram></mxfile>',
+    '<mxfile host="DeepDiagram"><diagram><mxGraphModel><root><mxCell id="0"/></root></mxGraphModel></diagram></mxfile>',
+])
+def test_no_ir_for_other_diagrams(xml):
+    assert extract_ir(xml) is None
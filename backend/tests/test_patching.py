@@ -0,0 +1,73 @@
+import json
+import pytest
+from app.core.patching import PatchError, apply_cell_ops, apply_edit, apply_json_patch
+
+DOC = {"nodes": [{"id": "1", "data": {"label": "Start"}}], "edges": []}
+XML = (
+    '<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>'
+    '<mxCell id="a" vertex="1" parent="1"><mxGeometry x="0" y="0" width="80" height="40" as="geometry"/></mxCell>'
+    '</root></mxGraphModel>'
+)
+
+
+def test_json_patch_applies_to_a_copy():
+    patched = apply_json_patch(DOC, [{"op": "replace", "path": "/nodes/0/data/label", "value": "Begin"}])
+    assert patched["nodes"][0]["data"]["label"] == "Begin"
+    assert DOC["nodes"][0]["data"]["label"] == "Start"
+
+
+@pytest.mark.parametrize("operation", [
+    {"op": "add", "path": 5, "value": {}},
+    {"op": "add", "path": None, "value": {}},
+    {"op": "add", "path": ["nodes", "-"], "value": {}},
+    {"op": "move", "from": 3, "path": "/edges/-"},
+    {"op": 1, "path": "/nodes/0"},
+    {"op": "replace", "path": "/nodes/-1/data/label", "value": "x"},
+    "remove /nodes/0",
+])
+def test_json_patch_rejects_malformed_operations(operation):
+    with pytest.raises(PatchError):
+        apply_json_patch(DOC, [operation])
+
+
+@pytest.mark.parametrize("operation", [
+    {"op": "add", "cell": {"id": "b"}},
+    {"op": "add", "cell": None},
+    {"op": "add", "cell": "<mxGeometry/>"},
+    {"op": "update", "id": "a", "attrs": ["value", "x"]},
+    {"op": "update", "id": "a", "attrs": {"value": {"text": "x"}}},
+    {"op": "update", "id": "a", "geometry": "x=10"},
+    {"op": "update", "id": "a", "geometry": {"x": "left"}},
+    {"op": "update", "id": "a", "geometry": {"x": None}},
+    {"op": "update", "id": 7},
+    ["remove", "a"],
+])
+def test_cell_ops_reject_malformed_operations(operation):
+    with pytest.raises(PatchError):
+        apply_cell_ops(XML, [operation])
+
+
+def test_cell_ops_update_geometry():
+    xml = apply_cell_ops(XML, [{"op": "update", "id": "a", "attrs": {"value": "API"}, "geometry": {"x": 120, "y": "40"}}])
+    assert 'value="API"' in xml and 'x="120"' in xml and 'y="40"' in xml
+
+
+def test_cell_removal_cascades_to_descendants_and_their_edges():
+    xml = (
+        '<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>'
+        '<mxCell id="g" parent="1"/><mxCell id="s" parent="g"/><mxCell id="n" parent="s"/>'
+        '<mxCell id="o" parent="1"/><mxCell id="e" edge="1" source="n" target="o" parent="1"/>'
+        '<mxCell id="label" parent="e"/></root></mxGraphModel>'
+    )
+    result = apply_cell_ops(xml, [{"op": "remove", "id": "g"}])
+    for removed in ("g", "s", "n", "e", "label"):
+        assert f'id="{removed}"' not in result
+    assert 'id="o"' in result
+
+
+@pytest.mark.parametrize("output", ['[{"op": "add", "path": 5}]', '{"op": "add"}', "[1, 2]"])
+def test_apply_edit_raises_patch_error_for_bad_model_output(output):
+    with pytest.raises(PatchError):
+        apply_edit("json", json.dumps(DOC), output)
+    with pytest.raises(PatchError):
+        apply_edit("cells", XML, output)
@@ -88,6 +88,10 @@ const AGENTS = [
     },
 ];
 
+// Reconnects to a running generation after a dropped stream (Last-Event-ID replay)
+const MAX_RESUME_ATTEMPTS = 3;
+const RESUME_DELAY_MS = 1000;
+
 export const ChatPanel = () => {
     const {
         messages,
@@ -138,6 +142,8 @@ export const ChatPanel = () => {
     const [showHistory, setShowHistory] = useState(false);
     const historyRef = useRef<HTMLDivElement>(null);
     const abortControllerRef = useRef<AbortController | null>(null);
+    // Server-side run behind the current stream (X-Generation-Id), used to cancel and resume it
+    const generationIdRef = useRef<string | null>(null);
 
     const fileInputRef = useRef<HTMLInputElement>(null);
     const inputRef = useRef<HTMLTextAreaElement>(null);
@@ -220,10 +226,34 @@ export const ChatPanel = () => {
         return () => document.removeEventListener('mousedown', handleClickOutside);
     }, []);
 
+    // CSV / JSON files are attached to the session as datasets for charts
+    const uploadDataset = async (file: File) => {
+        const params = new URLSearchParams({ name: file.name });
+        if (sessionId) params.set('session_id', String(sessionId));
+        try {
+            const response = await fetch(`/api/datasets?${params}`, { method: 'POST', body: file });
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.detail || response.statusText);
+            if (!sessionId) {
+                setSessionId(data.session_id);
+                loadSessions();
+            }
+            useChatStore.setState({ toast: { message: `Dataset "${file.name}" attached (${data.dataset.rows} rows)`, type: 'success' } });
+        } catch (error) {
+            useChatStore.getState().reportError(`Dataset upload failed: ${error instanceof Error ? error.message : error}`);
+        }
+    };
+
     const handleFileSelect = (e: React.ChangeEvent<HTMLInputElement>) => {
         const file = e.target.files?.[0];
         if (!file) return;
 
+        if (/\.(csv|json)$/i.test(file.name)) {
+            void uploadDataset(file);
+            e.target.value = '';
+            return;
+        }
+
         const reader = new FileReader();
         reader.onloadend = () => {
             const base64String = reader.result as string;
@@ -359,6 +389,12 @@ export const ChatPanel = () => {
 
     const stopGeneration = () => {
         if (abortControllerRef.current) {
+            // Aborting the fetch only detaches from the run; cancel it so the server stops generating
+            if (generationIdRef.current) {
+                void fetch(`/api/generations/${generationIdRef.current}/cancel`, { method: 'POST' })
+                    .catch((err) => console.error('Cancel failed', err));
+                generationIdRef.current = null;
+            }
             abortControllerRef.current.abort();
             abortControllerRef.current = null;
             setLoading(false);
@@ -418,6 +454,8 @@ export const ChatPanel = () => {
         }
 
         let thoughtBuffer = "";
+        // Whether a <think> block is open in the thought / tool_code stream
+        const openThink: Record<string, boolean> = { thought: false, tool_code: false };
         let toolArgsBuffer = "";
 
         // Create new AbortController
@@ -439,16 +477,41 @@ export const ChatPanel = () => {
             });
 
             if (!response.ok) throw new Error('Network response was not ok');
+            generationIdRef.current = response.headers.get('X-Generation-Id');
 
-            const reader = response.body?.getReader();
-            const decoder = new TextDecoder();
+            let reader = response.body?.getReader();
+            let decoder = new TextDecoder();
 
             if (!reader) return;
 
             let buffer = '';
+            // Id of the last complete event, replayed from on reconnect (Last-Event-ID)
+            let lastEventId = 0;
+            let resumeAttempts = 0;
             while (true) {
-                const { done, value } = await reader.read();
+                let chunk: ReadableStreamReadResult<Uint8Array>;
+                try {
+                    chunk = await reader.read();
+                } catch (readError: any) {
+                    // Connection dropped while the run goes on server-side: resume after the last event seen
+                    const generationId = generationIdRef.current;
+                    if (readError.name === 'AbortError' || !generationId || resumeAttempts >= MAX_RESUME_ATTEMPTS) throw readError;
+                    resumeAttempts += 1;
+                    await new Promise((resolve) => setTimeout(resolve, RESUME_DELAY_MS * resumeAttempts));
+                    const resumed = await fetch(`/api/generations/${generationId}/events`, {
+                        headers: { 'Last-Event-ID': String(lastEventId) },
+                        signal: abortControllerRef.current?.signal
+                    });
+                    if (!resumed.ok || !resumed.body) throw readError;
+                    reader = resumed.body.getReader();
+                    decoder = new TextDecoder();
+                    // A partial frame is replayed in full
+                    buffer = '';
+                    continue;
+                }
+                const { done, value } = chunk;
                 if (done) break;
+                resumeAttempts = 0;
 
                 // stream: true handles multi-byte characters split across chunks
                 buffer += decoder.decode(value, { stream: true });
@@ -461,9 +524,12 @@ export const ChatPanel = () => {
                 for (const line of parts) {
                     if (!line.trim()) continue;
 
+                    const idMatch = line.match(/^id: (\d+)$/m);
+                    if (idMatch) lastEventId = Number(idMatch[1]);
+
                     const eventMatch = line.match(/event: (.*)\ndata: (.*)/);
                     if (eventMatch) {
-                        const eventName = eventMatch[1].trim();
+                        let eventName = eventMatch[1].trim();
                         const dataStr = eventMatch[2].trim();
 
                         try {
@@ -483,7 +549,20 @@ export const ChatPanel = () => {
                                 continue;
                             }
 
-                            // 3. Dispatch events
+                            // 3. Reasoning arrives on its own channel; render it inline as <think> blocks
+                            if (eventName === 'reasoning') {
+                                const channel = data.channel === 'tool_code' ? 'tool_code' : 'thought';
+                                data.content = (openThink[channel] ? '' : '<think>') + data.content;
+                                openThink[channel] = true;
+                                eventName = channel;
+                            } else if ((eventName === 'thought' || eventName === 'tool_code') && openThink[eventName] && data.content) {
+                                data.content = '</think>' + data.content;
+                                openThink[eventName] = false;
+                            } else if (eventName === 'tool_start') {
+                                openThink.tool_code = false;
+                            }
+
+                            // 4. Dispatch events
                             switch (eventName) {
                                 case 'message_created':
                                     useChatStore.setState((state) => {
@@ -680,11 +759,14 @@ export const ChatPanel = () => {
                                     // Mark whatever was last (Tool or result) as done
                                     if (lastStepEnd?.isStreaming) {
                                         let finalContent = data.output || lastStepEnd.content || '';
-                                        // Preservation Fix: If we were streaming a Result (tool_end), 
-                                        // the existing content (accumulated chunks) is definitely what we want.
-                                        // The data.output might be a summarized result or cleaned code from backend that loses thoughts.
+                                        // Preservation Fix: If we were streaming a Result (tool_end), keep the
+                                        // streamed thoughts, but the code is the backend's output: it is validated,
+                                        // repaired and laid out (or compiled) after the raw stream.
                                         if (lastStepEnd.type === 'tool_end' && lastStepEnd.content) {
-                                            finalContent = lastStepEnd.content;
+                                            const thoughts = (lastStepEnd.content.match(/<think>[\s\S]*?<\/think>/gi) || []).join('');
+                                            finalContent = typeof data.output === 'string' && data.output
+                                                ? thoughts + data.output
+                                                : lastStepEnd.content;
                                         }
                                         updateLastStepContent(finalContent, false, 'done', lastStepEnd.type, false, eventSessionId);
                                     }
@@ -723,6 +805,7 @@ export const ChatPanel = () => {
             setLoading(false);
             setStreamingCode(false);
             abortControllerRef.current = null;
+            generationIdRef.current = null;
         }
     };
 
@@ -1222,7 +1305,7 @@ export const ChatPanel = () => {
                     <input
                         type="file"
                         ref={fileInputRef}
-                        accept="image/*"
+                        accept="image/*,.csv,.json"
                         onChange={handleFileSelect}
                         className="hidden"
                     />
@@ -1274,7 +1357,7 @@ export const ChatPanel = () => {
                                     type="button"
                                     onClick={() => fileInputRef.current?.click()}
                                     className="p-2 text-slate-400 hover:text-blue-600 hover:bg-blue-50 rounded-full transition-all"
-                                    title="Upload Image"
+                                    title="Upload Image or Dataset (CSV/JSON)"
                                     disabled={isLoading}
                                 >
                                     <Paperclip className="w-5 h-5" />
@@ -330,7 +330,8 @@ export const useChatStore = create<ChatState>((set, get) => ({
                     id: m.id,
                     parent_id: m.parent_id,
                     role: m.role,
-                    content: m.content,
+                    // Reasoning is stored separately; show it inline again
+                    content: m.reasoning ? `<think>${m.reasoning}</think>${m.content}` : m.content,
                     images: m.images,
                     steps: m.steps,
                     agent: m.agent,